@@ -0,0 +1,249 @@
+import os
+import json
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import ulid
+
+from long_align import DEFAULT_OVERLAP
+from marks_format import FORMATS
+from nemo_main_opt import add_reader_arguments, build_text_reader
+from result_store import DEFAULT_SWEEP_INTERVAL
+
+DEFAULT_MAX_BATCH = 16
+DEFAULT_MAX_WAIT_MS = 20
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_TIMEOUT = 120.0
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+class Job:
+    def __init__(self, text, audio_path, marks_format, window, overlap, future):
+        self.file_name = str(ulid.new())
+        self.text = text
+        self.audio_path = audio_path
+        self.marks_format = marks_format
+        self.window = window
+        self.overlap = overlap
+        self.future = future
+
+
+class AlignServer:
+    # One loaded model behind an asyncio front end. Requests wait in a bounded queue; the
+    # batcher takes up to max_batch of them, or whatever arrived within max_wait_ms of the
+    # first, and aligns them in one TextReader.batchResponse call on a single worker thread.
+
+    def __init__(self, text_reader, max_batch=DEFAULT_MAX_BATCH, max_wait_ms=DEFAULT_MAX_WAIT_MS,
+                 queue_size=DEFAULT_QUEUE_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.reader = text_reader
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.timeout = timeout
+        self.queue = asyncio.Queue(queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.counts = {'requests': 0, 'batches': 0, 'rejected': 0, 'timeouts': 0}
+        self.batcher = None
+
+    def start(self):
+        if self.batcher is None:
+            self.batcher = asyncio.get_running_loop().create_task(self.run_batches())
+        return self
+
+    async def close(self):
+        if self.batcher is not None:
+            self.batcher.cancel()
+            try:
+                await self.batcher
+            except asyncio.CancelledError:
+                pass
+            self.batcher = None
+        self.executor.shutdown(wait=True)
+
+    async def align(self, text, audio_path, marks_format="json", window=None, overlap=DEFAULT_OVERLAP,
+                    timeout=None):
+        # Returns (http_status, response dict)
+        if marks_format not in FORMATS:
+            raise ValueError(f"Unknown marks format: {marks_format}")
+        job = Job(text, audio_path, marks_format, window, overlap, asyncio.get_running_loop().create_future())
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.counts['rejected'] += 1
+            return 503, {'status': False, 'message': "Server busy, try again later"}
+        self.counts['requests'] += 1
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        try:
+            return 200, await asyncio.wait_for(job.future, timeout)
+        except asyncio.TimeoutError:
+            # The batcher skips cancelled jobs; one already being aligned finishes and is dropped
+            self.counts['timeouts'] += 1
+            return 504, {'status': False, 'message': f"Alignment timed out after {timeout:g}s"}
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            batch = [job for job in batch if not job.future.done()]
+            if not batch:
+                continue
+            self.counts['batches'] += 1
+            try:
+                responses = await loop.run_in_executor(self.executor, self.process, batch)
+            except Exception as e:
+                responses = [{'status': False, 'message': str(e)}] * len(batch)
+            for job, response in zip(batch, responses):
+                if not job.future.done():
+                    job.future.set_result(response)
+
+    def process(self, batch):
+        # Runs on the worker thread. Long-form requests and lone requests go through
+        # marksResponse; the rest are batched per output format.
+        responses = {}
+        groups = {}
+        for job in batch:
+            groups.setdefault(job.marks_format if job.window is None else None, []).append(job)
+        for marks_format, jobs in groups.items():
+            if marks_format is not None and len(jobs) > 1:
+                responses.update(self.process_batch(jobs, marks_format))
+            else:
+                for job in jobs:
+                    responses[job] = self.process_one(job)
+        return [responses[job] for job in batch]
+
+    def process_batch(self, jobs, marks_format):
+        items = [(job.file_name, job.text, job.audio_path) for job in jobs]
+        batch_response = self.reader.batchResponse(items, str(ulid.new()), self.max_batch, marks_format)
+        if not batch_response['status']:
+            # One bad request (say a missing file) fails the whole batch; answer each on its own
+            return {job: self.process_one(job) for job in jobs}
+        results = {result['id']: result for result in batch_response['results']}
+        responses = {}
+        for job in jobs:
+            response = {key: value for key, value in results[job.file_name].items() if key != 'id'}
+            response['status'] = True
+            if 'cache' in batch_response:
+                response['cache'] = batch_response['cache']
+            response['time'] = batch_response['time']
+            if 'timings' in batch_response:
+                response['timings'] = batch_response['timings']
+            responses[job] = response
+        return responses
+
+    def process_one(self, job):
+        return self.reader.marksResponse(job.text, job.file_name, job.audio_path, job.window, job.overlap,
+                                         job.marks_format)
+
+    def health(self):
+        return dict(self.counts, status=True, queued=self.queue.qsize(), max_batch=self.max_batch,
+                    max_wait_ms=self.max_wait * 1000)
+
+    async def handle(self, reader, writer):
+        try:
+            status, body = await self.dispatch(reader)
+        except KeyError as e:
+            status, body = 400, {'status': False, 'message': f"Missing field: {e.args[0]}"}
+        except (ValueError, TypeError) as e:
+            status, body = 400, {'status': False, 'message': str(e)}
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        payload = json.dumps(body).encode("utf-8")
+        writer.write((f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                      "Content-Type: application/json\r\n"
+                      f"Content-Length: {len(payload)}\r\n"
+                      + ("Retry-After: 1\r\n" if status == 503 else "")
+                      + "Connection: close\r\n\r\n").encode("latin-1") + payload)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def dispatch(self, reader):
+        # Minimal HTTP/1.1: one request per connection, JSON bodies only
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) < 2:
+            raise ValueError("Malformed request line")
+        method, path = request_line[0], request_line[1]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if path == "/health":
+            return 200, self.health()
+        if path != "/align":
+            return 404, {'status': False, 'message': f"Unknown path: {path}"}
+        if method != "POST":
+            return 405, {'status': False, 'message': "Use POST /align"}
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_BYTES:
+            return 413, {'status': False, 'message': "Request body too large"}
+        request = json.loads(await reader.readexactly(length))
+        return await self.align(request["text"], request["audiopath"], request.get("format", "json"),
+                                request.get("window"), request.get("overlap", DEFAULT_OVERLAP),
+                                request.get("timeout"))
+
+
+async def serve(align_server, host="127.0.0.1", port=8765, socket_path=None):
+    align_server.start()
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(align_server.handle, path=socket_path)
+    else:
+        server = await asyncio.start_server(align_server.handle, host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await align_server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve text highlight alignments over HTTP')
+    parser.add_argument('--host', help='address to listen on', default='127.0.0.1')
+    parser.add_argument('--port', help='port to listen on', type=int, default=8765)
+    parser.add_argument('--socket', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--max_batch', help='most requests aligned together', type=int, default=DEFAULT_MAX_BATCH)
+    parser.add_argument('--max_wait_ms', help='how long the first request of a batch waits for company',
+                        type=float, default=DEFAULT_MAX_WAIT_MS)
+    parser.add_argument('--queue_size', help='queued requests before new ones get 503', type=int,
+                        default=DEFAULT_QUEUE_SIZE)
+    parser.add_argument('--timeout', help='seconds before a request gets 504', type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument('--sweep_interval', help='seconds between output directory and result store sweeps',
+                        type=float, default=DEFAULT_SWEEP_INTERVAL)
+    add_reader_arguments(parser)
+
+    args = parser.parse_args()
+    text_reader = build_text_reader(args)
+    if args.sweep_outputs_after is not None or text_reader.result_store is not None:
+        max_age = args.sweep_outputs_after * 3600 if args.sweep_outputs_after is not None else None
+        text_reader.sweeper(max_age, args.sweep_interval).start()
+    align_server = AlignServer(text_reader, args.max_batch, args.max_wait_ms, args.queue_size, args.timeout)
+    print(f"Listening on {args.socket or f'{args.host}:{args.port}'}", flush=True)
+    try:
+        asyncio.run(serve(align_server, args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,507 @@
+import os
+import sys
+import json
+import wave
+import shutil
+import tempfile
+import subprocess
+
+from ctm import read_ctm_marks
+from audio_ingest import SAMPLE_RATE, read_wav_header, is_ingested, load_samples
+from timings import span
+
+DEFAULT_MODEL = "stt_en_fastconformer_hybrid_large_pc"
+NFA_DIR = "NeMo/tools/nemo_forced_aligner"
+SEGMENT_SEPARATOR = "|"
+DEFAULT_BATCH_SIZE = 16
+ENGINES = ("auto", "numpy", "nemo")
+OUTPUTS = ("words", "tokens", "segments", "ass")
+TMPFS_DIR = "/dev/shm"
+
+ASS_FILE_CONFIG = {
+    "vertical_alignment": "bottom",
+    "text_already_spoken_rgb": [66, 245, 212],
+    "text_being_spoken_rgb": [242, 222, 44],
+    "text_not_yet_spoken_rgb": [223, 242, 239],
+}
+
+
+def utterance(utt_id, text, audio_path):
+    return {"utt_id": utt_id, "text": text, "audio_filepath": audio_path}
+
+
+def scratch_root():
+    # Scratch output that is read back and deleted right away belongs in RAM when we have it
+    return TMPFS_DIR if os.path.isdir(TMPFS_DIR) else tempfile.gettempdir()
+
+
+def audio_duration(audio_path):
+    return read_wav_header(audio_path).duration
+
+
+class NemoBackend:
+    # Loads the NeMo model once and runs the NFA alignment steps in-process. profile: a
+    # cpu_inference.CPUProfile (int8 quantization, threads, inference_mode), or None.
+
+    def __init__(self, pretrained_name=DEFAULT_MODEL, device="cpu", nfa_dir=NFA_DIR,
+                 separator=SEGMENT_SEPARATOR, ass_file_config=None, profile=None):
+        self.name = profile.model_name(pretrained_name) if profile is not None else pretrained_name
+        self.pretrained_name = pretrained_name
+        self.profile = profile
+        self.device = device
+        self.nfa_dir = nfa_dir
+        self.separator = separator
+        self.ass_file_config = dict(ASS_FILE_CONFIG if ass_file_config is None else ass_file_config)
+        self.model = None
+        self.nfa = None
+        self.output_timestep_duration = None
+
+    def load(self):
+        if self.model is not None:
+            return
+        import torch
+        from nemo.collections.asr.models import ASRModel
+        from nemo.collections.asr.models.hybrid_rnnt_ctc_models import EncDecHybridRNNTCTCModel
+
+        if self.profile is not None:
+            self.profile.configure_threads()
+        with span("model_load"):
+            self.nfa = _load_nfa(self.nfa_dir)
+            model = ASRModel.from_pretrained(self.pretrained_name, map_location=torch.device(self.device))
+            model.eval()
+            if isinstance(model, EncDecHybridRNNTCTCModel):
+                model.change_decoding_strategy(decoder_type="ctc")
+            if self.profile is not None:
+                model = self.profile.prepare(model)
+        self.model = model
+
+    def no_grad(self):
+        import torch
+
+        return self.profile.no_grad() if self.profile is not None else torch.no_grad()
+
+    @property
+    def blank_id(self):
+        return self.model.tokenizer.vocab_size
+
+    @property
+    def frame_duration(self):
+        return self.model.cfg.preprocessor.window_stride * self.model.cfg.encoder.subsampling_factor
+
+    def tokenize(self, word):
+        return self.model.tokenizer.text_to_ids(word)
+
+    def samples(self, audio_path):
+        import numpy as np
+        from nemo.collections.asr.parts.preprocessing.segment import AudioSegment
+
+        sample_rate = self.model.cfg.preprocessor.sample_rate
+        if sample_rate == SAMPLE_RATE and is_ingested(audio_path):
+            # Already decoded by the ingest stage: map it instead of decoding again
+            return np.asarray(load_samples(audio_path))
+        return AudioSegment.from_file(audio_path, target_sr=sample_rate).samples
+
+    def emissions(self, audio_path):
+        return self.batch_emissions([audio_path])[0]
+
+    def batch_emissions(self, audio_paths):
+        self.load()
+        return padded_emissions([self.samples(audio_path) for audio_path in audio_paths], self.forward, self.no_grad(),
+                                self.device)
+
+    def forward(self, signal, length):
+        output = self.model.forward(input_signal=signal, input_signal_length=length)
+        if hasattr(self.model, "ctc_decoder"):
+            return self.model.ctc_decoder(encoder_output=output[0]), output[1]
+        return output[0], output[1]
+
+    def emission_module(self):
+        from cpu_inference import emission_module
+
+        self.load()
+        return emission_module(self.model, self.forward)
+
+    def tokenizer_spec(self):
+        # For cpu_inference.export_backend; the FastConformer models use SentencePiece
+        tokenizer = getattr(self.model.tokenizer, "tokenizer", None)
+        if not hasattr(tokenizer, "serialized_model_proto"):
+            raise ValueError(f"Cannot export the tokenizer of {self.pretrained_name}")
+        return {'type': "sentencepiece"}, tokenizer.serialized_model_proto()
+
+    def align_batch(self, utterances, output_dir=None, batch_size=DEFAULT_BATCH_SIZE, outputs=("words",)):
+        self.load()
+        results = []
+        for start in range(0, len(utterances), batch_size):
+            results.extend(self._align_batch(utterances[start:start + batch_size], output_dir, outputs))
+        return results
+
+    def _align_batch(self, utterances, output_dir, outputs):
+        import torch
+
+        nfa = self.nfa
+        with self.no_grad():
+            with span("inference"):
+                log_probs, y, T, U, utt_objs, self.output_timestep_duration = nfa.get_batch_variables(
+                    self.model, utterances, self.separator, self.output_timestep_duration
+                )
+            with span("viterbi"):
+                alignments = nfa.viterbi_decoding(log_probs, y, T, U, torch.device(self.device))
+
+        results = []
+        for item, utt_obj, alignment in zip(utterances, utt_objs, alignments):
+            utt_obj = nfa.add_t_start_end_to_utt_obj(utt_obj, alignment, self.output_timestep_duration)
+            utt_obj.utt_id = item["utt_id"]
+            marks = _utt_obj_marks(utt_obj)
+            if output_dir is not None:
+                with span("write_outputs"):
+                    for level in ("words", "tokens", "segments"):
+                        if level in outputs:
+                            write_ctm(_utt_obj_rows(utt_obj, level), output_dir, level, item["utt_id"])
+                    if "ass" in outputs:
+                        nfa.make_ass_files(utt_obj, output_dir, nfa.ASSFileConfig(**self.ass_file_config))
+            results.append(marks)
+        return results
+
+
+def padded_emissions(clips, forward, no_grad, device="cpu"):
+    # One forward pass over the clips zero-padded to the longest, the way NFA batches them;
+    # each clip's log-probs are cut back to its own number of frames
+    import numpy as np
+    import torch
+
+    signal = torch.zeros((len(clips), max(len(clip) for clip in clips)), dtype=torch.float32)
+    for row, clip in enumerate(clips):
+        signal[row, :len(clip)] = torch.from_numpy(np.array(clip, dtype=np.float32))
+    lengths = torch.tensor([len(clip) for clip in clips], device=device)
+    with no_grad:
+        log_probs, lengths = forward(signal.to(device), lengths)
+    return [log_probs[row, :int(lengths[row])].float().cpu().numpy() for row in range(len(clips))]
+
+
+class SubprocessBackend:
+    # The original path: one align.py process per call, marks read back from ctm/words
+
+    def __init__(self, pretrained_name=DEFAULT_MODEL, nfa_dir=NFA_DIR, python="python",
+                 separator=SEGMENT_SEPARATOR, ass_file_config=None):
+        self.name = pretrained_name
+        self.nfa_dir = nfa_dir
+        self.python = python
+        self.separator = separator
+        self.ass_file_config = dict(ASS_FILE_CONFIG if ass_file_config is None else ass_file_config)
+
+    def load(self):
+        pass
+
+    def align_batch(self, utterances, output_dir=None, batch_size=DEFAULT_BATCH_SIZE, outputs=("words",)):
+        if output_dir is None:
+            work_dir = tempfile.mkdtemp(prefix="nfa_output_", dir=scratch_root())
+            try:
+                return self.align_batch(utterances, work_dir, batch_size, outputs)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        # align.py names each CTM after the audio file, so link every audio under its utt_id
+        audio_dir = os.path.join(output_dir, "audio")
+        os.makedirs(audio_dir, exist_ok=True)
+        manifest_file_path = os.path.join(output_dir, "manifest.json")
+        with span("manifest"), open(manifest_file_path, "w") as manifest_file:
+            for item in utterances:
+                audio_link = os.path.join(audio_dir, item["utt_id"] + os.path.splitext(item["audio_filepath"])[1])
+                if not os.path.lexists(audio_link):
+                    os.symlink(os.path.abspath(item["audio_filepath"]), audio_link)
+                manifest_file.write(json.dumps({"audio_filepath": audio_link, "text": item["text"]}) + "\n")
+
+        command = [
+            self.python, os.path.join(self.nfa_dir, "align.py"),
+            f'pretrained_name="{self.name}"',
+            f'manifest_filepath="{manifest_file_path}"',
+            f'output_dir="{output_dir}"',
+            f'additional_segment_grouping_separator="{self.separator}"',
+            f'batch_size={batch_size}',
+            'save_output_file_formats=[ctm,ass]' if "ass" in outputs else 'save_output_file_formats=[ctm]',
+        ]
+        if "ass" in outputs:
+            for key, value in self.ass_file_config.items():
+                if isinstance(value, list):
+                    command.append(f'ass_file_config.{key}=[{",".join(str(v) for v in value)}]')
+                else:
+                    command.append(f'ass_file_config.{key}="{value}"')
+        try:
+            # Model startup and inference both happen in here
+            with span("subprocess"):
+                subprocess.run(" ".join(command), shell=True, check=True)
+        finally:
+            os.remove(manifest_file_path)
+            shutil.rmtree(audio_dir, ignore_errors=True)
+
+        ctm_dir = os.path.join(output_dir, "ctm", "words")
+        with span("ctm_parse"):
+            results = [read_ctm_marks([os.path.join(ctm_dir, item["utt_id"] + ".ctm")]) for item in utterances]
+        # align.py always writes every CTM level; drop the ones nobody asked for
+        for level in ("words", "tokens", "segments"):
+            if level not in outputs:
+                shutil.rmtree(os.path.join(output_dir, "ctm", level), ignore_errors=True)
+        for name in os.listdir(output_dir):
+            if name.endswith("_with_output_file_paths.json"):
+                os.remove(os.path.join(output_dir, name))
+        return results
+
+
+class StubBackend:
+    # Stands in for the acoustic model in tests: align_batch spreads the words evenly over
+    # the audio, emissions are seeded noise over a character vocabulary with a blank bias
+    vocabulary = "abcdefghijklmnopqrstuvwxyz'"
+    frame_duration = 0.08
+
+    def __init__(self, seconds_per_word=0.4, separator=SEGMENT_SEPARATOR, seed=0):
+        self.name = "stub"
+        self.seconds_per_word = seconds_per_word
+        self.separator = separator
+        self.seed = seed
+        self.blank_id = len(self.vocabulary)
+        self.calls = 0
+
+    def load(self):
+        pass
+
+    def tokenize(self, word):
+        return [self.vocabulary.index(c) for c in word.lower() if c in self.vocabulary]
+
+    def emissions(self, audio_path):
+        self.calls += 1
+        return self._emissions(audio_path)
+
+    def batch_emissions(self, audio_paths):
+        self.calls += 1
+        return [self._emissions(audio_path) for audio_path in audio_paths]
+
+    def _emissions(self, audio_path):
+        import numpy as np
+
+        frames = max(int(audio_duration(audio_path) / self.frame_duration), 1)
+        rng = np.random.default_rng(self.seed)
+        logits = rng.normal(0.0, 1.0, (frames, self.blank_id + 1)).astype(np.float32)
+        logits[:, self.blank_id] += 2.0
+        return logits - np.logaddexp.reduce(logits, axis=1, keepdims=True)
+
+    def align_batch(self, utterances, output_dir=None, batch_size=DEFAULT_BATCH_SIZE, outputs=("words",)):
+        self.calls += 1
+        results = []
+        for item in utterances:
+            words = item["text"].replace(self.separator, " ").split()
+            try:
+                step = audio_duration(item["audio_filepath"]) / max(len(words), 1)
+            except (wave.Error, EOFError):
+                step = self.seconds_per_word
+            results.append([
+                {'s': round(i * step, 2), 'e': round((i + 1) * step, 2), 'w': word}
+                for i, word in enumerate(words)
+            ])
+            if output_dir is not None and "words" in outputs:
+                write_word_ctm(results[-1], output_dir, item["utt_id"])
+        return results
+
+
+class Aligner:
+    # engine: "numpy" aligns the backend's emissions with ctc_viterbi, "nemo" leaves alignment
+    # to the backend, "auto" uses numpy when the backend has emissions and only word-level
+    # output is wanted. outputs: which of OUTPUTS to write under output_dir, if one is given.
+    def __init__(self, backend=None, engine="auto", band=None, emission_cache=None):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine: {engine}")
+        self.backend = backend if backend is not None else NemoBackend()
+        self.engine = engine
+        self.band = band
+        self.emission_cache = emission_cache
+
+    def load(self):
+        self.backend.load()
+        return self
+
+    def uses_emissions(self, outputs=()):
+        unknown = set(outputs) - set(OUTPUTS)
+        if unknown:
+            raise ValueError(f"Unknown outputs: {', '.join(sorted(unknown))}")
+        if self.engine == "numpy":
+            if not hasattr(self.backend, "emissions"):
+                raise ValueError(f"{type(self.backend).__name__} does not provide emissions")
+            if set(outputs) - {"words"}:
+                raise ValueError("The numpy engine only produces word-level output")
+            return True
+        return self.engine == "auto" and set(outputs) <= {"words"} and hasattr(self.backend, "emissions")
+
+    def config(self, outputs=("words",)):
+        # Everything besides audio and text that changes the marks
+        numpy_engine = self.uses_emissions(outputs)
+        return {'backend': type(self.backend).__name__, 'model': self.backend.name, 'separator': self.backend.separator,
+                'engine': "numpy" if numpy_engine else "nemo", 'band': self.band if numpy_engine else None}
+
+    def align(self, text, audio_path, output_dir=None, utt_id="utt", outputs=("words",), cached=True):
+        # cached=False for temporary slices of a file: their emissions would never be asked
+        # for again and would only push whole files out of the emission cache
+        if not os.path.exists(audio_path):
+            raise FileNotFoundError(f"Audio file not found: {audio_path}")
+        if self.uses_emissions(outputs):
+            return self.emission_marks(text, self.emissions(audio_path, cached), output_dir, utt_id, outputs)
+        return self.backend.align_batch([utterance(utt_id, text, audio_path)], output_dir, outputs=outputs)[0]
+
+    def emissions(self, audio_path, cached=True):
+        with span("inference"):
+            if self.emission_cache is None or not cached:
+                return self.backend.emissions(audio_path)
+            return self.emission_cache.get_or_compute(audio_path, self.backend.name, self.backend.emissions)
+
+    def batch_emissions(self, audio_paths):
+        # Cached clips are read back; the rest go through the backend together when it can
+        # batch them
+        with span("inference"):
+            keys = [None] * len(audio_paths)
+            results = [None] * len(audio_paths)
+            if self.emission_cache is not None:
+                keys = [self.emission_cache.key(audio_path, self.backend.name) for audio_path in audio_paths]
+                results = [self.emission_cache.get(key) for key in keys]
+            missing = [i for i, log_probs in enumerate(results) if log_probs is None]
+            if missing:
+                paths = [audio_paths[i] for i in missing]
+                if hasattr(self.backend, "batch_emissions"):
+                    computed = self.backend.batch_emissions(paths)
+                else:
+                    computed = [self.backend.emissions(path) for path in paths]
+                for i, log_probs in zip(missing, computed):
+                    results[i] = log_probs
+                    if self.emission_cache is not None:
+                        self.emission_cache.put(keys[i], log_probs)
+            return results
+
+    def emission_marks(self, text, log_probs, output_dir, utt_id, outputs):
+        marks = self.align_emissions(text, log_probs)
+        if output_dir is not None and "words" in outputs:
+            with span("write_outputs"):
+                write_word_ctm(marks, output_dir, utt_id)
+        return marks
+
+    def align_emissions(self, text, log_probs):
+        from ctc_viterbi import align_words
+
+        words = text.replace(self.backend.separator, " ").split()
+        word_tokens = [self.backend.tokenize(word) for word in words]
+        args = (log_probs, word_tokens, words, self.backend.blank_id, self.backend.frame_duration)
+        with span("viterbi"):
+            if self.band is not None:
+                try:
+                    return align_words(*args, band=self.band)
+                except ValueError:
+                    # The path strays further from the diagonal than the band allows
+                    pass
+            return align_words(*args)
+
+    def align_batch(self, utterances, output_dir=None, batch_size=DEFAULT_BATCH_SIZE, outputs=("words",)):
+        seen = set()
+        for item in utterances:
+            if item["utt_id"] in seen:
+                raise ValueError(f"Duplicate utterance id: {item['utt_id']}")
+            seen.add(item["utt_id"])
+            if not os.path.exists(item["audio_filepath"]):
+                raise FileNotFoundError(f"Audio file not found: {item['audio_filepath']}")
+        if self.uses_emissions(outputs):
+            # batch_size clips per forward pass, then the Viterbi over each clip's emissions
+            results = {}
+            for start in range(0, len(utterances), batch_size):
+                chunk = utterances[start:start + batch_size]
+                for item, log_probs in zip(chunk, self.batch_emissions([item["audio_filepath"] for item in chunk])):
+                    results[item["utt_id"]] = self.emission_marks(item["text"], log_probs, output_dir, item["utt_id"],
+                                                                  outputs)
+            return results
+        results = self.backend.align_batch(list(utterances), output_dir, batch_size, outputs)
+        return {item["utt_id"]: marks for item, marks in zip(utterances, results)}
+
+
+def write_ctm(rows, output_dir, level, utt_id):
+    # rows: (start, end, text) in the same layout align.py writes
+    ctm_dir = os.path.join(output_dir, "ctm", level)
+    os.makedirs(ctm_dir, exist_ok=True)
+    with open(os.path.join(ctm_dir, f"{utt_id}.ctm"), "w") as ctm:
+        for start_time, end_time, text in rows:
+            ctm.write(f"{utt_id} 1 {start_time:.2f} {end_time - start_time:.2f} {text.replace(' ', '▁')} NA lex NA\n")
+
+
+def write_word_ctm(marks, output_dir, utt_id):
+    write_ctm(((mark['s'], mark['e'], mark['w']) for mark in marks), output_dir, "words", utt_id)
+
+
+def _utt_obj_rows(utt_obj, level):
+    for segment in utt_obj.segments_and_tokens:
+        if not hasattr(segment, "words_and_tokens"):
+            if level == "tokens":
+                yield segment.t_start, segment.t_end, segment.text
+            continue
+        if level == "segments":
+            yield segment.t_start, segment.t_end, segment.text
+            continue
+        for word in segment.words_and_tokens:
+            if not hasattr(word, "tokens"):
+                if level == "tokens":
+                    yield word.t_start, word.t_end, word.text
+            elif level == "words":
+                yield word.t_start, word.t_end, word.text
+            else:
+                for token in word.tokens:
+                    yield token.t_start, token.t_end, token.text
+
+
+def _utt_obj_marks(utt_obj):
+    # Same rounding as the CTM writer, so in-process marks match the file-based ones
+    marks = []
+    for segment in utt_obj.segments_and_tokens:
+        for word in getattr(segment, "words_and_tokens", []):
+            if not hasattr(word, "tokens") or word.t_start is None or word.t_start < 0:
+                continue
+            start_time = round(word.t_start, 2)
+            marks.append({
+                's': start_time,
+                'e': round(start_time + round(word.t_end - word.t_start, 2), 2),
+                'w': word.text.replace("▁", "")
+            })
+    return marks
+
+
+class _NFA:
+    pass
+
+
+def _load_nfa(nfa_dir):
+    # The NFA helpers live next to align.py; newer NeMo moved the core steps into the package
+    nfa_dir = os.path.abspath(nfa_dir)
+    if nfa_dir not in sys.path:
+        sys.path.insert(0, nfa_dir)
+    from align import ASSFileConfig
+    from utils.make_ass_files import make_ass_files
+
+    nfa = _NFA()
+    nfa.ASSFileConfig = ASSFileConfig
+    nfa.make_ass_files = make_ass_files
+    try:
+        from nemo.collections.asr.parts.utils.aligner_utils import (
+            add_t_start_end_to_utt_obj, get_batch_variables, viterbi_decoding
+        )
+
+        def batch_variables(model, utterances, separator, output_timestep_duration):
+            return get_batch_variables(
+                audio=[item["audio_filepath"] for item in utterances],
+                model=model,
+                segment_separators=separator,
+                gt_text_batch=[item["text"] for item in utterances],
+                output_timestep_duration=output_timestep_duration,
+            )
+    except ImportError:
+        from utils.data_prep import add_t_start_end_to_utt_obj, get_batch_variables
+        from utils.viterbi_decoding import viterbi_decoding
+
+        def batch_variables(model, utterances, separator, output_timestep_duration):
+            return get_batch_variables(
+                [{"audio_filepath": item["audio_filepath"], "text": item["text"]} for item in utterances],
+                model, separator, False, 1, output_timestep_duration,
+            )
+    nfa.get_batch_variables = batch_variables
+    nfa.viterbi_decoding = viterbi_decoding
+    nfa.add_t_start_end_to_utt_obj = add_t_start_end_to_utt_obj
+    return nfa
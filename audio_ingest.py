@@ -0,0 +1,227 @@
+import os
+import wave
+import shutil
+import struct
+import subprocess
+
+import numpy as np
+
+from emission_cache import EmissionCache, atomic_write
+
+SAMPLE_RATE = 16000
+DEFAULT_MAX_BYTES = 8 * 1024 ** 3
+BLOCK_FRAMES = 1 << 16
+PCM = 1
+IEEE_FLOAT = 3
+EXTENSIBLE = 0xFFFE
+HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+
+
+class WavInfo:
+    def __init__(self, format_tag, channels, rate, sample_bytes, data_offset, frames):
+        self.format_tag = format_tag
+        self.channels = channels
+        self.rate = rate
+        self.sample_bytes = sample_bytes
+        self.data_offset = data_offset
+        self.frames = frames
+
+    @property
+    def duration(self):
+        return self.frames / float(self.rate)
+
+
+def read_wav_header(audio_path):
+    # Walks the RIFF chunks up to "data"; unlike the wave module this also reads float WAVs
+    with open(audio_path, "rb") as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:] != b"WAVE":
+            raise wave.Error(f"Not a WAV file: {audio_path}")
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise wave.Error(f"No data chunk in {audio_path}")
+            name, size = struct.unpack("<4sI", chunk)
+            if name == b"fmt ":
+                body = f.read(size + size % 2)
+                if len(body) < 16:
+                    raise wave.Error(f"Truncated format chunk in {audio_path}")
+                format_tag, channels, rate, _, _, bits = struct.unpack_from("<HHIIHH", body)
+                if format_tag == EXTENSIBLE and size >= 26:
+                    format_tag = struct.unpack_from("<H", body, 24)[0]
+                fmt = (format_tag, channels, rate, bits // 8)
+            elif name == b"data":
+                if fmt is None:
+                    raise wave.Error(f"Data before format chunk in {audio_path}")
+                data_offset = f.tell()
+                # Streamed WAVs leave the size at 0 or 0xFFFFFFFF; trust the file length instead
+                available = os.fstat(f.fileno()).st_size - data_offset
+                size = available if size in (0, 0xFFFFFFFF) else min(size, available)
+                return WavInfo(*fmt, data_offset, size // (fmt[1] * fmt[3]))
+            else:
+                f.seek(size + size % 2, os.SEEK_CUR)
+
+
+def wav_header(frames, rate=SAMPLE_RATE, channels=1, sample_bytes=4, format_tag=IEEE_FLOAT):
+    # 44-byte header, so float samples start 4-byte aligned and can be memory-mapped as is
+    data_bytes = frames * channels * sample_bytes
+    return HEADER.pack(b"RIFF", 36 + data_bytes, b"WAVE", b"fmt ", 16, format_tag, channels, rate,
+                       rate * channels * sample_bytes, channels * sample_bytes, sample_bytes * 8, b"data", data_bytes)
+
+
+def load_samples(audio_path):
+    # Memory-mapped float32 samples of a WAV written by ingest
+    info = read_wav_header(audio_path)
+    if info.format_tag != IEEE_FLOAT or info.sample_bytes != 4 or info.channels != 1:
+        raise ValueError(f"Not a mono float32 WAV: {audio_path}")
+    if info.frames == 0:
+        return np.zeros(0, dtype=np.float32)
+    return np.memmap(audio_path, dtype="<f4", mode="r", offset=info.data_offset, shape=(info.frames,))
+
+
+def is_ingested(audio_path):
+    try:
+        info = read_wav_header(audio_path)
+    except (OSError, wave.Error):
+        return False
+    return info.format_tag == IEEE_FLOAT and info.sample_bytes == 4 and info.channels == 1 and info.rate == SAMPLE_RATE
+
+
+def decode(audio_path):
+    # Yields 16 kHz mono float32 blocks. WAVs are read directly; anything else, or a WAV at
+    # another rate when ffmpeg is installed, is streamed through ffmpeg.
+    try:
+        info = read_wav_header(audio_path)
+    except wave.Error:
+        info = None
+    if info is not None and (info.rate == SAMPLE_RATE or shutil.which("ffmpeg") is None):
+        return _resample(_wav_blocks(audio_path, info), info.rate)
+    return _ffmpeg_blocks(audio_path)
+
+
+def _wav_blocks(audio_path, info):
+    frame_bytes = info.channels * info.sample_bytes
+    with open(audio_path, "rb") as f:
+        f.seek(info.data_offset)
+        remaining = info.frames
+        while remaining > 0:
+            raw = f.read(min(remaining, BLOCK_FRAMES) * frame_bytes)
+            count = len(raw) // frame_bytes
+            if count == 0:
+                break
+            remaining -= count
+            yield _to_float(raw[:count * frame_bytes], info).reshape(count, info.channels).mean(axis=1,
+                                                                                                 dtype=np.float32)
+
+
+def _to_float(raw, info):
+    if info.format_tag == IEEE_FLOAT:
+        return np.frombuffer(raw, dtype="<f4" if info.sample_bytes == 4 else "<f8").astype(np.float32)
+    if info.format_tag != PCM:
+        raise ValueError(f"Unsupported WAV encoding {info.format_tag:#x}")
+    if info.sample_bytes == 1:
+        return (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    if info.sample_bytes == 3:
+        packed = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+        samples = packed[:, 0].astype(np.int32) | (packed[:, 1].astype(np.int32) << 8) | (packed[:, 2].astype(np.int32) << 16)
+        return (np.where(samples >= 1 << 23, samples - (1 << 24), samples) / float(1 << 23)).astype(np.float32)
+    dtype = {2: "<i2", 4: "<i4"}[info.sample_bytes]
+    return (np.frombuffer(raw, dtype=dtype) / float(1 << (8 * info.sample_bytes - 1))).astype(np.float32)
+
+
+def _resample(blocks, rate):
+    # Streaming linear interpolation, used only when ffmpeg is not around to do it properly
+    if rate == SAMPLE_RATE:
+        yield from blocks
+        return
+    step = rate / SAMPLE_RATE
+    carry = np.zeros(0, dtype=np.float32)
+    base = 0
+    produced = 0
+    for block in blocks:
+        buffer = np.concatenate((carry, block))
+        last = base + len(buffer) - 1
+        stop = int(np.ceil(last / step))
+        if stop > produced:
+            positions = np.arange(produced, stop) * step - base
+            yield np.interp(positions, np.arange(len(buffer)), buffer).astype(np.float32)
+            produced = stop
+        keep_from = min(int(produced * step) - base, len(buffer))
+        carry = buffer[keep_from:]
+        base += keep_from
+    total = int(round((base + len(carry)) / step))
+    if total > produced and len(carry):
+        positions = np.arange(produced, total) * step - base
+        yield np.interp(positions, np.arange(len(carry)), carry).astype(np.float32)
+
+
+def _ffmpeg_blocks(audio_path):
+    if shutil.which("ffmpeg") is None:
+        raise ValueError(f"ffmpeg is needed to decode {os.path.basename(audio_path)}")
+    process = subprocess.Popen(
+        ["ffmpeg", "-nostdin", "-v", "error", "-i", audio_path, "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        tail = b""
+        while True:
+            raw = process.stdout.read(BLOCK_FRAMES * 4)
+            if not raw:
+                break
+            raw = tail + raw
+            cut = len(raw) - len(raw) % 4
+            tail = raw[cut:]
+            yield np.frombuffer(raw[:cut], dtype="<f4")
+        error = process.stderr.read().decode("utf-8", "replace").strip()
+        if process.wait() != 0:
+            raise ValueError(f"Could not decode {audio_path}: {error}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def write_ingested(blocks, f):
+    # The sample count is only known at the end, so the header is written twice
+    f.write(wav_header(0))
+    frames = 0
+    for block in blocks:
+        f.write(np.asarray(block, dtype="<f4").tobytes())
+        frames += len(block)
+    f.seek(0)
+    f.write(wav_header(frames))
+    return frames
+
+
+class AudioCache(EmissionCache):
+    # Decoded audio as 16 kHz mono float32 WAVs, keyed by the source file's content hash.
+    # The entries are ordinary WAVs, so NeMo, ffmpeg and the slicers read them directly,
+    # and load_samples memory-maps them. Eviction works as for the emission cache.
+    suffix = ".wav"
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        super().__init__(cache_dir, max_bytes)
+
+    def ingest(self, audio_path):
+        if os.path.dirname(os.path.abspath(audio_path)) == os.path.abspath(self.cache_dir):
+            return audio_path
+        if not os.path.exists(audio_path):
+            raise FileNotFoundError(f"Audio file not found: {audio_path}")
+        key = self.key(audio_path, f"pcm{SAMPLE_RATE}")
+        path = self.path(key)
+        try:
+            os.utime(path)
+            self.hits += 1
+            return path
+        except FileNotFoundError:
+            self.misses += 1
+        with atomic_write(path, "wb") as f:
+            write_ingested(decode(audio_path), f)
+        self.evict(keep=key)
+        return path
+
+    def samples(self, audio_path):
+        return load_samples(self.ingest(audio_path))
+
+    def duration(self, audio_path):
+        return read_wav_header(self.ingest(audio_path)).duration
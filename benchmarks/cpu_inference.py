@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+
+from aligner import Aligner, NemoBackend, StubBackend, audio_duration
+from audio_ingest import SAMPLE_RATE, wav_header
+from cpu_inference import CPUProfile, CharTokenizer, ModuleBackend, ExportedBackend, export_backend, \
+    boundary_deviation, random_encoder
+
+# Full precision against the CPU profile (int8, inference_mode, threads) and its exported
+# graph: model load time, real-time factor and how far the word boundaries move. By default
+# the model is a small randomly initialized encoder over the stub's character vocabulary, so
+# this runs without the pretrained download; --model checks a real NeMo model instead.
+
+
+def write_noise(path, seconds, seed=0):
+    samples = np.random.default_rng(seed).normal(0.0, 0.1, int(seconds * SAMPLE_RATE)).astype("<f4")
+    with open(path, "wb") as f:
+        f.write(wav_header(len(samples)))
+        f.write(samples.tobytes())
+
+
+def transcript(seconds, seed=0):
+    rng = random.Random(seed)
+    return " ".join("".join(rng.choice(StubBackend.vocabulary[:-1]) for _ in range(rng.randint(2, 7)))
+                    for _ in range(max(int(seconds * 2), 1)))
+
+
+def random_backend(profile):
+    vocabulary = StubBackend.vocabulary
+    return ModuleBackend(random_encoder(len(vocabulary) + 1), CharTokenizer(vocabulary), len(vocabulary),
+                         StubBackend.frame_duration, "random_encoder", profile=profile)
+
+
+def measure(backend, text, audio_path, repeats):
+    load_start = time.perf_counter()
+    aligner = Aligner(backend, "numpy").load()
+    load_seconds = time.perf_counter() - load_start
+    marks = aligner.align(text, audio_path)  # warm-up
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        marks = aligner.align(text, audio_path)
+    return marks, load_seconds, (time.perf_counter() - start_time) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare full-precision and CPU-profile inference')
+    parser.add_argument('--model', help='pretrained NeMo model (default: a random encoder)')
+    parser.add_argument('--audio', help='audio to align (default: synthetic noise)')
+    parser.add_argument('--text', help='transcript of --audio')
+    parser.add_argument('--seconds', type=float, default=60.0, help='length of the synthetic audio')
+    parser.add_argument('--threads', type=int, default=4, help='intra-op threads for the CPU profile')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs per variant')
+    args = parser.parse_args()
+
+    if (args.audio is None) != (args.text is None):
+        parser.error('--audio and --text go together')
+
+    def make_backend(profile):
+        return NemoBackend(args.model, profile=profile) if args.model else random_backend(profile)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        audio_path, text = args.audio, args.text
+        if audio_path is None:
+            audio_path = os.path.join(work_dir, "noise.wav")
+            write_noise(audio_path, args.seconds)
+            text = transcript(args.seconds)
+        seconds = audio_duration(audio_path)
+
+        graph_path = os.path.join(work_dir, "model.ts")
+        export_backend(make_backend(CPUProfile(quantize=True)), graph_path)
+        variants = [
+            ("fp32", make_backend(CPUProfile(inference_mode=False))),
+            ("fp32+threads", make_backend(CPUProfile(intra_op_threads=args.threads))),
+            ("int8", make_backend(CPUProfile(True, args.threads))),
+            ("int8 exported", ExportedBackend(graph_path, profile=CPUProfile(intra_op_threads=args.threads))),
+        ]
+
+        reference = None
+        print(f"{'variant':<16}{'load s':>9}{'RTF':>10}{'mean ms':>10}{'p95 ms':>10}{'max ms':>10}")
+        for name, backend in variants:
+            marks, load_seconds, align_seconds = measure(backend, text, audio_path, args.repeats)
+            if reference is None:
+                reference = marks
+            deviation = boundary_deviation(reference, marks)
+            print(f"{name:<16}{load_seconds:>9.2f}{align_seconds / seconds:>10.4f}{deviation['mean_ms']:>10.1f}"
+                  f"{deviation['p95_ms']:>10.1f}{deviation['max_ms']:>10.1f}")
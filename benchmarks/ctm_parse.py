@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ctm import read_ctm_columns, read_ctm_marks, iter_marks
+
+
+def legacy_parse(ctm_dir):
+    # The readlines/dict-per-word loop processMarks used before ctm.py
+    def process_ctm_file(ctm_file):
+        ctm_file_path = os.path.join(ctm_dir, ctm_file)
+        marks = []
+        if os.path.isfile(ctm_file_path):
+            with open(ctm_file_path, "r") as ctm:
+                for line in ctm.readlines():
+                    parts = line.strip().split()
+                    if len(parts) >= 4:
+                        word = parts[4]
+                        start_time = float(parts[2])
+                        duration = float(parts[3])
+                        if word != "<b>":
+                            word_cleaned = word.replace("▁", "")
+                            marks.append({
+                                's': start_time,
+                                'e': start_time + duration,
+                                'w': word_cleaned
+                            })
+        return marks
+
+    marks = []
+    with ThreadPoolExecutor() as executor:
+        for result in executor.map(process_ctm_file, os.listdir(ctm_dir)):
+            marks.extend(result)
+    return marks
+
+
+def write_ctm(ctm_dir, words, files, seed=0):
+    rng = random.Random(seed)
+    per_file = words // files
+    for index in range(files):
+        utt_id = f"utt{index:04d}"
+        start_time = 0.0
+        with open(os.path.join(ctm_dir, f"{utt_id}.ctm"), "w") as ctm:
+            for _ in range(per_file):
+                duration = rng.choice((0.16, 0.24, 0.32, 0.48))
+                word = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(1, 9)))
+                ctm.write(f"{utt_id} 1 {start_time:.2f} {duration:.2f} ▁{word} NA lex NA\n")
+                start_time += duration + rng.choice((0.0, 0.08))
+
+
+def best_of(repeat, fn):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark CTM parsing')
+    parser.add_argument('--words', type=int, default=300000)
+    parser.add_argument('--files', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as ctm_dir:
+        write_ctm(ctm_dir, args.words, args.files)
+        paths = [os.path.join(ctm_dir, name) for name in sorted(os.listdir(ctm_dir))]
+        cases = [
+            ("legacy readlines + threads", lambda: legacy_parse(ctm_dir)),
+            ("legacy + json.dumps", lambda: json.dumps(legacy_parse(ctm_dir))),
+            ("streaming marks", lambda: read_ctm_marks(paths)),
+            ("streaming generator", lambda: sum(1 for _ in iter_marks(paths))),
+            ("columnar", lambda: read_ctm_columns(paths)),
+            ("columnar + json.dumps", lambda: json.dumps({k: v if isinstance(v, list) else v.tolist()
+                                                          for k, v in read_ctm_columns(paths).items() if k != 'utt'})),
+        ]
+        print(f"{args.words} words in {args.files} file(s), best of {args.repeat}")
+        for name, fn in cases:
+            seconds, _ = best_of(args.repeat, fn)
+            print(f"{name:<28}{seconds * 1000:>10.1f} ms")
@@ -0,0 +1,59 @@
+import os
+import re
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ctm_parse import best_of
+from normalize import normalize
+
+
+def legacy_preprocess(text):
+    # The regex chain processMarks used before normalize.py
+    text = re.sub(r'\n{3,}', '/nn/nn/nn', text)
+    text = re.sub(r'\n{2}', '/nn/nn', text)
+    text = re.sub(r'\n', '/nn', text)
+    text = re.sub(r'\s+', ' ', text)
+    return text.replace('<p>', '\n\n')
+
+
+def book(words, seed=0):
+    # Prose-like text: short words, punctuation, line breaks, blank lines and <p> markers
+    rng = random.Random(seed)
+    parts = []
+    for index in range(words):
+        parts.append("".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(1, 9))))
+        roll = rng.random()
+        if roll < 0.01:
+            parts.append(".<p>")
+        elif roll < 0.03:
+            parts.append(".\n\n")
+        elif roll < 0.06:
+            parts.append("\n")
+        elif roll < 0.10:
+            parts.append(",  ")
+        else:
+            parts.append(" ")
+    return "".join(parts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark transcript normalization')
+    parser.add_argument('--words', type=int, default=500000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    text = book(args.words)
+    if normalize(text).text != legacy_preprocess(text):
+        raise SystemExit("normalize and the regex chain disagree")
+    cases = [
+        ("regex chain", lambda: legacy_preprocess(text)),
+        ("normalize", lambda: normalize(text)),
+        ("normalize + word offsets", lambda: normalize(text).word_spans("|")),
+    ]
+    print(f"{args.words} words, {len(text)} characters, best of {args.repeat}")
+    for name, fn in cases:
+        seconds, _ = best_of(args.repeat, fn)
+        print(f"{name:<28}{seconds * 1000:>10.1f} ms")
@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import time
+import wave
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+
+from aligner import Aligner, StubBackend
+from nemo_main_opt import TextReader
+
+# End-to-end processMarks/processBatch timings on synthetic audio. The stub backend stands in
+# for the acoustic model (seeded noise emissions), so everything after inference runs for real:
+# normalization, Viterbi, offsets, marks formatting and JSON. Each (workload, config) runs in a
+# fresh process so its peak RSS is its own.
+
+SAMPLE_RATE = 16000
+WORDS_PER_SECOND = 1.5
+CONFIGS = {
+    "numpy": {"engine": "numpy", "band": None},
+    "numpy_band": {"engine": "numpy", "band": 64},
+    "even": {"engine": "nemo", "band": None},
+}
+
+
+def workloads(quick):
+    # name -> (kind, clip durations of each request)
+    rng = random.Random(0)
+    mixed = [[rng.choice((5, 10, 30, 60, 120)) for _ in range(8)] for _ in range(5 if quick else 20)]
+    return {
+        "clips": ("marks", [[10]] * (40 if quick else 200)),
+        "chapters": ("long", [[300 if quick else 600]] * (1 if quick else 3)),
+        "mixed_batches": ("batch", mixed),
+    }
+
+
+def write_wav(path, seconds):
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(b"\0\0" * int(seconds * SAMPLE_RATE))
+
+
+def transcript(seconds, rng):
+    words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 5)))
+             for _ in range(max(int(seconds * WORDS_PER_SECOND), 1))]
+    for index in range(12, len(words), 40):
+        words[index] += "\n"
+    return " ".join(words)
+
+
+def percentile(latencies, q):
+    return round(float(np.percentile(latencies, q)) * 1000, 2) if latencies else None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_case(kind, config, requests, window, work_dir):
+    rng = random.Random(1)
+    audio = {}
+    for seconds in sorted({seconds for request in requests for seconds in request}):
+        audio[seconds] = os.path.join(work_dir, f"{seconds}s.wav")
+        if not os.path.exists(audio[seconds]):
+            write_wav(audio[seconds], seconds)
+    texts = [[transcript(seconds, rng) for seconds in request] for request in requests]
+
+    reader = TextReader(Aligner(StubBackend(), config["engine"], config["band"]).load(), scratch="memory")
+
+    def run(index):
+        request, request_texts = requests[index], texts[index]
+        if kind == "batch":
+            items = [(str(i), text, audio[seconds]) for i, (seconds, text) in enumerate(zip(request, request_texts))]
+            return reader.processBatch(items, f"batch{index}")
+        return reader.processMarks(request_texts[0], f"request{index}", audio[request[0]],
+                                   window if kind == "long" else None)
+
+    json.loads(run(0))  # warm-up, not counted
+    latencies = []
+    start_time = time.perf_counter()
+    for index in range(len(requests)):
+        request_start = time.perf_counter()
+        response = json.loads(run(index))
+        latencies.append(time.perf_counter() - request_start)
+        if not response['status']:
+            raise RuntimeError(response['message'])
+    wall = time.perf_counter() - start_time
+    audio_seconds = float(sum(sum(request) for request in requests))
+    return {
+        'requests': len(requests),
+        'audio_seconds': audio_seconds,
+        'wall_seconds': round(wall, 3),
+        'requests_per_second': round(len(requests) / wall, 2),
+        'audio_seconds_per_second': round(audio_seconds / wall, 1),
+        'rtf': round(wall / audio_seconds, 5),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, tolerance):
+    # Regressions: throughput down or p95 latency up by more than tolerance
+    with open(baseline_path, "r") as f:
+        report = json.load(f)
+    baseline = {(result['workload'], result['config']): result for result in report['results']}
+    regressions = 0
+    print(f"\nAgainst {baseline_path} (commit {report['commit']}):")
+    for result in results:
+        before = baseline.get((result['workload'], result['config']))
+        if before is None:
+            continue
+        throughput = result['audio_seconds_per_second'] / before['audio_seconds_per_second'] - 1
+        p95 = result['p95_ms'] / before['p95_ms'] - 1
+        flag = throughput < -tolerance or p95 > tolerance
+        regressions += flag
+        print(f"{result['workload']:<16}{result['config']:<12}throughput {throughput:+7.1%}   p95 {p95:+7.1%}"
+              f"{'   REGRESSION' if flag else ''}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the alignment pipeline on synthetic workloads')
+    parser.add_argument('--quick', action='store_true', help='smaller workloads')
+    parser.add_argument('--workloads', default=None, help='comma-separated subset of workloads')
+    parser.add_argument('--configs', default=",".join(CONFIGS), help='comma-separated subset of configs')
+    parser.add_argument('--window', type=float, default=120.0, help='long-form window for the chapters workload')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write the JSON results')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown before --compare fails')
+    args = parser.parse_args()
+
+    selected = workloads(args.quick)
+    if args.workloads:
+        selected = {name: selected[name] for name in args.workloads.split(',')}
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        print(f"{'workload':<16}{'config':<12}{'req/s':>9}{'RTF':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+              f"{'RSS MB':>9}")
+        for workload_name, workload in selected.items():
+            for config_name in args.configs.split(','):
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                    result = executor.submit(run_case, workload[0], CONFIGS[config_name], workload[1], args.window,
+                                             work_dir).result()
+                result = dict(workload=workload_name, config=config_name, **result)
+                results.append(result)
+                print(f"{workload_name:<16}{config_name:<12}{result['requests_per_second']:>9.2f}{result['rtf']:>10.5f}"
+                      f"{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}{result['p99_ms']:>10.1f}"
+                      f"{result['peak_rss_mb']:>9.1f}")
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'quick': args.quick,
+        'results': results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,273 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+from aligner import SEGMENT_SEPARATOR, NemoBackend, DEFAULT_MODEL, padded_emissions
+from audio_ingest import SAMPLE_RATE, decode, is_ingested, load_samples
+from timings import span
+
+META_FILE = "meta.json"
+TOKENIZER_FILE = "tokenizer.model"
+
+
+class CPUProfile:
+    # How the acoustic model runs on CPU: dynamic int8 quantization of its Linear layers,
+    # inference_mode instead of no_grad, and the intra-/inter-op thread pool sizes (None
+    # leaves torch's default). Quantized models get their own name, so cached emissions and
+    # stored results of the full-precision model are not reused for them.
+
+    def __init__(self, quantize=False, intra_op_threads=None, inter_op_threads=None, inference_mode=True):
+        self.quantize = quantize
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.inference_mode = inference_mode
+
+    def model_name(self, name):
+        return f"{name}+int8" if self.quantize else name
+
+    def configure_threads(self):
+        import torch
+
+        if self.intra_op_threads is not None:
+            torch.set_num_threads(self.intra_op_threads)
+        if self.inter_op_threads is not None:
+            try:
+                torch.set_num_interop_threads(self.inter_op_threads)
+            except RuntimeError:
+                # Only allowed once per process, before any inter-op work has started
+                pass
+
+    def prepare(self, model):
+        import torch
+
+        model.eval()
+        if self.quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        return model
+
+    def no_grad(self):
+        import torch
+
+        return torch.inference_mode() if self.inference_mode else torch.no_grad()
+
+
+def no_grad(profile):
+    import torch
+
+    return profile.no_grad() if profile is not None else torch.no_grad()
+
+
+class CharTokenizer:
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.ids = {c: i for i, c in enumerate(vocabulary)}
+
+    def __call__(self, word):
+        return [self.ids[c] for c in word.lower() if c in self.ids]
+
+    def spec(self):
+        return {'type': "chars", 'vocabulary': self.vocabulary}, None
+
+
+class SentencePieceTokenizer:
+    # What NeMo's SentencePieceTokenizer.text_to_ids does for non-legacy models, without NeMo
+    def __init__(self, model_proto):
+        import sentencepiece
+
+        self.model_proto = model_proto
+        self.processor = sentencepiece.SentencePieceProcessor(model_proto=model_proto)
+
+    def __call__(self, word):
+        return self.processor.encode_as_ids(word)
+
+    def spec(self):
+        return {'type': "sentencepiece"}, self.model_proto
+
+
+def samples_of(audio_path):
+    if is_ingested(audio_path):
+        return np.asarray(load_samples(audio_path))
+    return np.concatenate(list(decode(audio_path)) or [np.zeros(0, dtype=np.float32)])
+
+
+def emission_module(model, forward):
+    # forward(signal [1, samples], lengths [1]) -> (log_probs [1, T, V], lengths [1]) as an
+    # nn.Module that owns model's weights, which is what torch.jit.trace and save need
+    import torch
+
+    class Emissions(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, signal, length):
+            return forward(signal, length)
+
+    return Emissions()
+
+
+class ModuleBackend:
+    # Emissions from any torch module taking (signal [1, samples], lengths [1]) and returning
+    # (log_probs [1, T, V], lengths [1]). Word-level only: pair it with the numpy engine.
+
+    def __init__(self, module, tokenizer, blank_id, frame_duration, name="module", separator=SEGMENT_SEPARATOR,
+                 profile=None):
+        self.module = module
+        self.tokenizer = tokenizer
+        self.blank_id = blank_id
+        self.frame_duration = frame_duration
+        self.name = profile.model_name(name) if profile is not None else name
+        self.separator = separator
+        self.profile = profile
+        self.loaded = False
+
+    def load(self):
+        if self.loaded:
+            return
+        with span("model_load"):
+            if self.profile is not None:
+                self.profile.configure_threads()
+                self.module = self.profile.prepare(self.module)
+            else:
+                self.module.eval()
+        self.loaded = True
+
+    def tokenize(self, word):
+        return self.tokenizer(word)
+
+    def forward(self, signal, length):
+        return self.module(signal, length)
+
+    def emissions(self, audio_path):
+        return self.batch_emissions([audio_path])[0]
+
+    def batch_emissions(self, audio_paths):
+        self.load()
+        return padded_emissions([samples_of(audio_path) for audio_path in audio_paths], self.forward,
+                                no_grad(self.profile))
+
+    def emission_module(self):
+        return emission_module(self.module, self.forward)
+
+    def tokenizer_spec(self):
+        return self.tokenizer.spec()
+
+    def align_batch(self, utterances, output_dir=None, batch_size=None, outputs=("words",)):
+        raise ValueError(f"{type(self).__name__} only provides emissions; use the numpy engine")
+
+
+class ExportedBackend(ModuleBackend):
+    # A graph written by export_backend: TorchScript plus the tokenizer and frame timing, so
+    # loading it skips restoring the .nemo checkpoint. Quantization, if any, happened before
+    # the export; the profile's threads and inference_mode still apply.
+
+    def __init__(self, path, separator=SEGMENT_SEPARATOR, profile=None):
+        super().__init__(None, None, None, None, os.path.basename(path), separator, profile)
+        self.path = path
+
+    def load(self):
+        if self.loaded:
+            return
+        import torch
+
+        with span("model_load"):
+            if self.profile is not None:
+                self.profile.configure_threads()
+            extra_files = {META_FILE: "", TOKENIZER_FILE: ""}
+            self.module = torch.jit.load(self.path, map_location="cpu", _extra_files=extra_files)
+            self.module.eval()
+            # torch hands the extra files back as bytes; versions that give str only do so
+            # for UTF-8 contents, which encode back to the same bytes
+            extra_files = {name: content.encode("utf-8") if isinstance(content, str) else content
+                           for name, content in extra_files.items()}
+            meta = json.loads(extra_files[META_FILE].decode("utf-8"))
+            if meta['tokenizer']['type'] == "sentencepiece":
+                self.tokenizer = SentencePieceTokenizer(extra_files[TOKENIZER_FILE])
+            else:
+                self.tokenizer = CharTokenizer(meta['tokenizer']['vocabulary'])
+            self.blank_id = meta['blank_id']
+            self.frame_duration = meta['frame_duration']
+            self.name = meta['name']
+        self.loaded = True
+
+    def batch_emissions(self, audio_paths):
+        # The graph was traced on a single clip, so clips go through it one at a time
+        results = []
+        for audio_path in audio_paths:
+            results.extend(super().batch_emissions([audio_path]))
+        return results
+
+
+def export_backend(backend, path, example_seconds=10.0):
+    # Traces the backend's forward pass (quantized, if its profile says so) with a noise
+    # example and saves it with what ExportedBackend needs. Check the result with
+    # boundary_deviation against the original before deploying it.
+    import torch
+
+    backend.load()
+    rng = np.random.default_rng(0)
+    signal = torch.from_numpy(rng.normal(0.0, 0.1, (1, int(example_seconds * SAMPLE_RATE))).astype(np.float32))
+    length = torch.tensor([signal.shape[1]])
+    with torch.no_grad():
+        traced = torch.jit.trace(backend.emission_module(), (signal, length), check_trace=False)
+    tokenizer, tokenizer_model = backend.tokenizer_spec()
+    meta = {'name': backend.name, 'blank_id': backend.blank_id, 'frame_duration': backend.frame_duration,
+            'sample_rate': SAMPLE_RATE, 'tokenizer': tokenizer}
+    extra_files = {META_FILE: json.dumps(meta)}
+    if tokenizer_model is not None:
+        extra_files[TOKENIZER_FILE] = tokenizer_model
+    torch.jit.save(traced, path, _extra_files=extra_files)
+    return path
+
+
+def boundary_deviation(reference, marks):
+    # Word boundary differences in ms between two alignments of the same text; marks must be
+    # one per word in the same order (both from the numpy engine on one transcript)
+    if len(reference) != len(marks):
+        raise ValueError(f"Expected {len(reference)} marks, got {len(marks)}")
+    if not reference:
+        return {'words': 0, 'mean_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+    deviation = 1000 * np.abs(np.array([[m['s'], m['e']] for m in marks], dtype=np.float64)
+                              - np.array([[m['s'], m['e']] for m in reference], dtype=np.float64)).ravel()
+    return {'words': len(reference), 'mean_ms': round(float(deviation.mean()), 2),
+            'p95_ms': round(float(np.percentile(deviation, 95)), 2), 'max_ms': round(float(deviation.max()), 2)}
+
+
+def random_encoder(vocabulary_size, hidden=256, layers=4, frame_samples=1280, seed=0):
+    # Small randomly initialized stand-in for the acoustic encoder: 80 ms frames through a
+    # stack of Linear layers, so quantization, threading and export can be checked without
+    # the pretrained download
+    import torch
+
+    class RandomEncoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.frame_samples = frame_samples
+            self.input = torch.nn.Linear(frame_samples, hidden)
+            self.layers = torch.nn.ModuleList([torch.nn.Linear(hidden, hidden) for _ in range(layers)])
+            self.output = torch.nn.Linear(hidden, vocabulary_size)
+
+        def forward(self, signal, length):
+            frames = signal.shape[1] // self.frame_samples
+            x = signal[:, :frames * self.frame_samples].reshape(signal.shape[0], -1, self.frame_samples)
+            h = torch.relu(self.input(x * 10.0))
+            for layer in self.layers:
+                h = h + torch.relu(layer(h))
+            return torch.log_softmax(self.output(h), dim=-1), torch.div(length, self.frame_samples, rounding_mode="floor")
+
+    torch.manual_seed(seed)
+    return RandomEncoder()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the acoustic model as a TorchScript graph for CPU inference')
+    parser.add_argument('--output', help='where to write the graph', required=True)
+    parser.add_argument('--model', help='pretrained NeMo model', default=DEFAULT_MODEL)
+    parser.add_argument('--quantize', help='quantize Linear layers to int8 before exporting', action='store_true')
+    parser.add_argument('--example_seconds', help='length of the tracing example', type=float, default=10.0)
+    args = parser.parse_args()
+
+    export_backend(NemoBackend(args.model, profile=CPUProfile(args.quantize)), args.output, args.example_seconds)
+    print(f"Exported {args.model}{' (int8)' if args.quantize else ''} to {args.output}")
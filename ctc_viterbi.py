@@ -0,0 +1,111 @@
+import numpy as np
+
+NEG_INF = -np.inf
+
+
+def _band_limits(T, S, band):
+    # State window [lo, hi) for every frame, centred on the straight line from (0, 0) to (T-1, S-1)
+    if band is None:
+        return np.zeros(T, dtype=np.int64), np.full(T, S, dtype=np.int64)
+    centre = np.round(np.arange(T) * ((S - 1) / max(T - 1, 1))).astype(np.int64)
+    lo = np.clip(centre - band, 0, S)
+    hi = np.clip(centre + band + 1, 0, S)
+    return lo, hi
+
+
+def viterbi_states(log_probs, tokens, blank_id, band=None):
+    # Best CTC path through tokens interleaved with blanks; returns the state per frame,
+    # where state 2*u + 1 is token u and even states are blanks
+    log_probs = np.asarray(log_probs)
+    tokens = np.asarray(tokens, dtype=np.int64)
+    T = log_probs.shape[0]
+    S = 2 * len(tokens) + 1
+    if T == 0:
+        raise ValueError("Cannot align an empty emission matrix")
+
+    ext = np.full(S, blank_id, dtype=np.int64)
+    ext[1::2] = tokens
+    skip_ok = np.zeros(S, dtype=bool)
+    skip_ok[3::2] = tokens[1:] != tokens[:-1]
+
+    lo, hi = _band_limits(T, S, band)
+    width = int((hi - lo).max())
+    backpointers = np.zeros((T, width), dtype=np.int8)
+
+    states = np.arange(lo[0], hi[0])
+    alpha = np.where(states < 2, log_probs[0, ext[states]], NEG_INF)
+    # The previous window's scores sit at [2, 2 + len(alpha)) with -inf all around, so the
+    # scores of a state and of the one or two before it are slices, and states outside the
+    # previous window read -inf
+    previous = np.full(S + 2, NEG_INF)
+    for t in range(1, T):
+        previous[2:2 + len(alpha)] = alpha
+        first, last = lo[t] - lo[t - 1] + 2, hi[t] - lo[t - 1] + 2
+        stay = previous[first:last]
+        step = previous[first - 1:last - 1]
+        skip = np.where(skip_ok[lo[t]:hi[t]], previous[first - 2:last - 2], NEG_INF)
+        choice = (step > stay).astype(np.int8)
+        best = np.maximum(stay, step)
+        better = skip > best
+        choice[better] = 2
+        backpointers[t, :last - first] = choice
+        alpha_next = np.where(better, skip, best) + log_probs[t, ext[lo[t]:hi[t]]]
+        previous[2:2 + len(alpha)] = NEG_INF
+        alpha = alpha_next
+
+    final = [s for s in (S - 1, S - 2) if lo[-1] <= s < hi[-1]]
+    scores = [alpha[s - lo[-1]] for s in final]
+    if not final or not np.isfinite(max(scores)):
+        raise ValueError("No valid alignment: audio too short for the tokens or band too narrow")
+
+    path = np.empty(T, dtype=np.int64)
+    state = final[int(np.argmax(scores))]
+    for t in range(T - 1, -1, -1):
+        path[t] = state
+        state -= backpointers[t, state - lo[t]]
+    return path
+
+
+def token_frames(path, num_tokens):
+    # First and last frame of every token; the path is non-decreasing so searchsorted finds them
+    token_states = 2 * np.arange(num_tokens) + 1
+    first = np.searchsorted(path, token_states, side="left")
+    last = np.searchsorted(path, token_states, side="right") - 1
+    return first, last
+
+
+def align_words(log_probs, word_tokens, words, blank_id, frame_duration, band=None):
+    # word_tokens: token id list per word. Returns marks in the same shape as the CTM path.
+    lengths = np.array([len(t) for t in word_tokens], dtype=np.int64)
+    tokens = [token for word in word_tokens for token in word]
+    path = viterbi_states(log_probs, tokens, blank_id, band)
+    first, last = token_frames(path, len(tokens))
+
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    marks = []
+    previous_end = 0.0
+    for word, start, end in zip(words, starts, ends):
+        if start == end:
+            # Nothing the model can emit for this word; pin it to the previous boundary
+            marks.append({'s': previous_end, 'e': previous_end, 'w': word})
+            continue
+        start_frame = int(first[start])
+        start_time = round(start_frame * frame_duration, 2)
+        marks.append({
+            's': start_time,
+            'e': round(start_time + round((int(last[end - 1]) + 1 - start_frame) * frame_duration, 2), 2),
+            'w': word
+        })
+        previous_end = marks[-1]['e']
+    return marks
+
+
+def synthetic_emissions(path_tokens, vocab_size, blank_id, peak=0.0, floor=-8.0, noise=0.0, seed=0):
+    # Emission matrix whose best path is path_tokens (one token id or blank_id per frame)
+    rng = np.random.default_rng(seed)
+    log_probs = np.full((len(path_tokens), vocab_size), floor, dtype=np.float32)
+    if noise:
+        log_probs += rng.normal(0.0, noise, log_probs.shape).astype(np.float32)
+    log_probs[np.arange(len(path_tokens)), np.asarray(path_tokens)] = peak
+    return log_probs
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+
+BLANK = "<b>"
+
+
+def iter_ctm(ctm_file_path):
+    # Yields (utt_id, start, end, word) line by line, without reading the whole file
+    with open(ctm_file_path, "r") as ctm:
+        for line in ctm:
+            parts = line.split()
+            if len(parts) < 5 or parts[4] == BLANK:
+                continue
+            start_time = float(parts[2])
+            yield parts[0], start_time, round(start_time + float(parts[3]), 2), parts[4].replace("▁", "")
+
+
+def ctm_files(ctm_dir):
+    return [os.path.join(ctm_dir, name) for name in sorted(os.listdir(ctm_dir))
+            if os.path.isfile(os.path.join(ctm_dir, name))]
+
+
+def iter_marks(ctm_paths):
+    for ctm_file_path in ctm_paths:
+        for _, start_time, end_time, word in iter_ctm(ctm_file_path):
+            yield {'s': start_time, 'e': end_time, 'w': word}
+
+
+def read_ctm_columns(ctm_paths):
+    # Columnar result: 's'/'e' float64 arrays, 'w' word list and 'utt' ids, ordered by
+    # utterance then start time. The numbers are converted and rounded as whole columns.
+    utts, starts, durations, words = [], [], [], []
+    for ctm_file_path in ctm_paths:
+        with open(ctm_file_path, "r") as ctm:
+            for line in ctm:
+                parts = line.split()
+                if len(parts) < 5 or parts[4] == BLANK:
+                    continue
+                utts.append(parts[0])
+                starts.append(parts[2])
+                durations.append(parts[3])
+                words.append(parts[4])
+    starts = np.array(starts, dtype=np.float64)
+    columns = {
+        'utt': utts,
+        's': starts,
+        'e': np.round(starts + np.array(durations, dtype=np.float64), 2),
+        'w': [word.replace("▁", "") for word in words],
+    }
+    if not _is_ordered(utts, starts):
+        order = np.lexsort((starts, np.unique(np.array(utts), return_inverse=True)[1]))
+        columns = {key: value[order] if isinstance(value, np.ndarray) else [value[i] for i in order]
+                   for key, value in columns.items()}
+    return columns
+
+
+def _is_ordered(utts, starts):
+    # align.py writes each utterance's words in time order, one utterance per file
+    if any(utts[i] < utts[i - 1] for i in range(1, len(utts))):
+        return False
+    changes = {i for i in range(1, len(utts)) if utts[i] != utts[i - 1]}
+    return set((np.flatnonzero(np.diff(starts) < 0) + 1).tolist()) <= changes
+
+
+def columns_to_marks(columns):
+    return [{'s': s, 'e': e, 'w': w} for s, e, w in zip(columns['s'].tolist(), columns['e'].tolist(), columns['w'])]
+
+
+def read_ctm_marks(ctm_paths):
+    return columns_to_marks(read_ctm_columns(ctm_paths))
+
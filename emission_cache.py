@@ -0,0 +1,114 @@
+import os
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextmanager
+def atomic_write(path, mode="w", **kwargs):
+    # Writes to a temporary file next to path and moves it into place once the block exits
+    # cleanly, so readers never see half a file; on failure the temporary file is removed
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class EmissionCache:
+    # Per-frame log-probs on disk as .npy, keyed by audio content hash and model name.
+    # Hits are memory-mapped; file mtimes double as the LRU order for eviction.
+    suffix = ".npy"
+    max_entries = None
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._digests = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, audio_path, model_name):
+        model = hashlib.sha256(model_name.encode("utf-8")).hexdigest()[:16]
+        return f"{self.digest(audio_path)}_{model}"
+
+    def digest(self, audio_path):
+        # Rehash only when the file changed since we last saw it
+        stat = os.stat(audio_path)
+        signature = (os.path.abspath(audio_path), stat.st_size, stat.st_mtime_ns)
+        if signature not in self._digests:
+            self._digests[signature] = file_digest(audio_path)
+        return self._digests[signature]
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            log_probs = np.load(path, mmap_mode="r")
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return log_probs
+
+    def put(self, key, log_probs):
+        with atomic_write(self.path(key), "wb") as f:
+            np.save(f, np.ascontiguousarray(log_probs, dtype=np.float32))
+        self.evict(keep=key)
+
+    def get_or_compute(self, audio_path, model_name, compute):
+        key = self.key(audio_path, model_name)
+        log_probs = self.get(key)
+        if log_probs is None:
+            log_probs = compute(audio_path)
+            self.put(key, log_probs)
+        return log_probs
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(self.suffix):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((self.last_used(stat), stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes and (self.max_entries is None or count <= self.max_entries):
+                break
+            if name == f"{keep}{self.suffix}":
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            count -= 1
+
+    def last_used(self, stat):
+        return stat.st_mtime
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+from difflib import SequenceMatcher
+
+from aligner import audio_duration
+from long_align import write_wav_slice
+
+DEFAULT_CONTEXT = 2
+
+
+def split_words(text, separator):
+    return text.replace(separator, " ").split()
+
+
+def realign_edit(aligner, prev_marks, old_text, new_text, audio_path, context=DEFAULT_CONTEXT):
+    # Words that survive the edit keep their previous marks and act as time anchors;
+    # each run of changed words (plus `context` neighbours) is re-aligned only within
+    # the audio between the anchors either side of it.
+    separator = aligner.backend.separator
+    old_words = split_words(old_text, separator)
+    new_words = split_words(new_text, separator)
+    if len(prev_marks) != len(old_words):
+        raise ValueError(f"Expected {len(old_words)} previous marks for the old text, got {len(prev_marks)}")
+
+    old_index = [None] * len(new_words)
+    anchored = [False] * len(new_words)
+    changes = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_words, new_words, autojunk=False).get_opcodes():
+        if tag == "equal":
+            for offset in range(j2 - j1):
+                old_index[j1 + offset] = i1 + offset
+                anchored[j1 + offset] = True
+        else:
+            changes.append((j1, j2))
+    for j1, j2 in changes:
+        if j1 == j2 and context == 0:
+            continue
+        for j in range(max(j1 - context, 0), min(j2 + context, len(new_words))):
+            anchored[j] = False
+
+    if aligner.uses_emissions():
+        log_probs = aligner.emissions(audio_path)
+        duration = log_probs.shape[0] * aligner.backend.frame_duration
+    else:
+        log_probs = None
+        duration = audio_duration(audio_path)
+
+    marks = [None] * len(new_words)
+    for j, is_anchor in enumerate(anchored):
+        if is_anchor:
+            marks[j] = dict(prev_marks[old_index[j]], w=new_words[j])
+
+    work_dir = None
+    try:
+        j = 0
+        while j < len(new_words):
+            if anchored[j]:
+                j += 1
+                continue
+            start = j
+            while j < len(new_words) and not anchored[j]:
+                j += 1
+            end = j
+            grow = 1
+            while True:
+                window_start = marks[start - 1]['e'] if start > 0 else 0.0
+                window_end = marks[end]['s'] if end < len(new_words) else duration
+                try:
+                    if log_probs is not None:
+                        run_marks = _align_frames(aligner, new_words[start:end], log_probs, window_start, window_end)
+                    else:
+                        if work_dir is None:
+                            work_dir = tempfile.mkdtemp(prefix="realign_")
+                        run_marks = _align_slice(aligner, new_words[start:end], audio_path, window_start,
+                                                 window_end, work_dir)
+                    break
+                except ValueError:
+                    # Not enough audio between the anchors; give up more of them on each side. A
+                    # changed run reached on the right has no marks yet, so it joins this one.
+                    if start == 0 and end == len(new_words):
+                        raise
+                    start = max(start - grow, 0)
+                    end = min(end + grow, len(new_words))
+                    while end < len(new_words) and marks[end] is None:
+                        end += 1
+                    grow *= 2
+            for k, mark in enumerate(run_marks):
+                marks[start + k] = dict(mark, w=new_words[start + k])
+            j = end
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return marks
+
+
+def _align_frames(aligner, words, log_probs, window_start, window_end):
+    frame_duration = aligner.backend.frame_duration
+    first = int(round(window_start / frame_duration))
+    last = int(round(window_end / frame_duration))
+    if last <= first:
+        raise ValueError("Empty audio window")
+    return _shift(aligner.align_emissions(" ".join(words), log_probs[first:last]), first * frame_duration)
+
+
+def _align_slice(aligner, words, audio_path, window_start, window_end, work_dir):
+    if window_end <= window_start:
+        raise ValueError("Empty audio window")
+    slice_path = os.path.join(work_dir, "window.wav")
+    write_wav_slice(audio_path, window_start, window_end, slice_path)
+    try:
+        return _shift(aligner.align(" ".join(words), slice_path, utt_id="window"), window_start)
+    finally:
+        os.remove(slice_path)
+
+
+def _shift(marks, offset):
+    return [{'s': round(mark['s'] + offset, 2), 'e': round(mark['e'] + offset, 2), 'w': mark['w']} for mark in marks]
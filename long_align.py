@@ -0,0 +1,151 @@
+import os
+import math
+import shutil
+import tempfile
+
+from aligner import SEGMENT_SEPARATOR, audio_duration
+from audio_ingest import read_wav_header, wav_header
+
+DEFAULT_WINDOW = 120.0
+DEFAULT_OVERLAP = 15.0
+WORD_SHARE = 0.6
+WORD_SLACK = 1.25
+MIN_WORDS = 4
+AGREEMENT_TOLERANCE = 0.05
+MAX_HALVINGS = 2
+
+
+def write_wav_slice(audio_path, start, end, out_path):
+    # Copies [start, end) seconds of a wav file without reading the rest of it
+    info = read_wav_header(audio_path)
+    frame_bytes = info.channels * info.sample_bytes
+    first = min(int(start * info.rate), info.frames)
+    count = max(min(int(end * info.rate), info.frames) - first, 0)
+    with open(audio_path, "rb") as src, open(out_path, "wb") as dst:
+        dst.write(wav_header(count, info.rate, info.channels, info.sample_bytes, info.format_tag))
+        src.seek(info.data_offset + first * frame_bytes)
+        while count > 0:
+            frames = src.read(min(count, info.rate * 10) * frame_bytes)
+            if not frames:
+                break
+            dst.write(frames)
+            count -= len(frames) // frame_bytes
+
+
+def window_aligner(aligner, audio_path, utt_id):
+    # Aligns texts against one window's audio; with the numpy engine its emissions are
+    # computed once for every text tried on it
+    if aligner.uses_emissions():
+        log_probs = aligner.emissions(audio_path, cached=False)
+        return lambda text: aligner.align_emissions(text, log_probs)
+    return lambda text: aligner.align(text, audio_path, utt_id=utt_id, cached=False)
+
+
+def agreeing(marks, other, tolerance=AGREEMENT_TOLERANCE):
+    # How many leading words two alignments of the same words place at the same times
+    count = 0
+    for a, b in zip(marks, other):
+        if a['w'] != b['w'] or abs(a['s'] - b['s']) > tolerance or abs(a['e'] - b['e']) > tolerance:
+            break
+        count += 1
+    return count
+
+
+def align_long(aligner, text, audio_path, window=DEFAULT_WINDOW, overlap=DEFAULT_OVERLAP,
+               separator=SEGMENT_SEPARATOR, scratch_dir=None, cached=True):
+    # Aligns window by window. Forced alignment places every word it is given, so a window
+    # must never get more words than its audio holds: it gets WORD_SHARE of what the average
+    # speaking rate says. The speech after its last word is then unaccounted for, and the
+    # last words can be pulled onto it. So every window is aligned twice, the second time
+    # without its last quarter of words: a word is confirmed when it and every word before
+    # it land at the same times in both, and ends before the overlap zone. The last
+    # confirmed word is the anchor: it is not kept, the next window starts where it starts
+    # and aligns it again. When the runs agree on too few words and the shorter one reaches
+    # into the overlap zone, the window was crowded after all (slow speech, long silence)
+    # and is tried again with half the words; see confirmed_words. Window emissions never go
+    # to the emission cache: window edges move with every edit, so they would not be hit
+    # again. cached=False keeps audio_path out too when it is itself a slice.
+    if overlap * 2 >= window:
+        raise ValueError("overlap must be less than half the window")
+    if not os.path.exists(audio_path):
+        raise FileNotFoundError(f"Audio file not found: {audio_path}")
+
+    words = text.replace(separator, " ").split()
+    duration = audio_duration(audio_path)
+    if duration <= window:
+        return aligner.align(" ".join(words), audio_path, cached=cached)
+
+    words_per_second = len(words) / duration
+    work_dir = tempfile.mkdtemp(prefix="long_align_", dir=scratch_dir)
+    marks = []
+    try:
+        position = 0
+        offset = 0.0
+        index = 0
+        while position < len(words):
+            end = min(offset + window, duration)
+            chunk_audio = os.path.join(work_dir, f"window_{index}.wav")
+            write_wav_slice(audio_path, offset, end, chunk_audio)
+            try:
+                align = window_aligner(aligner, chunk_audio, f"window_{index}")
+                if end >= duration:
+                    keep = align(" ".join(words[position:]))
+                else:
+                    keep = confirmed_words(align, words[position:], end - offset - overlap,
+                                           (end - offset) * words_per_second)
+            finally:
+                os.remove(chunk_audio)
+
+            if end >= duration:
+                next_offset = end
+            else:
+                if not keep:
+                    raise RuntimeError(f"No words aligned in window starting at {offset:.2f}s")
+                if len(keep) > 1 and position + len(keep) < len(words):
+                    next_offset = round(keep.pop()['s'] + offset, 2)
+                else:
+                    next_offset = round(keep[-1]['e'] + offset, 2)
+            for mark in keep:
+                marks.append({'s': round(mark['s'] + offset, 2), 'e': round(mark['e'] + offset, 2), 'w': mark['w']})
+
+            position += len(keep)
+            offset = next_offset
+            index += 1
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return marks
+
+
+def confirmed_words(align, words, limit, expected):
+    # Marks (relative to the window) of the leading words that alignments with and without
+    # the last quarter of the words agree on; see align_long. expected: how many words the
+    # average speaking rate puts in the window.
+    count = max(math.floor(expected * WORD_SHARE), MIN_WORDS)
+    halvings = 0
+    while True:
+        chunk = words[:count]
+        try:
+            aligned = align(" ".join(chunk))
+            # With every remaining word in the chunk none can be pulled onto missing speech
+            check = aligned if len(chunk) == len(words) else align(" ".join(chunk[:-max(len(chunk) // 4, 1)]))
+        except ValueError:
+            # More tokens than the window has frames
+            if count <= MIN_WORDS:
+                raise
+            count = max(count // 2, MIN_WORDS)
+            continue
+        confirmed = [mark for mark in aligned[:agreeing(aligned, check)] if mark['e'] <= limit]
+        usable = [mark for mark in check if mark['e'] <= limit]
+        if len(confirmed) >= max(len(usable) // 2, 2):
+            return confirmed
+        if len(usable) == len(check) or halvings == MAX_HALVINGS or count <= MIN_WORDS:
+            break
+        # Crowded: the words of the shorter run reach into the overlap zone
+        count = max(count // 2, MIN_WORDS)
+        halvings += 1
+    # The runs disagree although the window is not crowded, or still disagree with a quarter
+    # of the words: the emissions are too flat to place words by. Such alignments spread the
+    # words over the whole window, so it gets more words than the rate says, to keep up with
+    # the audio, and they are kept unconfirmed.
+    aligned = align(" ".join(words[:max(math.ceil(expected * WORD_SLACK), 1)]))
+    return [mark for mark in aligned if mark['e'] <= limit] or aligned[:1]
@@ -92,7 +92,7 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     text = args.text
-    file_name = str(ulid.ulid())
+    file_name = str(ulid.new())
     audio_path = args.audiopath
     text_reader = TextReader()
     response = text_reader.processMarks(text, file_name, audio_path)
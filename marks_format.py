@@ -0,0 +1,139 @@
+import struct
+
+import numpy as np
+
+FORMATS = ("json", "columnar", "binary")
+
+# Binary layout, little-endian, every section 4-byte aligned so it can be viewed in place:
+#   magic b"FAM1" | uint32 n_marks | uint32 n_words | uint32 blob_bytes | uint32 flags
+#   int32[n_marks] start_ms | int32[n_marks] end_ms | uint32[n_marks] word_index
+#   uint32[n_words + 1] word offsets into the blob | blob (UTF-8 words, padded to 4 bytes)
+#   with HAS_OFFSETS set: int32[n_marks] char_start | int32[n_marks] char_end
+MAGIC = b"FAM1"
+HEADER = struct.Struct("<4sIIII")
+HAS_OFFSETS = 1
+
+
+# Source text offsets, present when the marks came through normalize
+OFFSET_KEYS = ('char_start', 'char_end')
+
+
+def to_columnar(marks):
+    columns = {
+        's': [mark['s'] for mark in marks],
+        'e': [mark['e'] for mark in marks],
+        'w': [mark['w'] for mark in marks],
+    }
+    if marks and all(OFFSET_KEYS[0] in mark for mark in marks):
+        for key in OFFSET_KEYS:
+            columns[key] = [mark[key] for mark in marks]
+    return columns
+
+
+def from_columnar(columns):
+    marks = [{'s': s, 'e': e, 'w': w} for s, e, w in zip(columns['s'], columns['e'], columns['w'])]
+    if OFFSET_KEYS[0] in columns:
+        for mark, char_start, char_end in zip(marks, *(columns[key] for key in OFFSET_KEYS)):
+            mark[OFFSET_KEYS[0]] = char_start
+            mark[OFFSET_KEYS[1]] = char_end
+    return marks
+
+
+def encode_binary(marks):
+    table = {}
+    word_index = np.fromiter((table.setdefault(mark['w'], len(table)) for mark in marks),
+                             dtype="<u4", count=len(marks))
+    starts = np.fromiter((round(mark['s'] * 1000) for mark in marks), dtype="<i4", count=len(marks))
+    ends = np.fromiter((round(mark['e'] * 1000) for mark in marks), dtype="<i4", count=len(marks))
+    char_offsets = None
+    if marks and all(OFFSET_KEYS[0] in mark for mark in marks):
+        char_offsets = [np.fromiter((mark[key] for mark in marks), dtype="<i4", count=len(marks))
+                        for key in OFFSET_KEYS]
+    return encode_columns(starts, ends, word_index, list(table), char_offsets)
+
+
+def encode_columns(starts_ms, ends_ms, word_index, words, char_offsets=None):
+    # char_offsets: (char_start, char_end) columns, or None
+    encoded = [word.encode("utf-8") for word in words]
+    offsets = np.zeros(len(encoded) + 1, dtype="<u4")
+    np.cumsum([len(word) for word in encoded], out=offsets[1:])
+    blob = b"".join(encoded)
+    blob += b"\0" * (-len(blob) % 4)
+    sections = [
+        HEADER.pack(MAGIC, len(starts_ms), len(encoded), len(blob), HAS_OFFSETS if char_offsets is not None else 0),
+        np.asarray(starts_ms, dtype="<i4").tobytes(), np.asarray(ends_ms, dtype="<i4").tobytes(),
+        np.asarray(word_index, dtype="<u4").tobytes(), offsets.tobytes(), blob,
+    ]
+    if char_offsets is not None:
+        sections.extend(np.asarray(column, dtype="<i4").tobytes() for column in char_offsets)
+    return b"".join(sections)
+
+
+def read_binary(buffer):
+    # Zero-copy views over bytes or a memory map: (start_ms, end_ms, word_index, words)
+    starts, ends, word_index, offsets, blob = binary_sections(buffer)
+    blob = bytes(blob)
+    words = [blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+    return starts, ends, word_index, words
+
+
+def read_header(buffer):
+    # (n_marks, n_words, blob_bytes, flags)
+    if bytes(buffer[:4]) != MAGIC:
+        raise ValueError("Not a marks file")
+    return HEADER.unpack_from(buffer, 0)[1:]
+
+
+def binary_sections(buffer):
+    # Like read_binary, but the words stay encoded: word i is blob[offsets[i]:offsets[i + 1]]
+    n_marks, n_words, blob_bytes, _ = read_header(buffer)
+    offset = HEADER.size
+    starts = np.frombuffer(buffer, dtype="<i4", count=n_marks, offset=offset)
+    offset += 4 * n_marks
+    ends = np.frombuffer(buffer, dtype="<i4", count=n_marks, offset=offset)
+    offset += 4 * n_marks
+    word_index = np.frombuffer(buffer, dtype="<u4", count=n_marks, offset=offset)
+    offset += 4 * n_marks
+    offsets = np.frombuffer(buffer, dtype="<u4", count=n_words + 1, offset=offset)
+    offset += 4 * (n_words + 1)
+    return starts, ends, word_index, offsets, buffer[offset:offset + blob_bytes]
+
+
+def read_char_offsets(buffer):
+    # (char_start, char_end) views, or None when the marks were written without them
+    n_marks, n_words, blob_bytes, flags = read_header(buffer)
+    if not flags & HAS_OFFSETS:
+        return None
+    offset = HEADER.size + 4 * (3 * n_marks + n_words + 1) + blob_bytes
+    return tuple(np.frombuffer(buffer, dtype="<i4", count=n_marks, offset=offset + 4 * n_marks * i) for i in range(2))
+
+
+def decode_binary(buffer):
+    starts, ends, word_index, words = read_binary(buffer)
+    marks = [{'s': s / 1000, 'e': e / 1000, 'w': words[w]}
+             for s, e, w in zip(starts.tolist(), ends.tolist(), word_index.tolist())]
+    char_offsets = read_char_offsets(buffer)
+    if char_offsets is not None:
+        for mark, char_start, char_end in zip(marks, *(column.tolist() for column in char_offsets)):
+            mark[OFFSET_KEYS[0]] = char_start
+            mark[OFFSET_KEYS[1]] = char_end
+    return marks
+
+
+def write_binary(marks, path):
+    with open(path, "wb") as f:
+        f.write(encode_binary(marks))
+
+
+def load_binary(path):
+    return decode_binary(np.memmap(path, dtype=np.uint8, mode="r"))
+
+
+def format_marks(marks, marks_format):
+    if marks_format == "json":
+        return marks
+    if marks_format == "columnar":
+        return to_columnar(marks)
+    if marks_format == "binary":
+        return encode_binary(marks)
+    raise ValueError(f"Unknown marks format: {marks_format}")
@@ -0,0 +1,108 @@
+import json
+import math
+
+import numpy as np
+
+from ctm import read_ctm_columns
+from marks_format import encode_columns, read_binary
+
+
+class MarksIndex:
+    # Marks sorted by start, held as int32 milliseconds like the binary marks format.
+    # max_ends[i] is the latest end among marks 0..i; it never decreases, so it can be
+    # searched too, which keeps range queries O(log n + k) even if words overlap.
+
+    def __init__(self, starts_ms, ends_ms, word_index, words):
+        starts_ms = np.asarray(starts_ms, dtype=np.int32)
+        if len(starts_ms) > 1 and np.any(starts_ms[1:] < starts_ms[:-1]):
+            order = np.argsort(starts_ms, kind="stable")
+            starts_ms = starts_ms[order]
+            ends_ms = np.asarray(ends_ms)[order]
+            word_index = np.asarray(word_index)[order]
+        self.starts = starts_ms
+        self.ends = np.asarray(ends_ms, dtype=np.int32)
+        self.word_index = np.asarray(word_index, dtype=np.uint32)
+        self.words = words
+        self.max_ends = np.maximum.accumulate(self.ends) if len(self.ends) else self.ends
+
+    @classmethod
+    def from_marks(cls, marks):
+        return cls.from_columns([m['s'] for m in marks], [m['e'] for m in marks], [m['w'] for m in marks])
+
+    @classmethod
+    def from_columns(cls, starts, ends, words):
+        table = {}
+        word_index = [table.setdefault(word, len(table)) for word in words]
+        starts_ms = np.round(np.asarray(starts, dtype=np.float64) * 1000).astype(np.int32)
+        ends_ms = np.round(np.asarray(ends, dtype=np.float64) * 1000).astype(np.int32)
+        return cls(starts_ms, ends_ms, word_index, list(table))
+
+    @classmethod
+    def from_ctm(cls, ctm_paths):
+        columns = read_ctm_columns(ctm_paths)
+        return cls.from_columns(columns['s'], columns['e'], columns['w'])
+
+    @classmethod
+    def from_response(cls, response):
+        # Accepts the processMarks JSON (string or dict) in any of its marks formats
+        if isinstance(response, str):
+            response = json.loads(response)
+        if 'marks_file' in response:
+            return cls.load(response['marks_file'])
+        marks = response['marks']
+        if isinstance(marks, dict):
+            return cls.from_columns(marks['s'], marks['e'], marks['w'])
+        return cls.from_marks(marks)
+
+    @classmethod
+    def load(cls, path):
+        return cls(*read_binary(np.memmap(path, dtype=np.uint8, mode="r")))
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(encode_columns(self.starts, self.ends, self.word_index, self.words))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def mark(self, i):
+        return {'s': int(self.starts[i]) / 1000, 'e': int(self.ends[i]) / 1000, 'w': self.words[self.word_index[i]]}
+
+    def index_at(self, t):
+        # The latest-starting mark with s <= t < e, or None
+        t_ms = _floor_ms(t)
+        hi = int(self.starts.searchsorted(t_ms, side="right"))
+        if hi == 0:
+            return None
+        if self.ends[hi - 1] > t_ms:
+            return hi - 1
+        # Only an overlapping, earlier-starting mark can still cover t
+        lo = int(self.max_ends.searchsorted(t_ms, side="right"))
+        if lo >= hi:
+            return None
+        hits = np.flatnonzero(self.ends[lo:hi] > t_ms)
+        return lo + int(hits[-1]) if len(hits) else None
+
+    def word_at(self, t):
+        i = self.index_at(t)
+        return None if i is None else self.mark(i)
+
+    def indexes_between(self, t0, t1):
+        # Marks overlapping [t0, t1], in start order
+        hi = int(self.starts.searchsorted(_floor_ms(t1), side="right"))
+        lo = int(self.max_ends.searchsorted(_ceil_ms(t0), side="left"))
+        if lo >= hi:
+            return np.zeros(0, dtype=np.int64)
+        return lo + np.flatnonzero(self.ends[lo:hi] >= _ceil_ms(t0))
+
+    def words_between(self, t0, t1):
+        return [self.mark(i) for i in self.indexes_between(t0, t1)]
+
+
+# Mark times are whole milliseconds; the epsilon keeps e.g. 0.57 * 1000 == 569.999... on 570
+def _floor_ms(t):
+    return math.floor(t * 1000 + 1e-6)
+
+
+def _ceil_ms(t):
+    return math.ceil(t * 1000 - 1e-6)
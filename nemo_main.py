@@ -95,7 +95,7 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     text = args.text
-    file_name = str(ulid.ulid())
+    file_name = str(ulid.new())
     audio_path = args.audiopath
 
     text_reader = TextReader()
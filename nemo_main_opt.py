@@ -2,111 +2,397 @@ import os
 import time
 import json
 import traceback
-import re
+import shutil
 import argparse
+from contextlib import nullcontext
 import ulid
-import subprocess
-from concurrent.futures import ThreadPoolExecutor
+from aligner import Aligner, NemoBackend, SubprocessBackend, StubBackend, DEFAULT_BATCH_SIZE, ENGINES, OUTPUTS, utterance, scratch_root
+from long_align import align_long, DEFAULT_OVERLAP
+from emission_cache import EmissionCache
+from audio_ingest import AudioCache
+from cpu_inference import CPUProfile, ExportedBackend
+from segment_align import Segmenter, DEFAULT_MIN_PAUSE, DEFAULT_THRESHOLD_DB, DEFAULT_MIN_CONFIDENCE, \
+    DEFAULT_WORKERS as DEFAULT_SEGMENT_WORKERS
+from result_store import ResultStore, Sweeper, sweep_outputs, DEFAULT_SWEEP_INTERVAL
+from normalize import normalize
+from timings import Timings, MetricsSink, CProfileHook, METRICS_FORMATS, recording, span
+from incremental import realign_edit
+from marks_format import FORMATS, format_marks, write_binary
+from subtitles import SUBTITLE_FORMATS, write_subtitles
+from worker_pool import WorkerPool, DEFAULT_THREADS
+
+BACKENDS = {
+    "nemo": NemoBackend,
+    "subprocess": SubprocessBackend,
+    "stub": StubBackend,
+    "exported": ExportedBackend,
+}
+
+# Where NeMo output files go: kept in storage, on tmpfs and deleted after the request, or not written at all
+SCRATCH = ("storage", "tmpfs", "memory")
+
+def preprocess_text(text):
+    return normalize(text).text
+
+
+def read_manifest(manifest_path):
+    items = []
+    with open(manifest_path, "r") as manifest_file:
+        for index, line in enumerate(manifest_file):
+            if line.strip():
+                entry = json.loads(line)
+                items.append((str(entry.get("id", index)), entry["text"], entry["audio_filepath"]))
+    return items
+
 
 class TextReader:
-    def processMarks(self, text, file_name, audio_path):
-        start_time = time.time()
+    # timings: add per-stage seconds to each response. metrics: a MetricsSink fed every request.
+    # profiler: called with each request's file name, returns a context manager to run it under
+    # (or None), e.g. CProfileHook. result_store: a ResultStore answering repeated word-level
+    # requests without aligning them again. segmenter: a Segmenter that splits single requests
+    # at paragraph pauses and aligns the pieces in parallel.
+    def __init__(self, aligner=None, outputs=("words",), scratch="storage", audio_cache=None, timings=False,
+                 metrics=None, profiler=None, result_store=None, segmenter=None):
+        if scratch not in SCRATCH:
+            raise ValueError(f"Unknown scratch location: {scratch}")
+        if scratch == "memory" and set(outputs) - {"words"}:
+            raise ValueError("Token, segment and ASS outputs need a scratch directory")
+        self.aligner = aligner if aligner is not None else Aligner()
+        self.outputs = tuple(outputs)
+        self.scratch = scratch
+        self.audio_cache = audio_cache
+        self.timings = timings
+        self.metrics = metrics
+        self.profiler = profiler
+        self.result_store = result_store
+        self.segmenter = segmenter
+        self.root_path = os.path.dirname(os.path.abspath(__file__)) + "/../storage/app/texthighlights/"
+
+    def processMarks(self, text, file_name, audio_path, window=None, overlap=DEFAULT_OVERLAP, marks_format="json"):
+        return self.respond(self.marks_work(text, file_name, audio_path, window, overlap, marks_format), file_name)
+
+    def marksResponse(self, text, file_name, audio_path, window=None, overlap=DEFAULT_OVERLAP, marks_format="json"):
+        return self.collect(self.marks_work(text, file_name, audio_path, window, overlap, marks_format), file_name)
+
+    def marks_work(self, text, file_name, audio_path, window, overlap, marks_format):
+        def work(response):
+            if not os.path.exists(audio_path):
+                raise FileNotFoundError(f"Audio file not found: {audio_path}")
+
+            with span("normalize"):
+                normalized = normalize(text)
+            key = self.result_key(audio_path, normalized.text, window, overlap)
+            marks = self.stored_marks(key)
+
+            if marks is None:
+                marks = self.align(normalized.text, file_name, audio_path, window, overlap)
+                self.store_marks(key, marks)
+            self.set_marks(response, self.attach(normalized, marks), marks_format, file_name)
+
+        return work
+
+    def align(self, text, file_name, audio_path, window, overlap):
+        pcm_path = self.ingest(audio_path)
+        if self.segmenter is not None and set(self.outputs) <= {"words"}:
+            return self.segmenter.align(self.aligner, text, pcm_path,
+                                        lambda: self.align_pass(text, file_name, pcm_path, window, overlap),
+                                        window, overlap)
+        return self.align_pass(text, file_name, pcm_path, window, overlap)
+
+    def align_pass(self, text, file_name, pcm_path, window, overlap):
+        if window is not None:
+            # Long-form: memory is bounded by the window, not the file length
+            return align_long(self.aligner, text, pcm_path, window, overlap)
+        # Align in-process with the already-loaded model
+        nemo_output_dir = self.output_dir(file_name)
         try:
-            response = {}
-            root_path = os.path.dirname(os.path.abspath(__file__)) + "/../storage/app/texthighlights/"
-            os.makedirs(root_path, exist_ok=True)
+            return self.aligner.align(text, pcm_path, nemo_output_dir, file_name, self.outputs)
+        finally:
+            self.release_output_dir(nemo_output_dir)
+
+    def processBatch(self, items, file_name, batch_size=DEFAULT_BATCH_SIZE, marks_format="json"):
+        return self.respond(self.batch_work(items, file_name, batch_size, marks_format), file_name)
+
+    def batchResponse(self, items, file_name, batch_size=DEFAULT_BATCH_SIZE, marks_format="json"):
+        return self.collect(self.batch_work(items, file_name, batch_size, marks_format), file_name)
 
+    def batch_work(self, items, file_name, batch_size, marks_format):
+        # items: (id, text, audio_path) tuples, aligned together and answered by id
+        def work(response):
+            with span("normalize"):
+                normalized = {str(utt_id): normalize(text) for utt_id, text, _ in items}
+            keys = {}
+            results = {}
+            for utt_id, _, audio_path in items:
+                utt_id = str(utt_id)
+                if os.path.exists(audio_path):
+                    keys[utt_id] = self.result_key(audio_path, normalized[utt_id].text)
+                    results[utt_id] = self.stored_marks(keys[utt_id])
+            # Only the clips not already in the result store go to the aligner
+            utterances = [utterance(str(utt_id), normalized[str(utt_id)].text, self.ingest(audio_path))
+                          for utt_id, _, audio_path in items if results.get(str(utt_id)) is None]
+            if utterances:
+                nemo_output_dir = self.output_dir(file_name)
+                try:
+                    aligned = self.aligner.align_batch(utterances, nemo_output_dir, batch_size, self.outputs)
+                finally:
+                    self.release_output_dir(nemo_output_dir)
+                for utt_id, marks in aligned.items():
+                    results[utt_id] = marks
+                    self.store_marks(keys.get(utt_id), marks)
+
+            response['results'] = []
+            for utt_id, _, _ in items:
+                utt_id = str(utt_id)
+                marks = results[utt_id]
+                result = {'id': utt_id}
+                self.set_marks(result, self.attach(normalized[utt_id], marks), marks_format, f"{file_name}_{utt_id}")
+                response['results'].append(result)
+
+        return work
+
+    def processEdit(self, prev_marks, old_text, new_text, file_name, audio_path, marks_format="json"):
+        # Re-aligns only the words that changed between old_text and new_text
+        def work(response):
             if not os.path.exists(audio_path):
                 raise FileNotFoundError(f"Audio file not found: {audio_path}")
+            with span("normalize"):
+                normalized = normalize(new_text)
+                old_processed = preprocess_text(old_text)
+            marks = realign_edit(self.aligner, prev_marks, old_processed, normalized.text, self.ingest(audio_path))
+            self.set_marks(response, self.attach(normalized, marks), marks_format, file_name)
+
+        return self.respond(work, file_name)
+
+    def processSubtitles(self, marks, file_name, subtitle_format="srt", style=None):
+        # Subtitles from the marks of an earlier request (a marks list, columnar marks or a
+        # binary marks file), so restyling never aligns again
+        def work(response):
+            path = os.path.join(self.root_path, f"{file_name}.{subtitle_format}")
+            with span("subtitles"):
+                response['subtitles_file'] = write_subtitles(marks, path, subtitle_format, style)
+
+        return self.respond(work, file_name)
 
-            # Precompiled regex for text preprocessing
-            newline_pattern = re.compile(r'\n{3,}')
-            double_newline_pattern = re.compile(r'\n{2}')
-            single_newline_pattern = re.compile(r'\n')
-            space_pattern = re.compile(r'\s+')
-
-            text = newline_pattern.sub('/nn/nn/nn', text)
-            text = double_newline_pattern.sub('/nn/nn', text)
-            text = single_newline_pattern.sub('/nn', text)
-            text = space_pattern.sub(' ', text)
-            text = text.replace('<p>', '\n\n')
-
-            # Create in-memory manifest
-            manifest_data = {
-                "audio_filepath": audio_path,
-                "text": text,
-            }
-            manifest_file_path = os.path.join(root_path, f"{file_name}_manifest.json")
-            with open(manifest_file_path, "w") as manifest_file:
-                json.dump(manifest_data, manifest_file)
-
-            # Perform forced alignment using NeMo
-            nemo_output_dir = os.path.join(root_path, f"{file_name}_nfa_output")
-            os.makedirs(nemo_output_dir, exist_ok=True)
-
-            command = [
-                "python", "NeMo/tools/nemo_forced_aligner/align.py",
-                'pretrained_name="stt_en_fastconformer_hybrid_large_pc"',
-                f'manifest_filepath="{manifest_file_path}"',
-                f'output_dir="{nemo_output_dir}"',
-                'additional_segment_grouping_separator="|"',
-                'ass_file_config.vertical_alignment="bottom"',
-                'ass_file_config.text_already_spoken_rgb=[66,245,212]',
-                'ass_file_config.text_being_spoken_rgb=[242,222,44]',
-                'ass_file_config.text_not_yet_spoken_rgb=[223,242,239]'
-            ]
-            subprocess.run(" ".join(command), shell=True, check=True)
-
-            # Process CTM files
-            ctm_dir = os.path.join(nemo_output_dir, "ctm", "words")
-            response['marks'] = []
-
-            def process_ctm_file(ctm_file):
-                ctm_file_path = os.path.join(ctm_dir, ctm_file)
-                marks = []
-                if os.path.isfile(ctm_file_path):
-                    with open(ctm_file_path, "r") as ctm:
-                        for line in ctm.readlines():
-                            parts = line.strip().split()
-                            if len(parts) >= 4:
-                                word = parts[4]
-                                start_time = float(parts[2])
-                                duration = float(parts[3])
-                                if word != "<b>":
-                                    word_cleaned = word.replace("▁", "")
-                                    marks.append({
-                                        's': start_time,
-                                        'e': start_time + duration,
-                                        'w': word_cleaned
-                                    })
-                return marks
-
-            # Use threading to speed up CTM file processing
-            with ThreadPoolExecutor() as executor:
-                results = list(executor.map(process_ctm_file, os.listdir(ctm_dir)))
-                for result in results:
-                    response['marks'].extend(result)
-
-            # Cleanup
-            os.remove(manifest_file_path)
+    def respond(self, work, name=None):
+        return self.collect(work, name, serialize=True)
+
+    def collect(self, work, name=None, serialize=False):
+        start_time = time.time()
+        cache_before = self.cache_stats()
+        timings = Timings() if self.timings or self.metrics is not None else None
+        profile = self.profiler(name) if self.profiler is not None else None
+        response = {}
+        try:
+            with recording(timings), profile or nullcontext():
+                os.makedirs(self.root_path, exist_ok=True)
+                work(response)
             response['status'] = True
         except Exception as e:
             traceback.print_exc()
             response['status'] = False
             response['message'] = f"{str(e)}\n{traceback.format_exc()}"
+        if cache_before is not None:
+            response['cache'] = {k: v - cache_before[k] for k, v in self.cache_stats().items()}
         response['time'] = float("{:.2f}".format(time.time() - start_time))
-        return json.dumps(response)
+        if timings is None:
+            return json.dumps(response) if serialize else response
+
+        timings.add('total', time.time() - start_time)
+        if self.timings:
+            # JSON serialization of this response is only in the metrics, it happens after
+            response['timings'] = timings.as_dict()
+        if serialize:
+            serialize_start = time.perf_counter()
+            body = json.dumps(response)
+            timings.add('serialize', time.perf_counter() - serialize_start)
+        if self.metrics is not None:
+            self.metrics.record(timings.stages, response['status'], name)
+        return body if serialize else response
+
+    @property
+    def separator(self):
+        return self.aligner.backend.separator
+
+    def ingest(self, audio_path):
+        # Decoded once to 16 kHz mono float32; later requests for the same audio reuse it
+        if self.audio_cache is None or not os.path.exists(audio_path):
+            return audio_path
+        with span("ingest"):
+            return self.audio_cache.ingest(audio_path)
+
+    def result_key(self, audio_path, text, window=None, overlap=None):
+        # Only word marks are stored; requests that also want NeMo's output files always align
+        if self.result_store is None or set(self.outputs) - {"words"}:
+            return None
+        config = dict(self.aligner.config(self.outputs), window=window, overlap=overlap if window is not None else None,
+                      segmenter=self.segmenter.config() if self.segmenter is not None else None)
+        with span("result_store"):
+            return self.result_store.result_key(audio_path, text, json.dumps(config, sort_keys=True))
+
+    def stored_marks(self, key):
+        if key is None:
+            return None
+        with span("result_store"):
+            return self.result_store.get(key)
+
+    def store_marks(self, key, marks):
+        if key is not None:
+            with span("result_store"):
+                self.result_store.put(key, marks)
+
+    def attach(self, normalized, marks):
+        with span("offsets"):
+            return normalized.attach(marks, self.separator)
+
+    def output_dir(self, file_name):
+        if self.scratch == "memory":
+            return None
+        base = self.root_path if self.scratch == "storage" else scratch_root()
+        nemo_output_dir = os.path.join(base, f"{file_name}_nfa_output")
+        os.makedirs(nemo_output_dir, exist_ok=True)
+        return nemo_output_dir
+
+    def release_output_dir(self, nemo_output_dir):
+        if self.scratch == "tmpfs" and nemo_output_dir is not None:
+            shutil.rmtree(nemo_output_dir, ignore_errors=True)
+
+    def set_marks(self, response, marks, marks_format, name):
+        with span("format"):
+            self._set_marks(response, marks, marks_format, name)
+
+    def _set_marks(self, response, marks, marks_format, name):
+        # Binary marks go to a file next to the other outputs, so clients can memory-map them
+        if marks_format == "binary":
+            marks_file_path = os.path.join(self.root_path, f"{name}_marks.bin")
+            write_binary(marks, marks_file_path)
+            response['marks_file'] = marks_file_path
+        else:
+            response['marks'] = format_marks(marks, marks_format)
+
+    def cache_stats(self):
+        stats = {}
+        if self.aligner.emission_cache is not None:
+            stats.update(self.aligner.emission_cache.stats())
+        if self.audio_cache is not None:
+            stats.update({f"audio_{key}": value for key, value in self.audio_cache.stats().items()})
+        if self.result_store is not None:
+            stats.update({f"result_{key}": value for key, value in self.result_store.stats().items()})
+        return stats or None
+
+    def sweeper(self, max_age, interval=DEFAULT_SWEEP_INTERVAL):
+        # Background cleanup of this reader's leftover output directories and expired results
+        return Sweeper([self.root_path, scratch_root()], max_age, self.result_store, interval)
+
+
+def add_reader_arguments(parser):
+    parser.add_argument('--engine', help='alignment engine', choices=ENGINES, default='auto')
+    parser.add_argument('--band', help='numpy engine: states searched either side of the diagonal', type=int)
+    parser.add_argument('--emission_cache', help='directory for cached per-frame log-probs')
+    parser.add_argument('--emission_cache_mb', help='emission cache size cap in MB', type=int, default=2048)
+    parser.add_argument('--audio_cache', help='directory for audio decoded to 16 kHz mono float32')
+    parser.add_argument('--audio_cache_mb', help='audio cache size cap in MB', type=int, default=8192)
+    parser.add_argument('--outputs', help=f'comma-separated NeMo outputs to write ({",".join(OUTPUTS)})',
+                        default='words')
+    parser.add_argument('--scratch', help='where NeMo outputs go', choices=SCRATCH, default='storage')
+    parser.add_argument('--backend', help='acoustic backend', choices=sorted(BACKENDS), default='nemo')
+    parser.add_argument('--exported_model', help='exported backend: graph written by cpu_inference.py')
+    parser.add_argument('--quantize', help='quantize the model\'s Linear layers to int8', action='store_true')
+    parser.add_argument('--intra_op_threads', help='torch threads within an operator', type=int)
+    parser.add_argument('--inter_op_threads', help='torch threads across independent operators', type=int)
+    parser.add_argument('--timings', help='add per-stage seconds to each response', action='store_true')
+    parser.add_argument('--metrics', help='file to write request metrics to')
+    parser.add_argument('--metrics_format', help='metrics file format', choices=METRICS_FORMATS, default='prometheus')
+    parser.add_argument('--segment', help='align paragraphs in parallel between long pauses', action='store_true')
+    parser.add_argument('--segment_workers', help='paragraph segments aligned at once', type=int,
+                        default=DEFAULT_SEGMENT_WORKERS)
+    parser.add_argument('--min_pause', help='shortest pause in seconds that can end a paragraph', type=float,
+                        default=DEFAULT_MIN_PAUSE)
+    parser.add_argument('--vad_threshold_db', help='speech level above the noise floor in dB', type=float,
+                        default=DEFAULT_THRESHOLD_DB)
+    parser.add_argument('--min_confidence', help='segments scoring lower are taken from a full pass instead',
+                        type=float, default=DEFAULT_MIN_CONFIDENCE)
+    parser.add_argument('--result_store', help='directory for stored marks of earlier requests')
+    parser.add_argument('--result_store_mb', help='result store size cap in MB', type=int, default=512)
+    parser.add_argument('--result_store_entries', help='result store entry cap', type=int, default=100000)
+    parser.add_argument('--result_ttl', help='hours a stored result stays valid', type=float, default=168.0)
+    parser.add_argument('--sweep_outputs_after', help='delete NeMo output directories older than this many hours',
+                        type=float)
+
+
+def build_text_reader(args):
+    emission_cache = None
+    if args.emission_cache is not None:
+        emission_cache = EmissionCache(args.emission_cache, args.emission_cache_mb * 1024 * 1024)
+    aligner = Aligner(build_backend(args), args.engine, args.band, emission_cache).load()
+    metrics = MetricsSink(args.metrics, args.metrics_format) if args.metrics is not None else None
+    profiler = CProfileHook(args.profile) if getattr(args, 'profile', None) is not None else None
+    result_store = None
+    if args.result_store is not None:
+        result_store = ResultStore(args.result_store, args.result_store_mb * 1024 * 1024, args.result_store_entries,
+                                   args.result_ttl * 3600)
+    segmenter = None
+    if args.segment:
+        segmenter = Segmenter(args.min_pause, args.vad_threshold_db, min_confidence=args.min_confidence,
+                              workers=args.segment_workers)
+    return TextReader(aligner, args.outputs.split(','), args.scratch, build_audio_cache(args), args.timings, metrics,
+                      profiler, result_store, segmenter)
+
+
+def build_backend(args):
+    profile = CPUProfile(args.quantize, args.intra_op_threads, args.inter_op_threads)
+    if args.backend == "nemo":
+        return NemoBackend(profile=profile)
+    if args.backend == "exported":
+        if args.exported_model is None:
+            raise ValueError("--backend exported needs --exported_model")
+        return ExportedBackend(args.exported_model, profile=profile)
+    return BACKENDS[args.backend]()
+
+
+def build_audio_cache(args):
+    if args.audio_cache is None:
+        return None
+    return AudioCache(args.audio_cache, args.audio_cache_mb * 1024 * 1024)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process text highlight')
-    parser.add_argument('--text', help='input string', required=True)
-    parser.add_argument('--audiopath', help='audio url', required=True)
+    parser.add_argument('--text', help='input string')
+    parser.add_argument('--audiopath', help='audio url')
+    parser.add_argument('--manifest', help='JSON lines file of {"id", "text", "audio_filepath"} to align as one batch')
+    parser.add_argument('--batch_size', help='utterances per model pass', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--window', help='align long audio in windows of this many seconds', type=float)
+    parser.add_argument('--overlap', help='seconds of overlap between windows', type=float, default=DEFAULT_OVERLAP)
+    parser.add_argument('--format', help='marks output format', choices=FORMATS, default='json')
+    parser.add_argument('--workers', help='align the manifest in this many worker processes', type=int)
+    parser.add_argument('--threads', help='intra-op threads per worker', type=int, default=DEFAULT_THREADS)
+    parser.add_argument('--profile', help='write a cProfile dump of the request to this directory')
+    parser.add_argument('--subtitles', help=f'comma-separated subtitle files to write from the marks '
+                                            f'({",".join(SUBTITLE_FORMATS)})')
+    add_reader_arguments(parser)
 
     args = parser.parse_args()
-    text = args.text
-    file_name = str(ulid.ulid())
-    audio_path = args.audiopath
-    text_reader = TextReader()
-    response = text_reader.processMarks(text, file_name, audio_path)
+    if args.manifest is None and (args.text is None or args.audiopath is None):
+        parser.error('--text and --audiopath are required unless --manifest is given')
+    file_name = str(ulid.new())
+    if args.manifest is not None and args.workers is not None:
+        with WorkerPool(build_text_reader, args, args.workers, args.threads,
+                        audio_cache=build_audio_cache(args)) as pool:
+            print(pool.processBatch(read_manifest(args.manifest), file_name, args.batch_size, args.format,
+                                    args.window, args.overlap))
+        raise SystemExit
+    text_reader = build_text_reader(args)
+    if args.sweep_outputs_after is not None:
+        sweep_outputs([text_reader.root_path, scratch_root()], args.sweep_outputs_after * 3600)
+    if args.manifest is not None:
+        response = text_reader.processBatch(read_manifest(args.manifest), file_name, args.batch_size, args.format)
+    else:
+        response = text_reader.processMarks(args.text, file_name, args.audiopath, args.window, args.overlap,
+                                            args.format)
     print(response)
+    if args.subtitles and args.manifest is None:
+        result = json.loads(response)
+        for subtitle_format in args.subtitles.split(',') if result['status'] else ():
+            print(text_reader.processSubtitles(result.get('marks_file', result.get('marks')), file_name,
+                                               subtitle_format))
@@ -0,0 +1,133 @@
+import numpy as np
+
+# Replaces the old regex chain (newline runs, whitespace collapse, <p>) with one set of
+# linear passes over the code points. Newline runs become /nn tokens, with three or more
+# capped at three. Other whitespace runs become one space, and <p> becomes a paragraph break.
+# Everything else is copied as is, so only the replaced runs need an entry in the offset map.
+NEWLINE = ord('\n')
+SPACE = ord(' ')
+REPLACEMENTS = {1: '/nn', 2: '/nn/nn', 3: '/nn/nn/nn', -1: '\n\n'}
+PARAGRAPH = np.array([ord('<'), ord('p'), ord('>')], dtype=np.uint32)
+# str.isspace, which is also what \s and str.split() go by; nothing above U+3000 is whitespace
+WHITESPACE = np.array([chr(c).isspace() for c in range(0x3001)] + [False])
+
+
+def code_points(text):
+    return np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+
+
+def is_space(points):
+    return WHITESPACE[np.minimum(points, len(WHITESPACE) - 1)]
+
+
+def runs(mask):
+    # [start, end) of every run of True
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], mask, [False])).view(np.int8)))
+    return edges[0::2], edges[1::2]
+
+
+class NormalizedText:
+    # text: what the aligner sees. The offset map holds one entry per replaced run, with its
+    # span in text and in the source; positions between the runs map one to one.
+
+    def __init__(self, text, out_starts, out_ends, src_starts, src_ends):
+        self.text = text
+        self.out_starts = out_starts
+        self.out_ends = out_ends
+        self.src_starts = src_starts
+        self.src_ends = src_ends
+
+    def to_source(self, positions):
+        # Source span [start, end) of each character position in text
+        positions = np.asarray(positions, dtype=np.int64)
+        run = np.searchsorted(self.out_starts, positions, side="right") - 1
+        has_run = run >= 0
+        run = np.maximum(run, 0)
+        if len(self.out_starts) == 0:
+            return positions, positions + 1
+        inside = has_run & (positions < self.out_ends[run])
+        copied = positions - np.where(has_run, self.out_ends[run], 0) + np.where(has_run, self.src_ends[run], 0)
+        return np.where(inside, self.src_starts[run], copied), np.where(inside, self.src_ends[run], copied + 1)
+
+    def word_spans(self, separator):
+        # The aligner's words (text split on whitespace and the segment separator) with
+        # [char_start, char_end) into the source
+        words = self.text.replace(separator, ' ').split()
+        points = code_points(self.text)
+        starts, ends = runs(~is_space(points) & (points != ord(separator)))
+        char_starts, _ = self.to_source(starts)
+        _, char_ends = self.to_source(ends - 1)
+        return words, char_starts.tolist(), char_ends.tolist()
+
+    def attach(self, marks, separator):
+        # Adds char_start/char_end to each mark. Marks normally line up one to one with the
+        # words; if the backend dropped some, match the rest by word in order.
+        words, char_starts, char_ends = self.word_spans(separator)
+        if len(marks) == len(words):
+            return [dict(mark, char_start=char_starts[i], char_end=char_ends[i]) for i, mark in enumerate(marks)]
+        attached = []
+        j = 0
+        for mark in marks:
+            k = j
+            while k < len(words) and words[k] != mark['w']:
+                k += 1
+            if k == len(words):
+                attached.append(dict(mark))
+                continue
+            attached.append(dict(mark, char_start=char_starts[k], char_end=char_ends[k]))
+            j = k + 1
+        return attached
+
+
+def normalize(text):
+    points = code_points(text)
+    newline = points == NEWLINE
+    space = is_space(points) & ~newline
+    paragraph = np.zeros(len(points), dtype=bool)
+    if len(points) >= 3:
+        paragraph[:-2] = (points[:-2] == PARAGRAPH[0]) & (points[1:-1] == PARAGRAPH[1]) & (points[2:] == PARAGRAPH[2])
+
+    newline_starts, newline_ends = runs(newline)
+    space_starts, space_ends = runs(space)
+    paragraph_starts = np.flatnonzero(paragraph)
+    src_starts = np.concatenate((newline_starts, space_starts, paragraph_starts))
+    src_ends = np.concatenate((newline_ends, space_ends, paragraph_starts + 3))
+    tokens = np.concatenate((np.minimum(newline_ends - newline_starts, 3), np.zeros(len(space_starts), dtype=np.int64),
+                             np.full(len(paragraph_starts), -1, dtype=np.int64)))
+    order = np.argsort(src_starts, kind="stable")
+    src_starts, src_ends, tokens = src_starts[order], src_ends[order], tokens[order]
+    # tokens: 1-3 for that many /nn, 0 for a space, -1 for a paragraph break
+    out_lengths = np.where(tokens > 0, 3 * tokens, np.where(tokens == 0, 1, 2))
+
+    # Drop all but the first character of each replaced run, put a placeholder there, and
+    # let str.replace expand the placeholders
+    inner = np.zeros(len(points), dtype=bool)
+    inner[1:] = (newline[1:] & newline[:-1]) | (space[1:] & space[:-1])
+    inner[paragraph_starts + 1] = True
+    inner[paragraph_starts + 2] = True
+    dropped = src_ends - src_starts - 1
+    kept_starts = src_starts - (np.cumsum(dropped) - dropped)
+    kept = points[~inner]
+    placeholders = _placeholders(text)
+    kept[kept_starts[tokens == 0]] = SPACE
+    for token, placeholder in placeholders.items():
+        kept[kept_starts[tokens == token]] = ord(placeholder)
+    normalized = kept.tobytes().decode('utf-32-le', 'surrogatepass')
+    for token, placeholder in placeholders.items():
+        normalized = normalized.replace(placeholder, REPLACEMENTS[token])
+    grown = out_lengths - 1
+    out_starts = kept_starts + (np.cumsum(grown) - grown)
+
+    return NormalizedText(normalized, out_starts, out_starts + out_lengths, src_starts, src_ends)
+
+
+def _placeholders(text):
+    # Private-use characters the text does not already contain
+    placeholders = {}
+    candidate = 0xE000
+    for token in REPLACEMENTS:
+        while chr(candidate) in text:
+            candidate += 1
+        placeholders[token] = chr(candidate)
+        candidate += 1
+    return placeholders
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+from emission_cache import EmissionCache, atomic_write
+
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_TTL = 7 * 24 * 3600.0
+DEFAULT_SWEEP_INTERVAL = 300.0
+OUTPUT_DIR_SUFFIX = "_nfa_output"
+
+
+class ResultStore(EmissionCache):
+    # Word marks as JSON, keyed by the audio content hash plus a hash of the normalized text
+    # and the aligner config. The marks are stored before source offsets are attached, since
+    # those depend on the raw text. An entry's mtime is when it was written (for the TTL) and
+    # its atime, set on every hit, is the LRU order for eviction.
+    suffix = ".json"
+
+    def __init__(self, store_dir, max_bytes=DEFAULT_MAX_BYTES, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        super().__init__(store_dir, max_bytes)
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def result_key(self, audio_path, text, config):
+        text_hash = hashlib.sha256(f"{config}\0{text}".encode("utf-8", "surrogatepass")).hexdigest()[:32]
+        return f"{self.digest(audio_path)}_{text_hash}"
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+            if self.expired(stat, time.time()):
+                os.remove(path)
+                raise FileNotFoundError(path)
+            with open(path, "r") as f:
+                marks = json.load(f)
+            os.utime(path, (time.time(), stat.st_mtime))
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return marks
+
+    def put(self, key, marks):
+        with atomic_write(self.path(key), "w") as f:
+            json.dump(marks, f, separators=(",", ":"))
+        self.evict(keep=key)
+
+    def expired(self, stat, now):
+        return self.ttl is not None and now - stat.st_mtime > self.ttl
+
+    def expire(self):
+        removed = 0
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if self.expired(os.stat(path), now):
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def last_used(self, stat):
+        return stat.st_atime
+
+
+def sweep_outputs(dirs, max_age):
+    # Removes *_nfa_output directories untouched for max_age seconds. Requests still writing
+    # theirs keep bumping its mtime, so only leftovers are old enough to go.
+    removed = 0
+    now = time.time()
+    for base in dirs:
+        try:
+            names = os.listdir(base)
+        except FileNotFoundError:
+            continue
+        for name in names:
+            path = os.path.join(base, name)
+            if not name.endswith(OUTPUT_DIR_SUFFIX):
+                continue
+            try:
+                if not os.path.isdir(path) or now - os.stat(path).st_mtime <= max_age:
+                    continue
+            except FileNotFoundError:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+class Sweeper(threading.Thread):
+    # Every interval seconds: removes output directories older than max_age and expired
+    # result store entries
+    def __init__(self, dirs, max_age, result_store=None, interval=DEFAULT_SWEEP_INTERVAL):
+        super().__init__(name="output-sweeper", daemon=True)
+        self.dirs = list(dirs)
+        self.max_age = max_age
+        self.result_store = result_store
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.removed = {'output_dirs': 0, 'results': 0}
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sweep()
+
+    def sweep(self):
+        if self.max_age is not None:
+            self.removed['output_dirs'] += sweep_outputs(self.dirs, self.max_age)
+        if self.result_store is not None:
+            self.removed['results'] += self.result_store.expire()
+        return self.removed
+
+    def stop(self):
+        self.stopped.set()
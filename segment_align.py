@@ -0,0 +1,206 @@
+import os
+import shutil
+import tempfile
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from aligner import SEGMENT_SEPARATOR, audio_duration
+from audio_ingest import SAMPLE_RATE, decode
+from long_align import write_wav_slice, align_long, DEFAULT_OVERLAP
+from normalize import runs
+from timings import span
+
+FRAME_SECONDS = 0.03
+DEFAULT_MIN_PAUSE = 0.6
+DEFAULT_THRESHOLD_DB = 12.0
+DEFAULT_TOLERANCE = 8.0
+DEFAULT_MIN_CONFIDENCE = 0.7
+DEFAULT_WORKERS = 2
+MIN_SPEECH_SECONDS = 0.1
+MAX_WORD_SECONDS = 3.0
+RATE_SLACK = 2.0
+PARAGRAPH_BREAK = "\n\n"
+
+
+def frame_energies(audio_path, frame_seconds=FRAME_SECONDS):
+    # Mean energy in dB of every frame, streamed block by block so hours of audio stay cheap
+    frame = int(SAMPLE_RATE * frame_seconds)
+    parts = []
+    carry = np.zeros(0, dtype=np.float32)
+    for block in decode(audio_path):
+        buffer = np.concatenate((carry, block))
+        usable = len(buffer) - len(buffer) % frame
+        samples = buffer[:usable].reshape(-1, frame).astype(np.float64)
+        parts.append(np.einsum("ij,ij->i", samples, samples) / frame)
+        carry = buffer[usable:]
+    energy = np.concatenate(parts) if parts else np.zeros(0)
+    return 10 * np.log10(energy + 1e-10)
+
+
+def speech_frames(db, threshold_db=DEFAULT_THRESHOLD_DB, frame_seconds=FRAME_SECONDS):
+    # Speech is threshold_db above the quietest tenth of the file; blips shorter than
+    # MIN_SPEECH_SECONDS (clicks, breaths) count as silence
+    if len(db) == 0:
+        return np.zeros(0, dtype=bool)
+    speech = db > np.percentile(db, 10) + threshold_db
+    starts, ends = runs(speech)
+    short = (ends - starts) * frame_seconds < MIN_SPEECH_SECONDS
+    for start, end in zip(starts[short], ends[short]):
+        speech[start:end] = False
+    return speech
+
+
+def find_pauses(speech, min_pause=DEFAULT_MIN_PAUSE, frame_seconds=FRAME_SECONDS):
+    # [start, end) frames of the silences between speech, not counting leading and trailing silence
+    starts, ends = runs(~speech)
+    keep = ((ends - starts) * frame_seconds >= min_pause) & (starts > 0) & (ends < len(speech))
+    return starts[keep], ends[keep]
+
+
+def paragraphs(text, separator=SEGMENT_SEPARATOR):
+    # Word lists of the text's paragraphs: <p> (already "\n\n" after normalize) and the
+    # segment separator both end one
+    parts = text.replace(separator, PARAGRAPH_BREAK).split(PARAGRAPH_BREAK)
+    return [words for words in (part.split() for part in parts) if words]
+
+
+def plan_cuts(boundaries, total_words, speech, pause_starts, pause_ends, tolerance=DEFAULT_TOLERANCE,
+              frame_seconds=FRAME_SECONDS):
+    # boundaries: index of the first word of every paragraph but the first. Each boundary is
+    # expected where the speech time so far matches its share of the words (counted from the
+    # last cut, so an early error does not carry over); the best pause within tolerance of
+    # that, longer and closer being better, becomes the cut. Boundaries with no pause near
+    # them stay inside a segment. Returns (word index, frame) per cut.
+    spoken = np.cumsum(speech)
+    total_speech = int(spoken[-1]) if len(spoken) else 0
+    centres = (pause_starts + pause_ends) / 2
+    window = tolerance / frame_seconds
+    cuts = []
+    word, frame, speech_before = 0, 0, 0
+    for boundary in boundaries:
+        if total_speech <= speech_before:
+            break
+        target = speech_before + (boundary - word) / (total_words - word) * (total_speech - speech_before)
+        expected = np.searchsorted(spoken, target)
+        lo = np.searchsorted(centres, max(expected - window, frame), side="right")
+        hi = np.searchsorted(centres, expected + window, side="right")
+        candidates = np.arange(lo, hi)
+        candidates = candidates[pause_starts[candidates] >= frame]
+        if len(candidates) == 0:
+            continue
+        score = (pause_ends[candidates] - pause_starts[candidates]) / (1 + np.abs(centres[candidates] - expected))
+        best = candidates[np.argmax(score)]
+        frame = int(centres[best])
+        word = boundary
+        speech_before = int(spoken[frame - 1]) if frame > 0 else 0
+        cuts.append((word, frame))
+    return cuts
+
+
+def segment_confidence(marks, duration, speech_seconds, words_per_second):
+    # 0-1: share of words with a plausible duration, scaled down when the segment's speaking
+    # rate is more than RATE_SLACK times off the file's
+    if not marks:
+        return 0.0
+    lengths = np.array([mark['e'] - mark['s'] for mark in marks])
+    plausible = float(np.mean((lengths > 0) & (lengths <= MAX_WORD_SECONDS) &
+                              (np.array([mark['e'] for mark in marks]) <= duration + 0.05)))
+    if speech_seconds <= 0 or words_per_second <= 0:
+        return plausible
+    ratio = len(marks) / speech_seconds / words_per_second
+    return plausible * min(1.0, min(ratio, 1 / ratio) * RATE_SLACK)
+
+
+def segment_result(future):
+    # A segment that cannot be aligned on its own (say more tokens than its audio has frames)
+    # gets no marks, so confidence 0, and takes its words from the full pass
+    try:
+        return future.result()
+    except Exception:
+        return None
+
+
+class Segmenter:
+    # Splits a transcript at its paragraph boundaries and the audio at the pauses found for
+    # them by an energy VAD, aligns the (paragraph group, audio span) pairs on workers threads
+    # and shifts the marks back onto the file's timeline. Segments whose marks look wrong are
+    # replaced by the same words from one full pass.
+
+    def __init__(self, min_pause=DEFAULT_MIN_PAUSE, threshold_db=DEFAULT_THRESHOLD_DB, tolerance=DEFAULT_TOLERANCE,
+                 min_confidence=DEFAULT_MIN_CONFIDENCE, workers=DEFAULT_WORKERS):
+        self.min_pause = min_pause
+        self.threshold_db = threshold_db
+        self.tolerance = tolerance
+        self.min_confidence = min_confidence
+        self.workers = workers
+
+    def config(self):
+        return {'min_pause': self.min_pause, 'threshold_db': self.threshold_db, 'tolerance': self.tolerance,
+                'min_confidence': self.min_confidence}
+
+    def segments(self, text, audio_path, separator=SEGMENT_SEPARATOR):
+        # [(words, start seconds, end seconds)]
+        groups = paragraphs(text, separator)
+        words = [word for group in groups for word in group]
+        duration = audio_duration(audio_path)
+        if len(groups) < 2:
+            return [(words, 0.0, duration)], None
+        with span("vad"):
+            speech = speech_frames(frame_energies(audio_path), self.threshold_db)
+            pause_starts, pause_ends = find_pauses(speech, self.min_pause)
+            boundaries = np.cumsum([len(group) for group in groups])[:-1]
+            cuts = plan_cuts(boundaries, len(words), speech, pause_starts, pause_ends, self.tolerance)
+        edges = [(0, 0.0)] + [(word, frame * FRAME_SECONDS) for word, frame in cuts] + [(len(words), duration)]
+        return [(words[first:last], start, end) for (first, start), (last, end) in zip(edges, edges[1:])], speech
+
+    def align(self, aligner, text, audio_path, fallback=None, window=None, overlap=DEFAULT_OVERLAP, scratch_dir=None):
+        separator = aligner.backend.separator
+        segments, speech = self.segments(text, audio_path, separator)
+        if fallback is None:
+            def fallback():
+                return aligner.align(" ".join(word for words, _, _ in segments for word in words), audio_path)
+        if len(segments) == 1:
+            return fallback()
+
+        work_dir = tempfile.mkdtemp(prefix="segment_align_", dir=scratch_dir)
+        try:
+            with span("segments"), ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # Each task gets its own copy of the context, so its spans land in this request
+                futures = [executor.submit(contextvars.copy_context().run, self.align_segment, aligner, words,
+                                           audio_path, start, end, os.path.join(work_dir, f"segment_{index}.wav"),
+                                           window, overlap)
+                           for index, (words, start, end) in enumerate(segments)]
+                results = [segment_result(future) for future in futures]
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        total_words = sum(len(words) for words, _, _ in segments)
+        words_per_second = total_words / (np.count_nonzero(speech) * FRAME_SECONDS or 1.0)
+        marks = []
+        full = None
+        for (words, start, end), segment_marks in zip(segments, results):
+            first, last = int(start / FRAME_SECONDS), int(end / FRAME_SECONDS)
+            confidence = segment_confidence(segment_marks, end - start,
+                                            np.count_nonzero(speech[first:last]) * FRAME_SECONDS, words_per_second)
+            if confidence >= self.min_confidence and len(segment_marks) == len(words):
+                marks.extend({'s': round(mark['s'] + start, 2), 'e': round(mark['e'] + start, 2), 'w': mark['w']}
+                             for mark in segment_marks)
+                continue
+            if full is None:
+                full = fallback()
+                if len(full) != total_words:
+                    # The full pass dropped words, so it cannot be spliced in; use it all
+                    return full
+            marks.extend(full[len(marks):len(marks) + len(words)])
+        return marks
+
+    def align_segment(self, aligner, words, audio_path, start, end, slice_path, window, overlap):
+        write_wav_slice(audio_path, start, end, slice_path)
+        try:
+            if window is not None:
+                return align_long(aligner, " ".join(words), slice_path, window, overlap, cached=False)
+            return aligner.align(" ".join(words), slice_path, utt_id=os.path.basename(slice_path)[:-4], cached=False)
+        finally:
+            os.remove(slice_path)
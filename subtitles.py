@@ -0,0 +1,240 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+from aligner import ASS_FILE_CONFIG
+from emission_cache import atomic_write
+from marks_format import MAGIC, binary_sections
+
+SUBTITLE_FORMATS = ("srt", "vtt", "ass")
+DEFAULT_MAX_CHARS = 42
+DEFAULT_MAX_LINES = 2
+DEFAULT_MAX_DURATION = 7.0
+DEFAULT_MAX_GAP = 1.5
+SENTENCE_END = (".", "?", "!")
+ASS_ALIGNMENT = {"top": 8, "center": 5, "bottom": 2}
+CHUNK = 8192
+
+
+class SubtitleStyle:
+    # Line breaking: lines of at most max_chars, cues of at most max_lines lines and
+    # max_duration seconds, a new cue after a sentence end or a silence longer than max_gap.
+    # ass_file_config: the same vertical alignment and three colours NeMo's ASS files use.
+
+    def __init__(self, max_chars=DEFAULT_MAX_CHARS, max_lines=DEFAULT_MAX_LINES, max_duration=DEFAULT_MAX_DURATION,
+                 max_gap=DEFAULT_MAX_GAP, sentence_breaks=True, ass_file_config=None, font="Arial", font_size=48,
+                 resolution=(1920, 1080)):
+        self.max_chars = max_chars
+        self.max_lines = max_lines
+        self.max_duration = max_duration
+        self.max_gap = max_gap
+        self.sentence_breaks = sentence_breaks
+        self.ass_file_config = dict(ASS_FILE_CONFIG, **(ass_file_config or {}))
+        self.font = font
+        self.font_size = font_size
+        self.resolution = resolution
+
+
+def iter_marks(source):
+    # Marks one at a time from a marks list, columnar marks, or a binary marks file (which is
+    # memory-mapped and read in chunks, so it is never loaded whole)
+    if isinstance(source, str):
+        starts, ends, word_index, offsets, blob = binary_sections(np.memmap(source, dtype=np.uint8, mode="r"))
+        for first in range(0, len(starts), CHUNK):
+            last = first + CHUNK
+            # Each distinct word of the chunk is decoded once
+            unique, inverse = np.unique(word_index[first:last], return_inverse=True)
+            texts = [blob[offsets[w]:offsets[w + 1]].tobytes().decode("utf-8") for w in unique.tolist()]
+            for s, e, w in zip(starts[first:last].tolist(), ends[first:last].tolist(), inverse.tolist()):
+                yield {'s': s / 1000, 'e': e / 1000, 'w': texts[w]}
+    elif isinstance(source, dict):
+        for s, e, w in zip(source['s'], source['e'], source['w']):
+            yield {'s': s, 'e': e, 'w': w}
+    else:
+        yield from source
+
+
+def display_word(word):
+    # Newline tokens from normalize (/nn) are just spaces on screen
+    if "/nn" in word:
+        return " ".join(word.replace("/nn", " ").split())
+    return word
+
+
+def cues(marks, style):
+    # Yields one cue at a time: a list of lines, each a list of (text, start, end). Only the
+    # current cue is held, so memory does not grow with the number of marks.
+    max_chars, max_lines, max_gap, max_duration = style.max_chars, style.max_lines, style.max_gap, style.max_duration
+    sentence_end = SENTENCE_END if style.sentence_breaks else ()
+    lines = [[]]
+    line = lines[0]
+    line_chars = 0
+    cue_start = cue_end = None
+    for mark in marks:
+        text = display_word(mark['w'])
+        if not text:
+            continue
+        start, end = mark['s'], mark['e']
+        if cue_start is not None and (start - cue_end > max_gap or end - cue_start > max_duration):
+            yield lines
+            lines, line_chars, cue_start = [[]], 0, None
+            line = lines[0]
+        if line and line_chars + 1 + len(text) > max_chars:
+            if len(lines) == max_lines:
+                yield lines
+                lines, cue_start = [[]], None
+                line = lines[0]
+            else:
+                line = []
+                lines.append(line)
+            line_chars = 0
+        line_chars += len(text) + 1 if line else len(text)
+        line.append((text, start, end))
+        if cue_start is None:
+            cue_start, cue_end = start, end
+        elif end > cue_end:
+            cue_end = end
+        if sentence_end and text.endswith(sentence_end):
+            yield lines
+            lines, line_chars, cue_start = [[]], 0, None
+            line = lines[0]
+    if lines[0]:
+        yield lines
+
+
+def cue_times(lines):
+    words = [word for line in lines for word in line]
+    return words[0][1], max(end for _, _, end in words)
+
+
+def clock(seconds, separator=",", fraction_digits=3):
+    ms = max(int(round(seconds * 1000)), 0)
+    hours, ms = divmod(ms, 3600000)
+    minutes, ms = divmod(ms, 60000)
+    secs, ms = divmod(ms, 1000)
+    if fraction_digits == 2:
+        return f"{hours}:{minutes:02d}:{secs:02d}{separator}{ms // 10:02d}"
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}{separator}{ms:03d}"
+
+
+def render_srt(marks, style):
+    for index, lines in enumerate(cues(marks, style), 1):
+        start, end = cue_times(lines)
+        text = "\n".join(" ".join(word for word, _, _ in line) for line in lines)
+        yield f"{index}\n{clock(start)} --> {clock(end)}\n{text}\n\n"
+
+
+def vtt_escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def render_vtt(marks, style):
+    yield "WEBVTT\n\n"
+    for lines in cues(marks, style):
+        start, end = cue_times(lines)
+        text = "\n".join(" ".join(vtt_escape(word) for word, _, _ in line) for line in lines)
+        yield f"{clock(start, '.')} --> {clock(end, '.')}\n{text}\n\n"
+
+
+def bgr(rgb):
+    # ASS colours are hex BGR: &HBBGGRR& inline, &HAABBGGRR in styles
+    r, g, b = rgb
+    return f"{b:02X}{g:02X}{r:02X}"
+
+
+def ass_escape(text):
+    # ASS has no escapes: braces open override blocks and a backslash can start \N
+    return text.replace("\\", "\uff3c").replace("{", "(").replace("}", ")")
+
+
+def render_ass(marks, style):
+    # Karaoke like NeMo's: one event per word of a cue, with the words already spoken, the
+    # word being spoken and the words still to come each in their own colour
+    config = style.ass_file_config
+    spoken = bgr(config["text_already_spoken_rgb"])
+    speaking = bgr(config["text_being_spoken_rgb"])
+    waiting = bgr(config["text_not_yet_spoken_rgb"])
+    yield ("[Script Info]\nScriptType: v4.00+\n"
+           f"PlayResX: {style.resolution[0]}\nPlayResY: {style.resolution[1]}\nScaledBorderAndShadow: yes\n\n"
+           "[V4+ Styles]\n"
+           "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, "
+           "Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, "
+           "MarginL, MarginR, MarginV, Encoding\n"
+           f"Style: Default,{style.font},{style.font_size},"
+           f"&H00{waiting},&H00{spoken},"
+           f"&H00000000,&H80000000,0,0,0,0,100,100,0,0,1,2,1,"
+           f"{ASS_ALIGNMENT.get(config['vertical_alignment'], 2)},40,40,40,1\n\n"
+           "[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n")
+    for lines in cues(marks, style):
+        # Each word with the space or line break before it; an event is then three runs of
+        # these, one per colour
+        tokens = []
+        starts = []
+        for number, line in enumerate(lines):
+            for index, (word, start, _) in enumerate(line):
+                separator = " " if index else "\\N" if number else ""
+                tokens.append(separator + ass_escape(word))
+                starts.append(start)
+        starts.append(cue_times(lines)[1])
+        for current in range(len(tokens)):
+            # Until the next word starts; the last word stays lit until the cue ends
+            start, end = starts[current], starts[current + 1]
+            if end <= start:
+                continue
+            yield (f"Dialogue: 0,{clock(start, '.', 2)},{clock(end, '.', 2)},Default,,0,0,0,,"
+                   f"{{\\c&H{spoken}&}}{''.join(tokens[:current])}{{\\c&H{speaking}&}}{tokens[current]}"
+                   f"{{\\c&H{waiting}&}}{''.join(tokens[current + 1:])}\n")
+
+
+RENDERERS = {"srt": render_srt, "vtt": render_vtt, "ass": render_ass}
+
+
+def render(marks, subtitle_format="srt", style=None):
+    # Subtitle text in chunks, one cue (one event for ASS) at a time
+    if subtitle_format not in RENDERERS:
+        raise ValueError(f"Unknown subtitle format: {subtitle_format}")
+    return RENDERERS[subtitle_format](iter_marks(marks), style or SubtitleStyle())
+
+
+def write_subtitles(marks, path, subtitle_format="srt", style=None):
+    # Written to a temporary file first, so a failed export does not leave half a file
+    with atomic_write(path, "w", encoding="utf-8") as f:
+        f.writelines(render(marks, subtitle_format, style))
+    return path
+
+
+def load_marks(path):
+    # A binary marks file stays on disk; JSON is a processMarks response or a bare marks list
+    with open(path, "rb") as f:
+        if f.read(4) == MAGIC:
+            return path
+    with open(path, "r") as f:
+        data = json.load(f)
+    if isinstance(data, dict) and 'marks_file' in data:
+        return data['marks_file']
+    return data['marks'] if isinstance(data, dict) and 'marks' in data else data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write SRT, WebVTT or karaoke ASS subtitles from marks')
+    parser.add_argument('--marks', help='binary marks file, processMarks JSON response or JSON marks list',
+                        required=True)
+    parser.add_argument('--output', help='subtitle file to write', required=True)
+    parser.add_argument('--format', help='subtitle format (default: from --output)', choices=SUBTITLE_FORMATS)
+    parser.add_argument('--max_chars', help='characters per line', type=int, default=DEFAULT_MAX_CHARS)
+    parser.add_argument('--max_lines', help='lines per cue', type=int, default=DEFAULT_MAX_LINES)
+    parser.add_argument('--max_duration', help='seconds per cue', type=float, default=DEFAULT_MAX_DURATION)
+    parser.add_argument('--max_gap', help='silence in seconds that starts a new cue', type=float,
+                        default=DEFAULT_MAX_GAP)
+    parser.add_argument('--no_sentence_breaks', help='keep filling a cue after . ? !', action='store_true')
+    parser.add_argument('--ass_file_config', help='JSON overrides for the ASS colours and vertical alignment')
+    args = parser.parse_args()
+
+    subtitle_format = args.format or os.path.splitext(args.output)[1].lstrip(".").lower()
+    if subtitle_format not in SUBTITLE_FORMATS:
+        parser.error('--format is needed when --output has no .srt, .vtt or .ass extension')
+    style = SubtitleStyle(args.max_chars, args.max_lines, args.max_duration, args.max_gap, not args.no_sentence_breaks,
+                          json.loads(args.ass_file_config) if args.ass_file_config else None)
+    print(write_subtitles(load_marks(args.marks), args.output, subtitle_format, style))
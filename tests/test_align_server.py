@@ -0,0 +1,149 @@
+import json
+import wave
+import asyncio
+
+from aligner import Aligner, StubBackend
+from align_server import AlignServer
+from audio_ingest import SAMPLE_RATE
+from nemo_main_opt import TextReader
+
+
+def write_wav(path, seconds):
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(b"\0\0" * int(seconds * SAMPLE_RATE))
+    return str(path)
+
+
+def make_server(tmp_path, **kwargs):
+    backend = StubBackend()
+    reader = TextReader(Aligner(backend, "nemo").load(), scratch="memory")
+    reader.root_path = str(tmp_path)
+    return AlignServer(reader, **kwargs), backend
+
+
+async def post(port, request):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = json.dumps(request).encode("utf-8")
+    writer.write(f"POST /align HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+    head, _, payload = (await reader.read()).partition(b"\r\n\r\n")
+    writer.close()
+    lines = head.decode("latin-1").split("\r\n")
+    headers = dict(line.split(": ", 1) for line in lines[1:])
+    return int(lines[0].split()[1]), headers, json.loads(payload)
+
+
+async def serving(align_server, requests, before=None):
+    # Starts the server on a free port, sends the requests concurrently and returns the replies
+    server = await asyncio.start_server(align_server.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    if before is not None:
+        await before(port)
+    else:
+        align_server.start()
+    try:
+        return await asyncio.gather(*(post(port, request) for request in requests))
+    finally:
+        server.close()
+        await server.wait_closed()
+        await align_server.close()
+
+
+def test_requests_are_batched(tmp_path):
+    audio = write_wav(tmp_path / "a.wav", 2.0)
+    texts = ["one two three", "four five", "six", "seven eight nine ten"]
+    align_server, backend = make_server(tmp_path, max_batch=8, max_wait_ms=500)
+    replies = asyncio.run(serving(align_server, [{'text': text, 'audiopath': audio} for text in texts]))
+    for (status, _, body), text in zip(replies, texts):
+        assert status == 200 and body['status']
+        assert [mark['w'] for mark in body['marks']] == text.split()
+    assert align_server.counts['batches'] == 1
+    assert backend.calls == 1
+
+
+def test_queue_full_is_503(tmp_path):
+    audio = write_wav(tmp_path / "a.wav", 1.0)
+    align_server, backend = make_server(tmp_path, queue_size=1, timeout=0.5)
+
+    async def fill(port):
+        # With the batcher not running, the first request holds the only queue slot
+        asyncio.get_running_loop().create_task(post(port, {'text': "held", 'audiopath': audio}))
+        for _ in range(100):
+            if align_server.queue.qsize():
+                break
+            await asyncio.sleep(0.01)
+
+    (status, headers, body), = asyncio.run(serving(align_server, [{'text': "late", 'audiopath': audio}], fill))
+    assert status == 503 and not body['status']
+    assert headers["Retry-After"] == "1"
+    assert align_server.counts['rejected'] == 1
+    assert backend.calls == 0
+
+
+def test_timeout_is_504(tmp_path):
+    audio = write_wav(tmp_path / "a.wav", 1.0)
+    align_server, backend = make_server(tmp_path, timeout=10.0)
+
+    async def run():
+        align_server.start()
+        align_server.batcher.cancel()
+        status, body = await align_server.align("slow words", audio, timeout=0.05)
+        # A batcher started after the timeout skips the abandoned job
+        align_server.batcher = None
+        align_server.start()
+        await asyncio.sleep(0.1)
+        await align_server.close()
+        return status, body
+
+    status, body = asyncio.run(run())
+    assert status == 504 and not body['status']
+    assert "0.05s" in body['message']
+    assert align_server.counts['timeouts'] == 1
+    assert align_server.counts['batches'] == 0
+    assert backend.calls == 0
+
+
+def test_missing_file_is_retried_one_by_one(tmp_path):
+    audio = write_wav(tmp_path / "a.wav", 2.0)
+    requests = [{'text': "one two", 'audiopath': audio},
+                {'text': "three four", 'audiopath': str(tmp_path / "missing.wav")},
+                {'text': "five six", 'audiopath': audio}]
+    align_server, backend = make_server(tmp_path, max_batch=8, max_wait_ms=500)
+    replies = asyncio.run(serving(align_server, requests))
+    assert [status for status, _, _ in replies] == [200, 200, 200]
+    first, missing, last = (body for _, _, body in replies)
+    assert [mark['w'] for mark in first['marks']] == ["one", "two"]
+    assert [mark['w'] for mark in last['marks']] == ["five", "six"]
+    assert not missing['status'] and "missing.wav" in missing['message']
+    assert align_server.counts['batches'] == 1
+    # The batch fails before reaching the model; then each request with audio is aligned on its own
+    assert backend.calls == 2
+
+
+def test_health_and_errors(tmp_path):
+    align_server, _ = make_server(tmp_path)
+
+    async def run():
+        server = await asyncio.start_server(align_server.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        align_server.start()
+        replies = []
+        for raw in (b"GET /health HTTP/1.1\r\n\r\n", b"GET /nowhere HTTP/1.1\r\n\r\n",
+                    b"POST /align HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}"):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(raw)
+            head, _, payload = (await reader.read()).partition(b"\r\n\r\n")
+            writer.close()
+            replies.append((int(head.split()[1]), json.loads(payload)))
+        server.close()
+        await server.wait_closed()
+        await align_server.close()
+        return replies
+
+    (health_status, health), (missing_status, _), (bad_status, bad) = asyncio.run(run())
+    assert health_status == 200 and health['queued'] == 0
+    assert missing_status == 404
+    assert bad_status == 400 and bad['message'] == "Missing field: text"
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from aligner import Aligner, StubBackend, utterance
+from audio_ingest import SAMPLE_RATE, wav_header
+from emission_cache import EmissionCache
+
+
+@pytest.fixture
+def clips(tmp_path):
+    paths = []
+    for index, seconds in enumerate([1.0, 2.5, 1.5, 3.0, 2.0]):
+        path = str(tmp_path / f"clip{index}.wav")
+        samples = np.random.default_rng(index).normal(0.0, 0.1, int(seconds * SAMPLE_RATE)).astype("<f4")
+        with open(path, "wb") as f:
+            f.write(wav_header(len(samples)))
+            f.write(samples.tobytes())
+        paths.append(path)
+    words = "one two three four five".split()
+    return [utterance(f"u{index}", " ".join(words[:index + 1]), path) for index, path in enumerate(paths)]
+
+
+def test_batch_emissions_go_batch_size_at_a_time(clips):
+    backend = StubBackend()
+    results = Aligner(backend, "auto").align_batch(clips, batch_size=2)
+    # Three forward passes for five clips, and the same marks as aligning each on its own
+    assert backend.calls == 3
+    single = Aligner(StubBackend(), "numpy")
+    assert results == {item["utt_id"]: single.align(item["text"], item["audio_filepath"]) for item in clips}
+
+
+def test_batch_reads_cached_emissions(tmp_path, clips):
+    backend = StubBackend()
+    aligner = Aligner(backend, "numpy", emission_cache=EmissionCache(str(tmp_path / "cache")))
+    aligner.align_batch(clips[:2], batch_size=8)
+    assert backend.calls == 1
+    results = aligner.align_batch(clips, batch_size=8)
+    # Only the three new clips are computed, in one pass
+    assert backend.calls == 2
+    assert aligner.emission_cache.stats() == {'hits': 2, 'misses': 5}
+    assert list(results) == [item["utt_id"] for item in clips]
+
+
+def test_batch_checks_its_input(clips):
+    aligner = Aligner(StubBackend(), "numpy")
+    with pytest.raises(ValueError):
+        aligner.align_batch([clips[0], clips[0]])
+    with pytest.raises(FileNotFoundError):
+        aligner.align_batch([utterance("missing", "word", "missing.wav")])
@@ -0,0 +1,137 @@
+import random
+
+import numpy as np
+import pytest
+
+import cpu_inference
+from aligner import Aligner, StubBackend
+from audio_ingest import SAMPLE_RATE, wav_header
+from cpu_inference import (CPUProfile, CharTokenizer, ModuleBackend, ExportedBackend, export_backend,
+                           boundary_deviation, random_encoder)
+
+VOCABULARY = StubBackend.vocabulary
+
+
+@pytest.fixture
+def torch():
+    return pytest.importorskip("torch")
+
+
+@pytest.fixture
+def noise(tmp_path):
+    path = str(tmp_path / "noise.wav")
+    samples = np.random.default_rng(0).normal(0.0, 0.1, 3 * SAMPLE_RATE).astype("<f4")
+    with open(path, "wb") as f:
+        f.write(wav_header(len(samples)))
+        f.write(samples.tobytes())
+    return path
+
+
+def random_backend(profile=None, tokenizer=None):
+    return ModuleBackend(random_encoder(len(VOCABULARY) + 1, hidden=64, layers=2),
+                         tokenizer or CharTokenizer(VOCABULARY), len(VOCABULARY), StubBackend.frame_duration,
+                         "random_encoder", profile=profile)
+
+
+def transcript(words, seed=0):
+    rng = random.Random(seed)
+    return " ".join("".join(rng.choice(VOCABULARY[:-1]) for _ in range(rng.randint(2, 5))) for _ in range(words))
+
+
+def test_quantize(torch, noise):
+    full = random_backend()
+    quantized = random_backend(CPUProfile(quantize=True, intra_op_threads=2))
+    quantized.load()
+    assert quantized.name == "random_encoder+int8"
+    assert isinstance(quantized.module.input, torch.ao.nn.quantized.dynamic.Linear)
+    assert all(isinstance(layer, torch.ao.nn.quantized.dynamic.Linear) for layer in quantized.module.layers)
+    assert torch.get_num_threads() == 2
+
+    reference, emissions = full.emissions(noise), quantized.emissions(noise)
+    assert emissions.shape == reference.shape == (int(3 / StubBackend.frame_duration), len(VOCABULARY) + 1)
+    assert np.allclose(np.logaddexp.reduce(emissions, axis=1), 0.0, atol=1e-4)
+    text = transcript(8)
+    deviation = boundary_deviation(Aligner(full, "numpy").align(text, noise),
+                                   Aligner(quantized, "numpy").align(text, noise))
+    assert deviation['words'] == 8
+
+
+@pytest.mark.parametrize("quantize", [False, True])
+def test_export_and_load(torch, tmp_path, noise, quantize):
+    backend = random_backend(CPUProfile(quantize=quantize))
+    path = export_backend(backend, str(tmp_path / "model.ts"), example_seconds=2.0)
+    exported = ExportedBackend(path, profile=CPUProfile())
+    exported.load()
+    assert exported.name == backend.name
+    assert exported.blank_id == backend.blank_id
+    assert exported.frame_duration == backend.frame_duration
+    assert exported.tokenize("Don't") == backend.tokenize("Don't")
+    # Traced on 2 s of audio, the graph still follows the length of the input
+    assert np.allclose(exported.emissions(noise), backend.emissions(noise), atol=1e-4)
+    text = transcript(8)
+    deviation = boundary_deviation(Aligner(backend, "numpy").align(text, noise),
+                                   Aligner(exported, "numpy").align(text, noise))
+    assert deviation['max_ms'] <= 1000 * StubBackend.frame_duration
+
+
+def test_batch_emissions(torch, tmp_path, noise):
+    # Zero padding to the longest clip leaves each clip's emissions as they are on their own
+    short = str(tmp_path / "short.wav")
+    samples = np.random.default_rng(1).normal(0.0, 0.1, SAMPLE_RATE).astype("<f4")
+    with open(short, "wb") as f:
+        f.write(wav_header(len(samples)))
+        f.write(samples.tobytes())
+    backend = random_backend()
+    batch = backend.batch_emissions([noise, short])
+    assert [len(log_probs) for log_probs in batch] == [37, 12]
+    assert np.allclose(batch[0], backend.emissions(noise), atol=1e-5)
+    assert np.allclose(batch[1], backend.emissions(short), atol=1e-5)
+
+
+class ProtoTokenizer:
+    def __init__(self, model_proto):
+        self.model_proto = model_proto
+
+    def __call__(self, word):
+        return [len(word)]
+
+    def spec(self):
+        return {'type': "sentencepiece"}, self.model_proto
+
+
+@pytest.mark.parametrize("as_text", [False, True])
+def test_exported_tokenizer_model(torch, tmp_path, monkeypatch, as_text):
+    # The tokenizer model reaches SentencePieceTokenizer as bytes, whether torch returns the
+    # extra files as bytes or as str
+    model_proto = b"\x0a\x05proto" + (b"" if as_text else b"\xff\x00")
+    path = export_backend(random_backend(tokenizer=ProtoTokenizer(model_proto)), str(tmp_path / "model.ts"), 2.0)
+    if as_text:
+        jit_load = torch.jit.load
+
+        def load(*args, _extra_files, **kwargs):
+            module = jit_load(*args, _extra_files=_extra_files, **kwargs)
+            for name, content in _extra_files.items():
+                if isinstance(content, bytes):
+                    _extra_files[name] = content.decode("utf-8")
+            return module
+
+        monkeypatch.setattr(torch.jit, "load", load)
+    monkeypatch.setattr(cpu_inference, "SentencePieceTokenizer", ProtoTokenizer)
+    exported = ExportedBackend(path)
+    exported.load()
+    assert exported.tokenizer.model_proto == model_proto
+    assert exported.tokenize("word") == [4]
+
+
+def test_boundary_deviation():
+    reference = [{'s': 0.0, 'e': 0.5, 'w': "a"}, {'s': 0.5, 'e': 1.0, 'w': "b"}]
+    marks = [{'s': 0.0, 'e': 0.52, 'w': "a"}, {'s': 0.56, 'e': 1.0, 'w': "b"}]
+    deviation = boundary_deviation(reference, marks)
+    assert deviation['words'] == 2
+    assert deviation['mean_ms'] == pytest.approx(20.0)
+    assert deviation['max_ms'] == pytest.approx(60.0)
+    assert deviation['p95_ms'] == pytest.approx(54.0)
+    assert boundary_deviation(reference, reference)['max_ms'] == 0.0
+    assert boundary_deviation([], []) == {'words': 0, 'mean_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+    with pytest.raises(ValueError):
+        boundary_deviation(reference, marks[:1])
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from aligner import Aligner, StubBackend
+from ctc_viterbi import viterbi_states, align_words, synthetic_emissions
+
+BLANK = 5
+
+
+def path_score(log_probs, tokens, path):
+    ext = np.full(2 * len(tokens) + 1, BLANK)
+    ext[1::2] = tokens
+    return float(log_probs[np.arange(len(path)), ext[path]].sum())
+
+
+def assert_legal(path, tokens):
+    # Starts on the first blank or token, ends on the last, and only moves forward by one
+    # state, or by two onto a token that differs from the one before it
+    states = 2 * len(tokens) + 1
+    assert path[0] in (0, 1) and path[-1] in (states - 1, states - 2)
+    steps = np.diff(path)
+    assert ((steps >= 0) & (steps <= 2)).all()
+    for state in path[1:][steps == 2]:
+        assert state % 2 == 1 and (state == 1 or tokens[(state - 1) // 2] != tokens[(state - 3) // 2])
+
+
+@pytest.mark.parametrize("band", [None, 2, 8])
+def test_recovers_known_alignment(band):
+    frames = [BLANK, 0, 0, 1, BLANK, BLANK, 2, 2, 2, BLANK, 3, 4, BLANK]
+    marks = align_words(synthetic_emissions(frames, BLANK + 1, BLANK, noise=0.5), [[0, 1], [2], [3, 4]],
+                        ["ab", "c", "de"], BLANK, 0.1, band)
+    assert marks == [{'s': 0.1, 'e': 0.4, 'w': "ab"}, {'s': 0.6, 'e': 0.9, 'w': "c"}, {'s': 1.0, 'e': 1.2, 'w': "de"}]
+
+
+def test_repeated_tokens_need_a_blank():
+    frames = [0, BLANK, 0, BLANK]
+    path = viterbi_states(synthetic_emissions(frames, BLANK + 1, BLANK), [0, 0], BLANK)
+    assert path.tolist() == [1, 2, 3, 4]
+    with pytest.raises(ValueError):
+        viterbi_states(synthetic_emissions([0, 0], BLANK + 1, BLANK), [0, 0], BLANK)
+
+
+def test_empty_emissions():
+    with pytest.raises(ValueError):
+        viterbi_states(np.zeros((0, BLANK + 1)), [0], BLANK)
+
+
+def test_band_matches_full_search_or_raises():
+    # Audio barely longer than the tokens, so the diagonal moves up to two states a frame
+    rng = np.random.default_rng(0)
+    aligned = 0
+    for _ in range(2000):
+        n = int(rng.integers(1, 8))
+        tokens = rng.integers(0, BLANK, n)
+        frames = int(rng.integers(n, 2 * n + 2))
+        log_probs = np.log(rng.dirichlet(np.ones(BLANK + 1), frames))
+        band = int(rng.integers(1, 4))
+        try:
+            path = viterbi_states(log_probs, tokens, BLANK, band)
+        except ValueError:
+            continue
+        assert_legal(path, tokens)
+        full = viterbi_states(log_probs, tokens, BLANK)
+        assert path_score(log_probs, tokens, path) <= path_score(log_probs, tokens, full) + 1e-9
+        aligned += 1
+    assert aligned > 1000
+
+
+def test_band_steeper_than_one_state_a_frame():
+    # Eight tokens in twelve frames: the banded path is legal (it used to index past the band)
+    log_probs = synthetic_emissions([0, 1, 2, 3, 27, 4, 5, 6, 7, 27, 27, 27], 28, 27)
+    tokens = list(range(8))
+    assert_legal(viterbi_states(log_probs, np.array(tokens), 27, band=1), tokens)
+    marks = Aligner(StubBackend(), "numpy", band=1).align_emissions("abcd efgh", log_probs)
+    assert [mark['w'] for mark in marks] == ["abcd", "efgh"]
+
+
+def test_band_too_narrow_falls_back():
+    # "aaabc" needs all seven frames, two of them blanks, which the band cannot follow
+    log_probs = synthetic_emissions([0, 27, 0, 27, 0, 1, 2], 28, 27)
+    with pytest.raises(ValueError):
+        viterbi_states(log_probs, [0, 0, 0, 1, 2], 27, band=1)
+    banded = Aligner(StubBackend(), "numpy", band=1).align_emissions("aaabc", log_probs)
+    assert banded == Aligner(StubBackend(), "numpy").align_emissions("aaabc", log_probs)
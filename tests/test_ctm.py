@@ -0,0 +1,35 @@
+import pytest
+
+from ctm import iter_ctm, read_ctm_columns, read_ctm_marks
+
+
+@pytest.mark.parametrize("text", [
+    # The layout align.py writes
+    "".join(f"utt 1 {i / 10:.2f} 0.10 w{i}▁ NA lex NA\n" for i in range(50)),
+    # Widths 8/6/10/8
+    "u 1 0.00 0.10 a NA lex NA\nu 1 0.10 0.10 b NA\nu 1 0.20 0.10 c NA lex NA lex NA\nu 1 0.30 0.10 d NA lex NA\n",
+    # Doubled spaces, a tab, a blank line, a short line, blank tokens and no final newline
+    "u 1 0.00 0.10 a NA lex NA\nu  1 0.10 0.10 b NA lex\tNA\n\nu 1 0.2\nu 1 0.20 0.10 <b> NA lex NA\nu 1 0.30 0.10 d NA",
+])
+def test_columns_match_line_by_line(tmp_path, text):
+    path = tmp_path / "utt.ctm"
+    path.write_text(text)
+    expected = list(iter_ctm(path))
+    columns = read_ctm_columns([path])
+    assert list(zip(columns['utt'], columns['s'].tolist(), columns['e'].tolist(), columns['w'])) == expected
+    assert read_ctm_marks([path]) == [{'s': s, 'e': e, 'w': w} for _, s, e, w in expected]
+
+
+def test_end_times_are_rounded(tmp_path):
+    path = tmp_path / "utt.ctm"
+    path.write_text("u 1 0.10 0.20 a NA lex NA\n")
+    assert read_ctm_marks([path]) == [{'s': 0.1, 'e': 0.3, 'w': "a"}]
+
+
+def test_columns_are_ordered_by_utterance(tmp_path):
+    (tmp_path / "b.ctm").write_text("b 1 0.00 0.10 x NA lex NA\n")
+    (tmp_path / "a.ctm").write_text("a 1 0.50 0.10 z NA lex NA\na 1 0.00 0.10 y NA lex NA\n")
+    columns = read_ctm_columns([str(tmp_path / "b.ctm"), str(tmp_path / "a.ctm")])
+    assert columns['utt'] == ["a", "a", "b"]
+    assert columns['w'] == ["y", "z", "x"]
+    assert columns['s'].tolist() == [0.0, 0.5, 0.0]
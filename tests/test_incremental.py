@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from aligner import Aligner, StubBackend
+from audio_ingest import SAMPLE_RATE, wav_header
+from incremental import realign_edit
+
+WORDS = "one two three four five six seven eight nine ten eleven twelve".split()
+STEP = 0.8
+
+
+@pytest.fixture
+def audio(tmp_path):
+    path = str(tmp_path / "audio.wav")
+    samples = np.random.default_rng(0).normal(0.0, 0.1, int(len(WORDS) * STEP * SAMPLE_RATE)).astype("<f4")
+    with open(path, "wb") as f:
+        f.write(wav_header(len(samples)))
+        f.write(samples.tobytes())
+    return path
+
+
+def previous_marks(words=WORDS):
+    return [{'s': round(i * STEP, 2), 'e': round((i + 1) * STEP, 2), 'w': word} for i, word in enumerate(words)]
+
+
+def check(marks, new_words, kept):
+    # Every word has a mark in order, the words kept as anchors did not move
+    assert [mark['w'] for mark in marks] == new_words
+    assert all(mark['s'] <= mark['e'] for mark in marks)
+    assert all(a['e'] <= b['s'] + 1e-9 for a, b in zip(marks, marks[1:]))
+    for new_index, old_index in kept.items():
+        assert (marks[new_index]['s'], marks[new_index]['e']) == (previous_marks()[old_index]['s'],
+                                                                   previous_marks()[old_index]['e'])
+
+
+@pytest.mark.parametrize("engine", ["numpy", "nemo"])
+def test_replace(audio, engine):
+    new_words = WORDS[:5] + ["fife"] + WORDS[6:]
+    marks = realign_edit(Aligner(StubBackend(), engine), previous_marks(), " ".join(WORDS), " ".join(new_words),
+                         audio, context=1)
+    check(marks, new_words, {j: j for j in range(len(WORDS)) if abs(j - 5) > 1})
+    assert previous_marks()[3]['e'] <= marks[4]['s'] and marks[6]['e'] <= previous_marks()[7]['s']
+
+
+@pytest.mark.parametrize("engine", ["numpy", "nemo"])
+def test_insert(audio, engine):
+    new_words = WORDS[:6] + ["and", "a", "half"] + WORDS[6:]
+    marks = realign_edit(Aligner(StubBackend(), engine), previous_marks(), " ".join(WORDS), " ".join(new_words),
+                         audio, context=0)
+    # The words either side give up their marks to make room; those further out keep them
+    check(marks, new_words, {j: j for j in range(5)} | {j + 3: j for j in range(7, len(WORDS))})
+
+
+def test_delete(audio):
+    new_words = WORDS[:4] + WORDS[6:]
+    aligner = Aligner(StubBackend(), "numpy")
+    marks = realign_edit(aligner, previous_marks(), " ".join(WORDS), " ".join(new_words), audio, context=0)
+    # Nothing to align: the remaining words keep their marks
+    assert marks == [dict(mark) for i, mark in enumerate(previous_marks()) if i not in (4, 5)]
+    marks = realign_edit(aligner, previous_marks(), " ".join(WORDS), " ".join(new_words), audio, context=1)
+    check(marks, new_words, {j: j for j in range(3)} | {j: j + 2 for j in range(5, len(new_words))})
+
+
+def test_widening_joins_the_next_changed_run(audio):
+    # The long replacement cannot fit in its 0.8 s gap; widening twice reaches the edit at
+    # index 7, which has no marks yet and is aligned together with it
+    new_words = list(WORDS)
+    new_words[3] = "abcdefghijklmnopqrstuvwxyz"
+    new_words[7] = "ate"
+    marks = realign_edit(Aligner(StubBackend(), "numpy"), previous_marks(), " ".join(WORDS), " ".join(new_words),
+                         audio, context=0)
+    assert [mark['w'] for mark in marks] == new_words
+    assert all(mark is not None for mark in marks)
+    assert all(a['e'] <= b['s'] + 1e-9 for a, b in zip(marks, marks[1:]))
+    assert marks[3]['e'] - marks[3]['s'] >= 26 * StubBackend.frame_duration - 1e-9
+
+
+def test_insert_into_tight_gap(audio):
+    # Nothing separates the inserted words from their neighbours; the first run widens into
+    # the second
+    new_words = WORDS[:2] + ["abcdefghijklmnopqrstuvwxyz"] + WORDS[2:5] + ["zyxwvutsrq"] + WORDS[5:]
+    marks = realign_edit(Aligner(StubBackend(), "numpy"), previous_marks(), " ".join(WORDS), " ".join(new_words),
+                         audio, context=0)
+    assert [mark['w'] for mark in marks] == new_words
+    assert all(a['e'] <= b['s'] + 1e-9 for a, b in zip(marks, marks[1:]))
+
+
+def test_wrong_number_of_marks(audio):
+    with pytest.raises(ValueError):
+        realign_edit(Aligner(StubBackend(), "numpy"), previous_marks()[:-1], " ".join(WORDS), "one", audio)
@@ -0,0 +1,91 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+from aligner import Aligner, StubBackend
+from audio_ingest import SAMPLE_RATE, wav_header, load_samples
+from ctc_viterbi import synthetic_emissions
+from emission_cache import EmissionCache
+from long_align import align_long
+
+FRAME = 0.04
+FRAME_SAMPLES = int(FRAME * SAMPLE_RATE)
+
+
+class FrameBackend(StubBackend):
+    # Every sample of the audio holds the index of its frame, so any slice of it maps back
+    # onto the rows of one emission matrix for the whole file
+    frame_duration = FRAME
+
+    def __init__(self, log_probs):
+        super().__init__()
+        self.log_probs = log_probs
+
+    def emissions(self, audio_path):
+        samples = np.asarray(load_samples(audio_path))
+        frames = samples[:len(samples) // FRAME_SAMPLES * FRAME_SAMPLES].reshape(-1, FRAME_SAMPLES)[:, 0]
+        return self.log_probs[frames.astype(np.int64)]
+
+
+def speech(seconds, variation, seed):
+    # Peaky emissions of random words whose speaking rate drifts by +-variation
+    rng = random.Random(seed)
+    vocabulary = StubBackend.vocabulary[:-1]
+    blank = len(StubBackend.vocabulary)
+    total = int(seconds / FRAME)
+    path, words, truth = [], [], []
+    while True:
+        length = rng.randint(2, 7)
+        word = rng.choice(vocabulary)
+        while len(word) < length:
+            # No doubled letters: CTC needs a blank between them
+            word += rng.choice(vocabulary.replace(word[-1], ""))
+        rate = 1 + variation * np.sin(len(words) / 40)
+        gap = max(int(round(rng.randint(2, 6) * rate)), 1)
+        per_char = max(int(round(2 * rate)), 1)
+        if len(path) + gap + per_char * len(word) + 5 > total:
+            break
+        path += [blank] * gap
+        start = len(path)
+        for c in word:
+            path += [vocabulary.index(c)] * per_char
+        truth.append((round(start * FRAME, 2), round(len(path) * FRAME, 2)))
+        words.append(word)
+    path += [blank] * (total - len(path))
+    return synthetic_emissions(path, blank + 1, blank), words, truth
+
+
+@pytest.mark.parametrize("variation", [0.0, 0.25, 0.5])
+def test_windows_match_full_pass(tmp_path, variation):
+    log_probs, words, truth = speech(600, variation, seed=1)
+    audio_path = str(tmp_path / "speech.wav")
+    samples = np.repeat(np.arange(len(log_probs), dtype="<f4"), FRAME_SAMPLES)
+    with open(audio_path, "wb") as f:
+        f.write(wav_header(len(samples)))
+        f.write(samples.tobytes())
+    aligner = Aligner(FrameBackend(log_probs), "numpy")
+
+    full = aligner.align_emissions(" ".join(words), log_probs)
+    windowed = align_long(aligner, " ".join(words), audio_path, window=120, overlap=15)
+
+    assert [mark['w'] for mark in windowed] == words
+    expected = np.array(truth)
+    assert np.abs(np.array([[m['s'], m['e']] for m in full]) - expected).max() < FRAME / 2
+    assert np.abs(np.array([[m['s'], m['e']] for m in windowed]) - expected).max() <= FRAME + 1e-6
+
+
+def test_windows_stay_out_of_the_emission_cache(tmp_path):
+    # Window slices are never asked for again, so they must not evict whole files
+    audio_path = str(tmp_path / "chapter.wav")
+    with open(audio_path, "wb") as f:
+        f.write(wav_header(300 * SAMPLE_RATE))
+        f.write(bytes(4 * 300 * SAMPLE_RATE))
+    cache = EmissionCache(str(tmp_path / "cache"))
+    aligner = Aligner(StubBackend(), "numpy", emission_cache=cache)
+    text = " ".join(speech(300, 0.0, seed=2)[1])
+    marks = align_long(aligner, text, audio_path, window=120, overlap=15)
+    assert len(marks) == len(text.split())
+    assert os.listdir(cache.cache_dir) == []
+    assert cache.stats() == {'hits': 0, 'misses': 0}
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from marks_format import (to_columnar, from_columnar, encode_binary, decode_binary, read_binary, write_binary,
+                          load_binary, read_char_offsets, format_marks)
+from subtitles import iter_marks, load_marks
+
+MARKS = [
+    {'s': 0.0, 'e': 0.32, 'w': "the"},
+    {'s': 0.32, 'e': 0.71, 'w': "café"},
+    {'s': 0.71, 'e': 0.71, 'w': "the"},
+    {'s': 0.8, 'e': 1.29, 'w': "東京"},
+    {'s': 1.29, 'e': 2.05, 'w': "naïve/nn"},
+    {'s': 3599.99, 'e': 3600.07, 'w': "the"},
+]
+OFFSET_MARKS = [dict(mark, char_start=i * 5, char_end=i * 5 + 3) for i, mark in enumerate(MARKS)]
+
+
+def through_json(value):
+    return json.loads(json.dumps(value))
+
+
+@pytest.mark.parametrize("marks", [MARKS, OFFSET_MARKS, []])
+def test_json(marks):
+    assert through_json(format_marks(marks, "json")) == marks
+
+
+@pytest.mark.parametrize("marks", [MARKS, OFFSET_MARKS, []])
+def test_columnar(marks):
+    columns = format_marks(marks, "columnar")
+    assert ('char_start' in columns) == bool(marks and 'char_start' in marks[0])
+    assert from_columnar(through_json(columns)) == marks
+
+
+@pytest.mark.parametrize("marks", [MARKS, OFFSET_MARKS, []])
+def test_binary(tmp_path, marks):
+    encoded = format_marks(marks, "binary")
+    assert len(encoded) % 4 == 0
+    assert decode_binary(encoded) == marks
+    path = str(tmp_path / "marks.bin")
+    write_binary(marks, path)
+    assert load_binary(path) == marks
+
+
+def test_binary_stores_each_word_once():
+    starts, ends, word_index, words = read_binary(encode_binary(MARKS))
+    assert words == ["the", "café", "東京", "naïve/nn"]
+    assert word_index.tolist() == [0, 1, 0, 2, 3, 0]
+    assert starts.tolist() == [0, 320, 710, 800, 1290, 3599990]
+
+
+def test_binary_offsets_are_flagged(tmp_path):
+    assert read_char_offsets(encode_binary(MARKS)) is None
+    char_start, char_end = read_char_offsets(encode_binary(OFFSET_MARKS))
+    assert char_start.tolist() == [mark['char_start'] for mark in OFFSET_MARKS]
+    assert char_end.tolist() == [mark['char_end'] for mark in OFFSET_MARKS]
+    # Readers that only want times and words see the same sections either way
+    assert [array.tolist() for array in read_binary(encode_binary(OFFSET_MARKS))[:3]] == \
+           [array.tolist() for array in read_binary(encode_binary(MARKS))[:3]]
+    path = str(tmp_path / "marks.bin")
+    write_binary(OFFSET_MARKS, path)
+    assert load_marks(path) == path
+    assert list(iter_marks(path)) == MARKS
+
+
+def test_not_a_marks_file():
+    with pytest.raises(ValueError):
+        decode_binary(b"JSON" + bytes(12))
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        format_marks(MARKS, "csv")
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from marks_index import MarksIndex
+
+
+def random_marks(rng, count, overlapping):
+    # Times in hundredths like real marks; overlapping marks can run over several later ones
+    marks = []
+    start = 0
+    for i in range(count):
+        start += int(rng.integers(0, 40))
+        length = int(rng.integers(0, 300 if overlapping and rng.random() < 0.2 else 40))
+        marks.append({'s': start / 100, 'e': (start + length) / 100, 'w': f"w{int(rng.integers(0, 20))}"})
+    if overlapping:
+        rng.shuffle(marks)
+    return marks
+
+
+def in_start_order(marks):
+    return sorted(marks, key=lambda mark: round(mark['s'] * 1000))
+
+
+def brute_word_at(ordered, t):
+    covering = [mark for mark in ordered if mark['s'] <= t < mark['e']]
+    return covering[-1] if covering else None
+
+
+def brute_words_between(ordered, t0, t1):
+    return [mark for mark in ordered if mark['e'] >= t0 and mark['s'] <= t1]
+
+
+def queries(rng, marks):
+    # Every mark boundary, and random times in hundredths and thousandths around the marks
+    end = max((mark['e'] for mark in marks), default=0) + 1
+    boundaries = [mark[key] for mark in marks for key in ('s', 'e')]
+    return boundaries + [int(t) / 100 for t in rng.integers(-100, end * 100, 200)] + \
+        [int(t) / 1000 for t in rng.integers(0, end * 1000, 200)]
+
+
+@pytest.mark.parametrize("overlapping", [False, True])
+@pytest.mark.parametrize("seed", range(5))
+def test_against_brute_force(tmp_path, overlapping, seed):
+    rng = np.random.default_rng(seed)
+    marks = random_marks(rng, 300, overlapping)
+    ordered = in_start_order(marks)
+    path = str(tmp_path / "marks.bin")
+    MarksIndex.from_marks(marks).save(path)
+    for index in (MarksIndex.from_marks(marks), MarksIndex.load(path)):
+        assert len(index) == len(marks)
+        times = queries(rng, marks)
+        for t in times:
+            assert index.word_at(t) == brute_word_at(ordered, t)
+        for t0, t1 in zip(times, rng.permutation(times)):
+            t0, t1 = min(t0, t1), max(t0, t1)
+            assert index.words_between(t0, t1) == brute_words_between(ordered, t0, t1)
+
+
+def test_boundaries():
+    index = MarksIndex.from_marks([{'s': 0.5, 'e': 0.57, 'w': "a"}, {'s': 0.57, 'e': 1.0, 'w': "b"}])
+    assert index.word_at(0.57)['w'] == "b"
+    assert index.word_at(0.5699)['w'] == "a"
+    assert index.word_at(1.0) is None
+    assert index.word_at(0.49) is None
+    assert [mark['w'] for mark in index.words_between(0.57, 0.57)] == ["a", "b"]
+    assert index.words_between(1.01, 2.0) == []
+
+
+def test_empty():
+    index = MarksIndex.from_marks([])
+    assert len(index) == 0
+    assert index.word_at(1.0) is None
+    assert index.words_between(0.0, 10.0) == []
@@ -0,0 +1,67 @@
+import re
+
+import pytest
+
+from normalize import normalize
+
+TEXTS = [
+    "",
+    "one",
+    "  leading and trailing  ",
+    "one\ntwo\n\nthree\n\n\nfour\n\n\n\n\nfive",
+    "windows\r\nline\r\n\r\nbreaks\r\n",
+    "first.<p>Second paragraph<p><p>third",
+    "tabs\tand\x0bvertical\x0cfeeds",
+    "non breaking em　ideographic line\u0085next",
+    "café naïve 東京 \U0001f600 emoji",
+    "mixed \n \n\t\n<p>  \n\n\nend",
+    "<p",
+    "p>",
+    "<<p>>",
+    "\n",
+    " private use ",
+]
+
+
+def legacy_preprocess(text):
+    # The regex chain processMarks used before normalize.py
+    text = re.sub(r'\n{3,}', '/nn/nn/nn', text)
+    text = re.sub(r'\n{2}', '/nn/nn', text)
+    text = re.sub(r'\n', '/nn', text)
+    text = re.sub(r'\s+', ' ', text)
+    return text.replace('<p>', '\n\n')
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_matches_regex_chain(text):
+    assert normalize(text).text == legacy_preprocess(text)
+
+
+def test_matches_regex_chain_on_prose():
+    words = "the quick brown fox jumps over a lazy dog".split()
+    separators = [" ", "  ", "\n", "\n\n", "\n\n\n\n", ".<p>", "\r\n", "\t", " ", " \n "]
+    text = "".join(word + separators[(i * 7) % len(separators)] for i, word in enumerate(words * 40))
+    assert normalize(text).text == legacy_preprocess(text)
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_word_spans(text):
+    # Each aligner word comes from the source slice it points at
+    normalized = normalize(text)
+    words, char_starts, char_ends = normalized.word_spans("|")
+    assert words == normalized.text.split()
+    assert [legacy_preprocess(text[start:end]) for start, end in zip(char_starts, char_ends)] == words
+    assert all(a < b for a, b in zip(char_ends, char_starts[1:]))
+
+
+@pytest.mark.parametrize("text, words, slices", [
+    # \r is whitespace and \n a /nn token, so the /nn sticks to the next word
+    ("One\r\ntwo three<p>four five\n\n\nsix.", ["One", "/nntwo", "three", "four", "five/nn/nn/nnsix."],
+     ["One", "\ntwo", "three", "four", "five\n\n\nsix."]),
+    ("a\u00a0b\u2003\u2003c\u3000d\u0085e", ["a", "b", "c", "d", "e"], ["a", "b", "c", "d", "e"]),
+    ("<p>café|東京 \U0001f600", ["café", "東京", "\U0001f600"], ["café", "東京", "\U0001f600"]),
+])
+def test_word_spans_source_slices(text, words, slices):
+    result, char_starts, char_ends = normalize(text).word_spans("|")
+    assert result == words
+    assert [text[start:end] for start, end in zip(char_starts, char_ends)] == slices
@@ -0,0 +1,116 @@
+import os
+import time
+
+import pytest
+
+from emission_cache import atomic_write
+from result_store import OUTPUT_DIR_SUFFIX, ResultStore, Sweeper, sweep_outputs
+from timings import MetricsSink
+
+MARKS = [{'s': 0.0, 'e': 0.4, 'w': "one"}, {'s': 0.4, 'e': 0.9, 'w': "two"}]
+
+
+def age(path, atime_ago, mtime_ago):
+    now = time.time()
+    os.utime(path, (now - atime_ago, now - mtime_ago))
+
+
+def test_evicts_least_recently_used(tmp_path):
+    store = ResultStore(str(tmp_path), max_entries=3, ttl=None)
+    for key in "abc":
+        store.put(key, MARKS)
+    # Written oldest first, but a was read last: b is the least recently used
+    age(store.path("a"), 10, 300)
+    age(store.path("b"), 200, 200)
+    age(store.path("c"), 100, 100)
+    store.put("d", MARKS)
+    assert sorted(os.listdir(tmp_path)) == ["a.json", "c.json", "d.json"]
+
+
+def test_hit_moves_entry_to_the_front(tmp_path):
+    store = ResultStore(str(tmp_path), max_entries=2, ttl=None)
+    store.put("a", MARKS)
+    store.put("b", MARKS)
+    age(store.path("a"), 200, 200)
+    age(store.path("b"), 100, 100)
+    assert store.get("a") == MARKS
+    # The hit sets a's atime and leaves its mtime, the write time the TTL goes by
+    assert time.time() - os.stat(store.path("a")).st_atime < 10
+    assert time.time() - os.stat(store.path("a")).st_mtime > 150
+    store.put("c", MARKS)
+    assert sorted(os.listdir(tmp_path)) == ["a.json", "c.json"]
+    assert store.stats() == {'hits': 1, 'misses': 0}
+
+
+def test_ttl(tmp_path):
+    store = ResultStore(str(tmp_path), ttl=60.0)
+    store.put("old", MARKS)
+    store.put("new", MARKS)
+    store.put("stale", MARKS)
+    # Recent reads do not keep an entry alive past its TTL
+    age(store.path("old"), 0, 120)
+    age(store.path("stale"), 0, 90)
+    assert store.get("old") is None
+    assert not os.path.exists(store.path("old"))
+    assert store.get("new") == MARKS
+    assert store.stats() == {'hits': 1, 'misses': 1}
+    assert store.expire() == 1
+    assert sorted(os.listdir(tmp_path)) == ["new.json"]
+
+
+def test_result_key(tmp_path):
+    audio = tmp_path / "a.wav"
+    audio.write_bytes(b"audio")
+    store = ResultStore(str(tmp_path / "store"))
+    key = store.result_key(str(audio), "one two", "numpy")
+    assert key == store.result_key(str(audio), "one two", "numpy")
+    assert key != store.result_key(str(audio), "one two", "nemo")
+    assert key != store.result_key(str(audio), "one three", "numpy")
+
+
+def test_sweep_outputs(tmp_path):
+    base, other = tmp_path / "base", tmp_path / "other"
+    old, recent, kept = base / ("old" + OUTPUT_DIR_SUFFIX), base / ("recent" + OUTPUT_DIR_SUFFIX), base / "old_data"
+    for path in (old / "ctm", recent, kept, other / ("x" + OUTPUT_DIR_SUFFIX)):
+        path.mkdir(parents=True)
+    (old / "ctm" / "words.ctm").write_text("")
+    (base / ("file" + OUTPUT_DIR_SUFFIX)).write_text("")
+    for path in (old, kept, base / ("file" + OUTPUT_DIR_SUFFIX), other / ("x" + OUTPUT_DIR_SUFFIX)):
+        age(str(path), 7200, 7200)
+    assert sweep_outputs([str(base), str(tmp_path / "missing")], max_age=3600) == 1
+    assert sorted(os.listdir(base)) == sorted(["recent" + OUTPUT_DIR_SUFFIX, "old_data", "file" + OUTPUT_DIR_SUFFIX])
+    assert os.listdir(other) == ["x" + OUTPUT_DIR_SUFFIX]
+
+
+def test_sweeper(tmp_path):
+    store = ResultStore(str(tmp_path / "store"), ttl=60.0)
+    store.put("old", MARKS)
+    age(store.path("old"), 0, 120)
+    (tmp_path / ("a" + OUTPUT_DIR_SUFFIX)).mkdir()
+    age(str(tmp_path / ("a" + OUTPUT_DIR_SUFFIX)), 7200, 7200)
+    sweeper = Sweeper([str(tmp_path)], max_age=3600, result_store=store)
+    assert sweeper.sweep() == {'output_dirs': 1, 'results': 1}
+    assert os.listdir(tmp_path) == ["store"]
+
+
+def test_failed_writes_leave_no_temporary_files(tmp_path):
+    store = ResultStore(str(tmp_path / "store"))
+    store.put("a", MARKS)
+    with pytest.raises(TypeError):
+        store.put("a", [{'s': object()}])
+    # The entry already there is untouched
+    assert os.listdir(store.cache_dir) == ["a.json"]
+    assert store.get("a") == MARKS
+
+    path = str(tmp_path / "out.txt")
+    with pytest.raises(RuntimeError):
+        with atomic_write(path) as f:
+            f.write("half")
+            raise RuntimeError("interrupted")
+    assert os.listdir(tmp_path) == ["store"]
+
+    metrics = MetricsSink(str(tmp_path / "metrics.prom"))
+    metrics.prometheus_text = lambda: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        metrics.write_prometheus()
+    assert os.listdir(tmp_path) == ["store"]
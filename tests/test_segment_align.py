@@ -0,0 +1,56 @@
+import os
+import random
+
+import numpy as np
+
+from aligner import Aligner, StubBackend
+from audio_ingest import SAMPLE_RATE, wav_header
+from emission_cache import EmissionCache
+from segment_align import Segmenter
+
+
+def write_speech(path, seconds, pauses, seed=0):
+    # Bursts of noise 0.3 s long, 0.1 s apart, with silent [start, end) pauses
+    rng = np.random.default_rng(seed)
+    samples = rng.normal(0.0, 0.1, int(seconds * SAMPLE_RATE)).astype("<f4")
+    position = np.arange(len(samples)) / SAMPLE_RATE
+    samples[position % 0.4 >= 0.3] *= 1e-3
+    for start, end in pauses:
+        samples[int(start * SAMPLE_RATE):int(end * SAMPLE_RATE)] *= 1e-3
+    with open(path, "wb") as f:
+        f.write(wav_header(len(samples)))
+        f.write(samples.tobytes())
+    return path
+
+
+def words(count, length, seed):
+    rng = random.Random(seed)
+    vocabulary = StubBackend.vocabulary[:-1]
+    result = []
+    for _ in range(count):
+        word = rng.choice(vocabulary)
+        while len(word) < length:
+            # No doubled letters, so a word needs no more frames than it has letters
+            word += rng.choice(vocabulary.replace(word[-1], ""))
+        result.append(word)
+    return result
+
+
+def test_failed_segment_comes_from_full_pass(tmp_path):
+    # The first paragraph's letters outnumber the frames of its segment, so it cannot be
+    # aligned on its own; the whole file has frames enough for every letter
+    audio = write_speech(str(tmp_path / "chapter.wav"), 70.0, [(23.0, 24.5)])
+    first, second = words(30, 15, seed=1), words(60, 3, seed=2)
+    text = " ".join(first) + "\n\n" + " ".join(second)
+    cache = EmissionCache(str(tmp_path / "cache"))
+    aligner = Aligner(StubBackend(), "numpy", emission_cache=cache).load()
+    segmenter = Segmenter(workers=2)
+    segments, _ = segmenter.segments(text, audio)
+    assert [len(segment_words) for segment_words, _, _ in segments] == [30, 60]
+
+    full = aligner.align(" ".join(first + second), audio)
+    marks = segmenter.align(aligner, text, audio)
+    assert [mark['w'] for mark in marks] == first + second
+    assert marks[:30] == full[:30]
+    # Only the whole file's emissions are cached, not those of the segment slices
+    assert os.listdir(cache.cache_dir) == [cache.key(audio, aligner.backend.name) + cache.suffix]
@@ -0,0 +1,43 @@
+import os
+
+from worker_pool import THREAD_VARIABLES, WorkerPool, schedule, thread_caps
+
+# In a spawned worker this module is imported while _worker's arguments are unpickled, before
+# any of the worker's own code runs: the environment numpy and torch would start their pools in
+IMPORT_ENVIRONMENT = {variable: os.environ.get(variable) for variable in THREAD_VARIABLES}
+
+
+class EnvironmentReader:
+    def marksResponse(self, text, file_name, audio_path, window, overlap, marks_format):
+        return {'status': True, 'environment': IMPORT_ENVIRONMENT}
+
+
+def make_reader(args):
+    return EnvironmentReader()
+
+
+def test_workers_start_with_thread_caps():
+    before = {variable: os.environ.get(variable) for variable in THREAD_VARIABLES}
+    with WorkerPool(make_reader, None, workers=1, threads=3) as pool:
+        response = pool.batchResponse([("a", "text", "missing.wav")], "pool")
+    assert response['status']
+    assert response['results'][0]['environment'] == {variable: "3" for variable in THREAD_VARIABLES}
+    # The parent's own environment is left as it was
+    assert {variable: os.environ.get(variable) for variable in THREAD_VARIABLES} == before
+
+
+def test_thread_caps_restore(monkeypatch):
+    monkeypatch.setenv("OMP_NUM_THREADS", "16")
+    monkeypatch.delenv("MKL_NUM_THREADS", raising=False)
+    with thread_caps(2):
+        assert [os.environ[variable] for variable in THREAD_VARIABLES] == ["2", "2", "2"]
+    assert os.environ["OMP_NUM_THREADS"] == "16"
+    assert "MKL_NUM_THREADS" not in os.environ
+
+
+def test_schedule():
+    items = [("long", "", "", 900.0)] + [(str(i), "", "", 100.0) for i in range(7)]
+    units = schedule(items, batch_size=2, bin_seconds=300.0, long_seconds=600.0)
+    assert units[0] == (True, [items[0]])
+    assert all(not is_long and len(unit) <= 2 for is_long, unit in units[1:])
+    assert sorted(item[0] for _, unit in units for item in unit) == sorted(item[0] for item in items)
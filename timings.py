@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import cProfile
+from contextvars import ContextVar
+from contextlib import contextmanager
+
+from emission_cache import atomic_write
+
+METRICS_FORMATS = ("prometheus", "jsonl")
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+METRIC_PREFIX = "forced_alignment"
+
+_current = ContextVar("timings", default=None)
+
+
+class _Span:
+    __slots__ = ("timings", "name", "start")
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.name, time.perf_counter() - self.start)
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+def span(name):
+    # Times a pipeline stage for the request being recorded, if any; otherwise a shared no-op
+    timings = _current.get()
+    if timings is None:
+        return NO_SPAN
+    return _Span(timings, name)
+
+
+class Timings:
+    # Seconds per stage for one request. Stages entered more than once (one per window or
+    # per batch) add up.
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def as_dict(self, ndigits=4):
+        return {name: round(seconds, ndigits) for name, seconds in self.stages.items()}
+
+
+@contextmanager
+def recording(timings):
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+class MetricsSink:
+    # Cumulative request counts and per-stage histograms. "prometheus" rewrites path in the
+    # text exposition format after every request (for a textfile collector); "jsonl" appends
+    # one line per request with its stage timings.
+
+    def __init__(self, path, metrics_format="prometheus", buckets=DEFAULT_BUCKETS):
+        if metrics_format not in METRICS_FORMATS:
+            raise ValueError(f"Unknown metrics format: {metrics_format}")
+        self.path = path
+        self.metrics_format = metrics_format
+        self.buckets = tuple(buckets)
+        self.requests = {}
+        self.histograms = {}
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, stages, status, name=None):
+        status = "ok" if status else "error"
+        self.requests[status] = self.requests.get(status, 0) + 1
+        for stage, seconds in stages.items():
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+        if self.metrics_format == "jsonl":
+            with open(self.path, "a") as f:
+                f.write(json.dumps({'ts': round(time.time(), 3), 'name': name, 'status': status,
+                                    'timings': {stage: round(seconds, 6) for stage, seconds in stages.items()}}) + "\n")
+        else:
+            self.write_prometheus()
+
+    def prometheus_text(self):
+        lines = [
+            f"# HELP {METRIC_PREFIX}_requests_total Alignment requests handled, by status.",
+            f"# TYPE {METRIC_PREFIX}_requests_total counter",
+        ]
+        for status, count in sorted(self.requests.items()):
+            lines.append(f'{METRIC_PREFIX}_requests_total{{status="{status}"}} {count}')
+        lines += [
+            f"# HELP {METRIC_PREFIX}_stage_seconds Time spent in each pipeline stage per request.",
+            f"# TYPE {METRIC_PREFIX}_stage_seconds histogram",
+        ]
+        for stage, histogram in sorted(self.histograms.items()):
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {count}')
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]:.6f}')
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        # Atomic, so a scraper never sees half a file
+        with atomic_write(self.path, "w") as f:
+            f.write(self.prometheus_text())
+
+
+class CProfileHook:
+    # Profiler hook for TextReader: profiles the requests named in names (all of them if None)
+    # and dumps pstats files to output_dir/{name}.prof
+
+    def __init__(self, output_dir, names=None):
+        self.output_dir = output_dir
+        self.names = None if names is None else set(names)
+        os.makedirs(output_dir, exist_ok=True)
+
+    def __call__(self, name):
+        if self.names is not None and name not in self.names:
+            return None
+        return self.profile(name)
+
+    @contextmanager
+    def profile(self, name):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(self.output_dir, f"{name}.prof"))
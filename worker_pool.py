@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import queue
+import wave
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from aligner import DEFAULT_BATCH_SIZE, audio_duration
+from long_align import DEFAULT_OVERLAP
+
+DEFAULT_THREADS = 4
+DEFAULT_BIN_SECONDS = 300.0
+DEFAULT_LONG_SECONDS = 600.0
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+
+def clip_duration(audio_path):
+    # Unknown durations sort last; the worker reports the real problem with the file
+    try:
+        return audio_duration(audio_path)
+    except (OSError, wave.Error, EOFError):
+        return 0.0
+
+
+def schedule(items, batch_size=DEFAULT_BATCH_SIZE, bin_seconds=DEFAULT_BIN_SECONDS, long_seconds=DEFAULT_LONG_SECONDS):
+    # items: (id, text, audio_path, duration). Files longer than long_seconds become units of
+    # their own; the rest are packed first-fit decreasing into bins of at most bin_seconds of
+    # audio and batch_size clips. Units come back longest first, so the big files start
+    # straight away and the clip bins fill in around them.
+    units = []
+    bins = []
+    for item in sorted(items, key=lambda item: item[3], reverse=True):
+        if item[3] > long_seconds:
+            units.append((True, [item]))
+            continue
+        for unit in bins:
+            if len(unit) < batch_size and sum(clip[3] for clip in unit) + item[3] <= bin_seconds:
+                unit.append(item)
+                break
+        else:
+            bins.append([item])
+    units.extend((False, unit) for unit in bins)
+    units.sort(key=lambda unit: sum(item[3] for item in unit[1]), reverse=True)
+    return units
+
+
+@contextmanager
+def thread_caps(threads):
+    # The thread caps have to be in a worker's environment before torch or numpy start their
+    # pools, and a spawned worker imports numpy (to unpickle _worker) before running any of
+    # its code. So they are set here, in the parent, for the processes started inside.
+    saved = {variable: os.environ.get(variable) for variable in THREAD_VARIABLES}
+    os.environ.update({variable: str(threads) for variable in THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for variable, value in saved.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+
+
+def _worker(index, make_reader, reader_args, threads, tasks, results):
+    reader = make_reader(reader_args)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    results.put(("ready", index, os.getpid()))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        unit_id, is_long, items, file_name, batch_size, marks_format, window, overlap = task
+        start_time = time.time()
+        if is_long or len(items) == 1:
+            responses = [_single(reader, item, f"{file_name}_{item[0]}", marks_format, window if is_long else None,
+                                 overlap) for item in items]
+        else:
+            responses = _batch(reader, items, file_name, batch_size, marks_format, overlap)
+        results.put(("done", index, unit_id, time.time() - start_time, responses))
+
+
+def _single(reader, item, file_name, marks_format, window, overlap):
+    response = reader.marksResponse(item[1], file_name, item[2], window, overlap, marks_format)
+    return dict(response, id=item[0])
+
+
+def _batch(reader, items, file_name, batch_size, marks_format, overlap):
+    batch_response = reader.batchResponse([item[:3] for item in items], file_name, batch_size, marks_format)
+    if not batch_response['status']:
+        # One bad clip fails the whole bin; answer each on its own so the others still get marks
+        return [_single(reader, item, f"{file_name}_{item[0]}", marks_format, None, overlap) for item in items]
+    return [dict(result, status=True) for result in batch_response['results']]
+
+
+class WorkerPool:
+    # N processes, each with its own warm TextReader from make_reader(reader_args) and a fixed
+    # number of intra-op threads. Work units are handed out longest first from one shared
+    # queue, so whichever worker is free takes the next one.
+
+    def __init__(self, make_reader, reader_args, workers=None, threads=DEFAULT_THREADS,
+                 bin_seconds=DEFAULT_BIN_SECONDS, long_seconds=DEFAULT_LONG_SECONDS, audio_cache=None):
+        self.make_reader = make_reader
+        self.reader_args = reader_args
+        self.workers = workers if workers is not None else max((os.cpu_count() or 1) // threads, 1)
+        self.threads = threads
+        self.bin_seconds = bin_seconds
+        self.long_seconds = long_seconds
+        self.audio_cache = audio_cache
+        self.context = multiprocessing.get_context("spawn")
+        self.tasks = None
+        self.results = None
+        self.processes = []
+        self.usage = []
+        self.started = None
+        self.next_unit = 0
+
+    def start(self):
+        if self.processes:
+            return self
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        with thread_caps(self.threads):
+            for index in range(self.workers):
+                process = self.context.Process(
+                    target=_worker, daemon=True,
+                    args=(index, self.make_reader, self.reader_args, self.threads, self.tasks, self.results))
+                process.start()
+                self.processes.append(process)
+                self.usage.append({'worker': index, 'pid': None, 'units': 0, 'clips': 0, 'audio_seconds': 0.0,
+                                   'busy_seconds': 0.0})
+        # Every worker has its model loaded before the first request is scheduled
+        for _ in range(self.workers):
+            _, index, pid = self._result()
+            self.usage[index]['pid'] = pid
+        self.started = time.time()
+        return self
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def processBatch(self, items, file_name, batch_size=DEFAULT_BATCH_SIZE, marks_format="json", window=None,
+                     overlap=DEFAULT_OVERLAP, durations=None):
+        return json.dumps(self.batchResponse(items, file_name, batch_size, marks_format, window, overlap, durations))
+
+    def batchResponse(self, items, file_name, batch_size=DEFAULT_BATCH_SIZE, marks_format="json", window=None,
+                      overlap=DEFAULT_OVERLAP, durations=None):
+        # Same shape as TextReader.batchResponse, results in input order. A clip that fails
+        # carries its own status and message instead of failing the rest.
+        start_time = time.time()
+        ids = [str(utt_id) for utt_id, _, _ in items]
+        if len(set(ids)) != len(ids):
+            return {'status': False, 'message': "Duplicate utterance ids in batch",
+                    'time': float("{:.2f}".format(time.time() - start_time))}
+        self.start()
+        if durations is None:
+            items, durations = self.ingest(items)
+        units = schedule([(str(utt_id), text, audio_path, duration)
+                          for (utt_id, text, audio_path), duration in zip(items, durations)],
+                         batch_size, self.bin_seconds, self.long_seconds)
+        pending = {}
+        for is_long, unit in units:
+            unit_id = self.next_unit
+            self.next_unit += 1
+            pending[unit_id] = unit
+            self.tasks.put((unit_id, is_long, [item[:3] for item in unit], f"{file_name}_{unit_id}", batch_size,
+                            marks_format, window, overlap))
+
+        by_id = {}
+        while pending:
+            _, index, unit_id, busy_seconds, responses = self._result()
+            unit = pending.pop(unit_id)
+            usage = self.usage[index]
+            usage['units'] += 1
+            usage['clips'] += len(unit)
+            usage['audio_seconds'] += sum(item[3] for item in unit)
+            usage['busy_seconds'] += busy_seconds
+            for response in responses:
+                by_id[response['id']] = response
+
+        response = {'results': []}
+        for utt_id, _, _ in items:
+            result = by_id[str(utt_id)]
+            response['results'].append({'id': result['id'], **{key: value for key, value in result.items()
+                                                               if key not in ('id', 'time')}})
+        response['status'] = all(result['status'] for result in response['results'])
+        response['time'] = float("{:.2f}".format(time.time() - start_time))
+        response['workers'] = self.stats()
+        return response
+
+    def ingest(self, items):
+        # With an audio cache the clips are decoded here, in parallel, and the workers get the
+        # cached 16 kHz copies; either way the durations come from the WAV headers
+        if self.audio_cache is None:
+            return items, [clip_duration(audio_path) for _, _, audio_path in items]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            paths = list(executor.map(self._ingest, [audio_path for _, _, audio_path in items]))
+        return ([(utt_id, text, path) for (utt_id, text, _), path in zip(items, paths)],
+                [clip_duration(path) for path in paths])
+
+    def _ingest(self, audio_path):
+        try:
+            return self.audio_cache.ingest(audio_path)
+        except (OSError, ValueError, wave.Error):
+            return audio_path
+
+    def stats(self):
+        # utilization: share of the pool's lifetime each worker spent aligning
+        uptime = time.time() - self.started if self.started is not None else 0.0
+        return [dict(usage, audio_seconds=round(usage['audio_seconds'], 2),
+                     busy_seconds=round(usage['busy_seconds'], 2),
+                     utilization=round(usage['busy_seconds'] / uptime, 3) if uptime > 0 else 0.0)
+                for usage in self.usage]
+
+    def _result(self):
+        while True:
+            try:
+                return self.results.get(timeout=1.0)
+            except queue.Empty:
+                dead = [process.pid for process in self.processes if not process.is_alive()]
+                if dead:
+                    raise RuntimeError(f"Alignment worker exited unexpectedly (pid {', '.join(map(str, dead))})")